@@ -0,0 +1,771 @@
+import collections
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+from datetime import datetime
+from fractions import Fraction
+
+import cv2
+import numpy as np
+
+from pic2formula.bspline2fourier_series import bsplines2fourier_series
+from pic2formula.detect_edge import detect_edge_headless
+from pic2formula.edges2polylines import edges2polylines, edges2polylines_py
+from pic2formula.edge_graph import edges2polylines_graph
+from pic2formula.generate import (iter_fourier_series, simplify_polylines, TRACERS,
+                                  SIMPLIFY_STEP_RATIO)
+from pic2formula.packed_pic_formula import PackedPicFormula
+from pic2formula.pic_formula import PicFormula, sample_pf
+from pic2formula.picf import save_picf, load_picf
+from pic2formula.polyline import Polyline
+from pic2formula.rational import limit_denominator
+from pic2formula.stats import Stats
+from pic2formula.tiles import trace_tiles, DEFAULT_OVERLAP
+
+
+# stagesで使う合成画像の種類
+IMAGE_KINDS = ("circles", "text", "noise", "texture")
+
+
+def main():
+    args = get_args()
+    args.func(args)
+
+
+def get_args():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_trace = subparsers.add_parser(
+        "trace", help="compare the tracers of edges2polylines")
+    parser_trace.add_argument("--sizes", type=int, nargs="+",
+                              default=[128, 256, 512],
+                              help="side length of synthetic images[128 256 512]")
+    parser_trace.add_argument("-e", type=int, default=6,
+                              help="connect points which have distance less than given[6]")
+    parser_trace.add_argument("--seed", type=int, default=0,
+                              help="random seed[0]")
+    parser_trace.add_argument("--skip-python", action="store_true",
+                              help="skip edges2polylines_py(slow)")
+    parser_trace.set_defaults(func=bench_trace)
+
+    parser_fourier = subparsers.add_parser(
+        "fourier", help="time iter_fourier_series against the number of curves")
+    parser_fourier.add_argument("--curves", type=int, nargs="+",
+                                default=[100, 500, 2000],
+                                help="number of curves[100 500 2000]")
+    parser_fourier.add_argument("-n", type=int, default=500,
+                                help="degree of fourier series approximation[500]")
+    parser_fourier.add_argument("-k", type=int, default=4,
+                                help="degree of B-Spline[4]")
+    parser_fourier.add_argument("-j", "--workers", type=int, nargs="+",
+                                default=[2, 4],
+                                help="numbers of workers to compare with serial[2 4]")
+    parser_fourier.add_argument("--pool", type=str, default="process",
+                                choices=["process", "thread"],
+                                help="pool used in parallel runs[process]")
+    parser_fourier.add_argument("--seed", type=int, default=0,
+                                help="random seed[0]")
+    parser_fourier.set_defaults(func=bench_fourier)
+
+    parser_latex = subparsers.add_parser(
+        "latex", help="compare building the tex/desmos text in memory with streaming it")
+    parser_latex.add_argument("--terms", type=int, default=1000000,
+                              help="number of terms of each of x(t) and y(t)[1000000]")
+    parser_latex.add_argument("-n", type=int, default=1000,
+                              help="degree of each curve[1000]")
+    parser_latex.add_argument("--maxd", type=int, default=100,
+                              help="max denominator of fraction[100]")
+    parser_latex.add_argument("--chunk-size", type=int, default=1 << 20,
+                              help="characters written at once in the chunked mode[1048576]")
+    parser_latex.add_argument("--seed", type=int, default=0,
+                              help="random seed[0]")
+    parser_latex.set_defaults(func=bench_latex)
+
+    parser_fraction = subparsers.add_parser(
+        "fraction", help="compare limit_denominator with Fraction.limit_denominator")
+    parser_fraction.add_argument("--terms", type=int, default=100000,
+                                 help="number of coefficients[100000]")
+    parser_fraction.add_argument("--maxd", type=int, default=100,
+                                 help="max denominator of fraction[100]")
+    parser_fraction.add_argument("--seed", type=int, default=0,
+                                 help="random seed[0]")
+    parser_fraction.set_defaults(func=bench_fraction)
+
+    parser_stages = subparsers.add_parser(
+        "stages", help="time each stage of the pipeline on synthetic images")
+    parser_stages.add_argument("--kinds", type=str, nargs="+", default=list(IMAGE_KINDS),
+                               choices=list(IMAGE_KINDS),
+                               help="kinds of synthetic images[{}]".format(" ".join(IMAGE_KINDS)))
+    parser_stages.add_argument("--sizes", type=int, nargs="+", default=[256, 512],
+                               help="side length of synthetic images[256 512]")
+    parser_stages.add_argument("--densities", type=float, nargs="+", default=[1.0, 2.0],
+                               help="density of shapes/details in synthetic images[1.0 2.0]")
+    parser_stages.add_argument("-n", type=int, default=100,
+                               help="degree of fourier series approximation[100]")
+    parser_stages.add_argument("-e", type=int, default=6,
+                               help="connect points which have distance less than given[6]")
+    parser_stages.add_argument("-k", type=int, default=4,
+                               help="degree of B-Spline[4]")
+    parser_stages.add_argument("--ml", type=int, default=10,
+                               help="minimum length of polylines[10]")
+    parser_stages.add_argument("--maxd", type=int, default=100,
+                               help="max denominator of fraction[100]")
+    parser_stages.add_argument("--showmax", type=int, default=None,
+                               help="max number of terms shown in latex()[all]")
+    parser_stages.add_argument("--simplify", type=float, default=None,
+                               help="tolerance of polyline simplification in pixels[no simplification]")
+    parser_stages.add_argument("--samples", type=int, default=100000,
+                               help="number of t at which PicFormula is evaluated[100000]")
+    parser_stages.add_argument("-r", "--repeat", type=int, default=5,
+                               help="number of runs of each stage(the best is reported)[5]")
+    parser_stages.add_argument("--seed", type=int, default=0,
+                               help="random seed[0]")
+    parser_stages.add_argument("-o", "--output", type=str, default="benchmark_stages.json",
+                               help="JSON file to write the results[benchmark_stages.json]")
+    parser_stages.set_defaults(func=bench_stages)
+
+    parser_compare = subparsers.add_parser(
+        "compare", help="compare two results of stages and flag regressions")
+    parser_compare.add_argument("base", type=str,
+                                help="JSON file of the baseline")
+    parser_compare.add_argument("new", type=str,
+                                help="JSON file to compare with the baseline")
+    parser_compare.add_argument("--threshold", type=float, default=0.25,
+                                help="relative slowdown regarded as a regression[0.25]")
+    parser_compare.add_argument("--min-time", type=float, default=1e-3,
+                                help="ignore differences smaller than given(s)[0.001]")
+    parser_compare.set_defaults(func=bench_compare)
+
+    parser_server = subparsers.add_parser(
+        "server", help="load-test server.py on localhost and report latency percentiles")
+    parser_server.add_argument("--kind", type=str, default="circles", choices=list(IMAGE_KINDS),
+                               help="kind of the synthetic image[circles]")
+    parser_server.add_argument("--size", type=int, default=256,
+                               help="side length of the synthetic image[256]")
+    parser_server.add_argument("--requests", type=int, default=50,
+                               help="number of requests[50]")
+    parser_server.add_argument("-c", "--concurrency", type=int, default=4,
+                               help="number of concurrent clients[4]")
+    parser_server.add_argument("-j", "--workers", type=int, default=2,
+                               help="number of workers of the server[2]")
+    parser_server.add_argument("--queue", type=int, default=None,
+                               help="queue size of the server[2 * workers]")
+    parser_server.add_argument("--timeout", type=float, default=60,
+                               help="timeout of a request in seconds[60]")
+    parser_server.add_argument("--query", type=str, default="n=100&maxd=100",
+                               help="query string of /convert[n=100&maxd=100]")
+    parser_server.add_argument("--seed", type=int, default=0,
+                               help="random seed[0]")
+    parser_server.set_defaults(func=bench_server)
+
+    parser_tiles = subparsers.add_parser(
+        "tiles", help="compare tiled tracing with the untiled trace on a colour image")
+    parser_tiles.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000],
+                              help="side length of synthetic images[1000 2000]")
+    parser_tiles.add_argument("--tile-size", type=int, default=256,
+                              help="size of tiles in px[256]")
+    parser_tiles.add_argument("--overlap", type=int, default=DEFAULT_OVERLAP,
+                              help="margin read around each tile in px[{}]".format(DEFAULT_OVERLAP))
+    parser_tiles.add_argument("-e", type=int, default=6,
+                              help="connect points which have distance less than given[6]")
+    parser_tiles.add_argument("--methods", type=str, nargs="+", default=list(TRACERS),
+                              choices=list(TRACERS),
+                              help="methods to convert edges to polylines[{}]".format(
+                                  " ".join(TRACERS)))
+    parser_tiles.add_argument("-j", "--workers", type=int, default=None,
+                              help="number of worker processes of the tiled run[no parallelization]")
+    parser_tiles.add_argument("--seed", type=int, default=0,
+                              help="random seed[0]")
+    parser_tiles.set_defaults(func=bench_tiles)
+
+    args = parser.parse_args()
+    return args
+
+
+def synthetic_edges(size, seed=0):
+    """
+    円と文字を描いた画像のエッジ検出結果を返す
+    """
+    rng = np.random.default_rng(seed)
+    img = np.zeros((size, size), dtype=np.uint8)
+    for _ in range(max(size // 32, 1)):
+        center = tuple(int(c) for c in rng.integers(0, size, 2))
+        radius = int(rng.integers(size // 32 + 2, size // 4 + 3))
+        cv2.circle(img, center, radius, 255, 2)
+    scale = size / 256
+    for ii in range(max(size // 128, 1)):
+        org = (int(rng.integers(0, size // 2)), int(rng.integers(size // 4, size)))
+        cv2.putText(img, "pic2formula"[ii % 11:], org,
+                    cv2.FONT_HERSHEY_SIMPLEX, scale, 255, max(int(scale * 2), 1))
+    return cv2.Canny(img, 100, 200, L2gradient=True)
+
+
+def synthetic_polylines(num, seed=0):
+    """
+    長さの異なる楕円状の折れ線をnum本返す(短いものほど多い)
+    """
+    rng = np.random.default_rng(seed)
+    polylines = []
+    for _ in range(num):
+        n_points = int(min(rng.pareto(1.2) * 12 + 8, 3000))
+        theta = np.linspace(0, 2 * np.pi, n_points, endpoint=False)
+        a, b = rng.uniform(2, 200, 2)
+        polylines.append(Polyline(np.stack((np.round(a * np.cos(theta)),
+                                            np.round(b * np.sin(theta))), axis=1)))
+    return sorted(polylines, key=len)
+
+
+def synthetic_image(kind, size, density=1.0, seed=0):
+    """
+    エッジ検出前のグレースケールの合成画像を返す
+
+    Parameters
+    ----------
+    kind : str
+        "circles" : 円
+        "text" : 文字列
+        "noise" : ぼかしたノイズを2値化した斑点模様
+        "texture" : グラデーション・縞・ノイズを重ねた写真のような濃淡
+    density : float
+        図形の数や模様の細かさの倍率
+    """
+    rng = np.random.default_rng(seed)
+    img = np.zeros((size, size), dtype=np.uint8)
+    if kind == "circles":
+        for _ in range(max(int(density * size / 32), 1)):
+            center = tuple(int(c) for c in rng.integers(0, size, 2))
+            radius = int(rng.integers(size // 32 + 2, size // 4 + 3))
+            cv2.circle(img, center, radius, 255, 2)
+    elif kind == "text":
+        scale = size / 512
+        n_rows = max(int(density * size / 64), 1)
+        for ii in range(n_rows):
+            org = (int(rng.integers(0, size // 4)), int((ii + 1) * size / (n_rows + 1)))
+            cv2.putText(img, "pic2formula", org, cv2.FONT_HERSHEY_SIMPLEX,
+                        scale * 1.5, 255, max(int(scale * 3), 1))
+    elif kind == "noise":
+        ksize = max(int(size / (16 * density)), 3) // 2 * 2 + 1
+        noise = cv2.GaussianBlur(rng.random((size, size)), (ksize, ksize), 0)
+        img[noise > np.median(noise)] = 255
+    elif kind == "texture":
+        y, x = np.mgrid[0:size, 0:size] / size
+        tmp = 0.4 * x + 0.2 * y
+        for _ in range(max(int(4 * density), 1)):
+            fx, fy = rng.uniform(-4 * density, 4 * density, 2)
+            tmp += 0.15 * np.sin(2 * np.pi * (fx * x + fy * y) + rng.uniform(0, 2 * np.pi))
+        # 物体の境界の代わりに濃さの異なる楕円を塗る
+        for _ in range(max(int(density * size / 16), 1)):
+            mask = np.zeros((size, size), dtype=np.uint8)
+            center = tuple(int(c) for c in rng.integers(0, size, 2))
+            axes = tuple(int(a) for a in rng.integers(size // 32 + 2, size // 6 + 3, 2))
+            cv2.ellipse(mask, center, axes, float(rng.uniform(0, 180)), 0, 360, 1, -1)
+            tmp[mask == 1] = 0.5 * tmp[mask == 1] + rng.uniform(0, 0.8)
+        tmp = cv2.GaussianBlur(tmp, (3, 3), 0)
+        tmp += 0.3 * cv2.GaussianBlur(rng.normal(0, 1, (size, size)), (5, 5), 0)
+        tmp = (tmp - tmp.min()) / (tmp.max() - tmp.min())
+        img = np.round(tmp * 255).astype(np.uint8)
+    else:
+        raise ValueError("kind must be one of {}.".format(list(IMAGE_KINDS)))
+    return img
+
+
+def timeit(fun, *args, **kwargs):
+    start = time.perf_counter()
+    res = fun(*args, **kwargs)
+    return res, time.perf_counter() - start
+
+
+def repeat_timeit(repeat, fun, *args, **kwargs):
+    """
+    funをrepeat回実行し，最後の結果と各回の時間を返す
+    """
+    times = []
+    for _ in range(max(repeat, 1)):
+        res, t = timeit(fun, *args, **kwargs)
+        times.append(t)
+    return res, times
+
+
+def bench_trace(args):
+    # numbaのコンパイル時間を計測に含めないように一度実行しておく
+    edges2polylines_graph(synthetic_edges(64), args.e)
+    with contextlib.redirect_stdout(io.StringIO()):
+        edges2polylines(synthetic_edges(64), args.e)
+
+    print("{:>6s} {:>8s} {:>10s} {:>10s} {:>6s} {:>8s} {:>10s} {:>8s}".format(
+          "size", "pixels", "python[s]", "numba[s]", "same", "lines",
+          "graph[s]", "lines"))
+    for size in args.sizes:
+        edges = synthetic_edges(size, args.seed)
+        n_pixels = int(np.count_nonzero(edges == 255))
+        lines_g, t_graph = timeit(edges2polylines_graph, edges, args.e)
+        # 進捗表示は計測の邪魔になるので捨てる
+        with contextlib.redirect_stdout(io.StringIO()):
+            random.seed(args.seed)
+            lines, t_numba = timeit(edges2polylines, edges.copy(), args.e)
+            if args.skip_python:
+                t_python, same = float("nan"), "-"
+            else:
+                random.seed(args.seed)
+                lines_py, t_python = timeit(edges2polylines_py, edges.copy(), args.e)
+                same = len(lines) == len(lines_py) and all(
+                    np.array_equal(a, b) for a, b in zip(lines, lines_py))
+        print("{:6d} {:8d} {:10.3f} {:10.3f} {:>6s} {:8d} {:10.3f} {:8d}".format(
+              size, n_pixels, t_python, t_numba, str(same), len(lines),
+              t_graph, len(lines_g)))
+
+def fourier_series(polylines, n, k, workers=None, pool="process"):
+    """
+    generateと同じようにiter_fourier_seriesで変換し，xのFourierSeriesのリストを返す
+    """
+    return [x_fs for _, x_fs, _ in iter_fourier_series(polylines, n, k, workers=workers,
+                                                       pool=pool)]
+
+
+def bench_fourier(args):
+    header = "{:>7s} {:>8s} {:>10s}".format("curves", "points", "serial[s]")
+    for workers in args.workers:
+        header += " {:>10s} {:>7s}".format("j={}[s]".format(workers), "speedup")
+    print(header)
+    for num in args.curves:
+        polylines = synthetic_polylines(num, args.seed)
+        n_points = sum(len(polyline) for polyline in polylines)
+        x_ref, t_serial = timeit(fourier_series, polylines, args.n, args.k)
+        row = "{:7d} {:8d} {:10.3f}".format(num, n_points, t_serial)
+        for workers in args.workers:
+            x_fs_lst, t = timeit(fourier_series, polylines, args.n, args.k,
+                                 workers=workers, pool=args.pool)
+            # 並列化しても順番と結果が変わらないことを確認
+            assert len(x_ref) == len(x_fs_lst)
+            assert all(np.array_equal(a.r, b.r) for a, b in zip(x_ref, x_fs_lst))
+            row += " {:10.3f} {:7.2f}".format(t, t_serial / t)
+        print(row)
+
+
+def bench_fraction(args):
+    def reference(x, maxd):
+        fracs = [Fraction(float(v)).limit_denominator(maxd) for v in x]
+        return [f.numerator for f in fracs], [f.denominator for f in fracs]
+
+    limit_denominator(np.ones(1), args.maxd)  # numbaのコンパイル
+    rng = np.random.default_rng(args.seed)
+    x = rng.normal(0, 100, args.terms) * 10.0 ** rng.integers(-12, 4, args.terms)
+    (num, den), t_vec = timeit(limit_denominator, x, args.maxd)
+    (num_ref, den_ref), t_ref = timeit(reference, x, args.maxd)
+    assert np.array_equal(num, num_ref) and np.array_equal(den, den_ref)
+    print("{:>8s} {:>14s} {:>10s} {:>8s}".format("terms", "Fraction[s]", "numba[s]", "speedup"))
+    print("{:8d} {:14.3f} {:10.3f} {:8.1f}".format(args.terms, t_ref, t_vec, t_ref / t_vec))
+
+    # 境界の値: 0, 0か±1/maxdになる小さな値，int64の範囲の端
+    maxd = args.maxd
+    edge = np.array([0.0, 5e-324, 1 / (2 * maxd), -1 / (2 * maxd), 1 / (maxd + 1),
+                     np.nextafter(1 / (2 * maxd), 1), 2.0 ** 53 + 2, 2.0 ** 62 / maxd,
+                     -(2.0 ** 63), np.nextafter(2.0 ** 63, 0)])
+    num, den = limit_denominator(edge, maxd)
+    assert ([int(v) for v in num], [int(v) for v in den]) == reference(edge, maxd)
+    # int64に収まらないものはValueErrorにする
+    for value in (2.0 ** 63, -1e300, 1e300, np.inf, np.nan):
+        try:
+            limit_denominator(np.array([1.0, value]), maxd)
+        except ValueError:
+            continue
+        raise AssertionError("limit_denominator accepted {!r}".format(value))
+    print("boundary values: ok")
+
+
+def synthetic_picf(n_terms, n, maxd=100, seed=0):
+    """
+    合計n_terms項の係数を持つx, yのPackedPicFormulaFractionを返す
+    """
+    rng = np.random.default_rng(seed)
+    num = max(n_terms // (n + 1), 1)
+    offsets = np.arange(num + 1) * (n + 1)
+    decay = np.tile(1 / (1 + np.arange(n + 1)), num)
+    res = []
+    for _ in range(2):
+        r = rng.normal(0, 100, num * (n + 1)) * decay
+        p = rng.uniform(-np.pi, np.pi, num * (n + 1))
+        res.append(PackedPicFormula(r, p, offsets).fraction(maxd))
+    return res
+
+
+class RSSMonitor:
+    """
+    別スレッドでRSSを定期的に読み，開始時からの増分の最大値(byte)を記録する
+
+    /proc/self/statmが無い環境ではru_maxrssの増分で代用する
+    """
+
+    def __init__(self, interval=1e-3):
+        self.interval = interval
+        self.start = self._rss()
+        self.peak = self.start
+        self._maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _rss():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * resource.getpagesize()
+        except OSError:
+            return None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = self._rss()
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if self.start is None:
+            return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - self._maxrss) * 1024
+        self.peak = max(self.peak, self._rss())
+        return self.peak - self.start
+
+
+def _write_text(path, picf_path, kind, mode, chunk_size):
+    """
+    picfファイルを読み込んでtex/desmosを書き出し，時間とピークRSSの増分(byte)を返す
+    (新しいプロセスで実行する)
+    """
+    x, y = load_picf(picf_path)
+    monitor = RSSMonitor()
+    start = time.perf_counter()
+    if mode == "string":
+        # 文字列全体を作ってから書き込む(以前のgenerate_tex, generate_desmos)
+        if kind == "tex":
+            s = "\\begin{{align*}}\n{}\\end{{align*}}\n{}".format(x.latex(None), y.latex(None))
+        else:
+            s = x.str_desmos(fun_name="f") + y.str_desmos(fun_name="g")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(s)
+    else:
+        chunk_size = chunk_size if mode == "chunked" else None
+        if kind == "tex":
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("\\begin{align*}\n")
+                x.write_latex(f, None, chunk_size)
+                f.write("\\end{align*}\n")
+                y.write_latex(f, None, chunk_size)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                x.write_desmos(f, "f", chunk_size)
+                y.write_desmos(f, "g", chunk_size)
+    elapsed = time.perf_counter() - start
+    return elapsed, monitor.stop()
+
+
+def bench_latex(args):
+    x, y = synthetic_picf(args.terms, args.n, args.maxd, args.seed)
+    print("{:>6s} {:>8s} {:>8s} {:>13s} {:>10s} {:>10s}".format(
+          "kind", "mode", "time[s]", "peak RSS[MB]", "size[MB]", "same"))
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as dirname:
+        picf_path = os.path.join(dirname, "bench.picf")
+        save_picf(picf_path, x, y)
+        for kind in ("tex", "desmos"):
+            digest = None
+            for mode in ("string", "stream", "chunked"):
+                path = os.path.join(dirname, "{}_{}.txt".format(kind, mode))
+                # ピークRSSを比べるために毎回新しいプロセスで書き出す
+                with ctx.Pool(1) as pool:
+                    elapsed, rss = pool.apply(_write_text, (path, picf_path, kind,
+                                                            mode, args.chunk_size))
+                with open(path, "rb") as f:
+                    data = f.read()
+                same = digest is None or hashlib.sha1(data).hexdigest() == digest
+                digest = digest or hashlib.sha1(data).hexdigest()
+                print("{:>6s} {:>8s} {:8.2f} {:13.1f} {:10.1f} {:>10s}".format(
+                      kind, mode, elapsed, rss / 2 ** 20, len(data) / 2 ** 20, str(same)))
+
+
+def run_stages(img, args):
+    """
+    画像をgenerateと同じ順に処理し，段階ごとの時間を求める
+
+    Returns
+    -------
+    times : dict
+        段階の名前から各回の時間のリストへの辞書
+    info : dict
+        エッジの画素数・折れ線の数・係数の数
+    """
+    times = {}
+    repeat = args.repeat
+
+    edges, times["canny"] = repeat_timeit(repeat, detect_edge_headless, img)
+
+    def trace():
+        # edges2polylinesはedgesを書き換え，開始点を乱数で選ぶ
+        random.seed(args.seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return edges2polylines(edges.copy(), args.e)
+    polylines, times["edges2polylines"] = repeat_timeit(repeat, trace)
+    ml = max(args.ml, args.k + 1)
+    polylines = sorted((pl for pl in polylines if len(pl) >= ml), key=lambda pl: pl.length())
+    points = sum(len(pl) for pl in polylines)
+    if args.simplify is not None:
+        polylines, times["simplify"] = repeat_timeit(
+            repeat, simplify_polylines, polylines, args.simplify, args.k,
+            SIMPLIFY_STEP_RATIO * args.simplify)
+
+    bsplines, times["closed_bspline"] = repeat_timeit(
+        repeat, lambda: [pl.closed_bspline(k=args.k) for pl in polylines])
+    (x_fs, y_fs), times["bspline2fourier_series"] = repeat_timeit(
+        repeat, bsplines2fourier_series, bsplines, args.n)
+    x_picf, y_picf = PicFormula(x_fs), PicFormula(y_fs)
+
+    (x_picff, y_picff), times["fraction"] = repeat_timeit(
+        repeat, lambda: (x_picf.fraction(args.maxd), y_picf.fraction(args.maxd)))
+    _, times["latex"] = repeat_timeit(
+        repeat, lambda: (x_picff.latex(args.showmax), y_picff.latex(args.showmax)))
+
+    tt = np.linspace(0, 2 * np.pi * max(x_picf.num, 1), args.samples)
+    _, times["PicFormula.__call__"] = repeat_timeit(
+        repeat, lambda: (x_picf(tt), y_picf(tt)))
+    _, times["plot_pf sampling"] = repeat_timeit(repeat, sample_pf, x_picf, y_picf)
+
+    info = {"edge_pixels": int(np.count_nonzero(edges == 255)),
+            "lines": len(polylines),
+            "points": points,
+            "points_simplified": sum(len(pl) for pl in polylines),
+            "coefficients": sum(fs.n + 1 for fs in x_fs)}
+    return times, info
+
+
+def bench_stages(args):
+    # numbaのコンパイル時間を計測に含めないように小さな画像で一度実行しておく
+    run_stages(synthetic_image("circles", 128, seed=args.seed),
+               Namespace(**dict(vars(args), repeat=1, samples=100)))
+
+    results = []
+    print("{:>24s} {:>8s} {:>6s} {:>24s} {:>10s} {:>10s}".format(
+          "case", "pixels", "lines", "stage", "best[s]", "median[s]"))
+    for kind in args.kinds:
+        for size in args.sizes:
+            for density in args.densities:
+                case = "{}-{}-d{:g}".format(kind, size, density)
+                img = synthetic_image(kind, size, density, args.seed)
+                times, info = run_stages(img, args)
+                for stage, ts in times.items():
+                    results.append(dict(case=case, kind=kind, size=size, density=density,
+                                        stage=stage, best=min(ts),
+                                        median=float(np.median(ts)), times=ts, **info))
+                    print("{:>24s} {:8d} {:6d} {:>24s} {:10.4f} {:10.4f}".format(
+                          case, info["edge_pixels"], info["lines"], stage,
+                          min(ts), float(np.median(ts))))
+
+    meta = {"date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "args": {key: value for key, value in vars(args).items() if key != "func"}}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+    print("saved: {}".format(args.output))
+
+
+def bench_compare(args):
+    """
+    2つのstagesの結果を段階ごとに比べ，遅くなったものを示す
+
+    newの時間がbaseの(1 + threshold)倍より大きく，差がmin_time以上のものを
+    regressionとし，1つでもあれば終了コード1で終わる
+    """
+    with open(args.base, encoding="utf-8") as f:
+        base = {(r["case"], r["stage"]): r for r in json.load(f)["results"]}
+    with open(args.new, encoding="utf-8") as f:
+        new = {(r["case"], r["stage"]): r for r in json.load(f)["results"]}
+
+    print("{:>24s} {:>24s} {:>10s} {:>10s} {:>7s}  {}".format(
+          "case", "stage", "base[s]", "new[s]", "ratio", ""))
+    regressions = []
+    for key in [key for key in new if key in base]:
+        t_base = base[key]["best"]
+        t_new = new[key]["best"]
+        ratio = t_new / t_base if t_base > 0 else float("inf")
+        flag = ""
+        if abs(t_new - t_base) >= args.min_time:
+            if ratio > 1 + args.threshold:
+                flag = "REGRESSION"
+                regressions.append(key)
+            elif ratio < 1 / (1 + args.threshold):
+                flag = "faster"
+        print("{:>24s} {:>24s} {:10.4f} {:10.4f} {:7.2f}  {}".format(
+              key[0], key[1], t_base, t_new, ratio, flag))
+    missing = [key for key in base if key not in new]
+    if missing:
+        print("not in {}: {}".format(args.new, ", ".join("/".join(key) for key in missing)))
+    print("{} regression(s) in {} stage(s)".format(
+          len(regressions), len([key for key in new if key in base])))
+    if regressions:
+        sys.exit(1)
+
+
+def bench_server(args):
+    """
+    server.pyを空いているポートで起動し，concurrency個のクライアントから
+    合わせてrequests回/convertを呼んでレイテンシを測る
+    """
+    import http.client
+    import socket
+    import subprocess
+    from server import percentiles
+
+    retry_interval = 0.05  # 503が返ったときに送り直すまでの時間(s)
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+           "--port", str(port), "-j", str(args.workers), "--timeout", str(args.timeout)]
+    if args.queue is not None:
+        cmd += ["--queue", str(args.queue)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    try:
+        # ワーカーの初期化が終わるとlistening onを表示する
+        print(proc.stdout.readline().rstrip())
+        body = cv2.imencode(".png", synthetic_image(args.kind, args.size, seed=args.seed))[1].tobytes()
+        path = "/convert?" + args.query
+        latencies = []
+        statuses = collections.Counter()
+        lock = threading.Lock()
+        remaining = iter(range(args.requests))
+
+        def client():
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=args.timeout + 10)
+            while True:
+                with lock:
+                    if next(remaining, None) is None:
+                        break
+                start = time.perf_counter()
+                while True:
+                    conn.request("POST", path, body=body)
+                    res = conn.getresponse()
+                    res.read()
+                    with lock:
+                        statuses[res.status] += 1
+                    if res.getheader("Connection") == "close":
+                        conn.close()
+                    if res.status != 503:
+                        break
+                    time.sleep(retry_interval)
+                if res.status == 200:
+                    with lock:
+                        latencies.append(time.perf_counter() - start)
+            conn.close()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - start
+
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        conn.request("GET", "/stats")
+        server_stats = json.loads(conn.getresponse().read())
+        conn.close()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    print("statuses: {}".format(dict(sorted(statuses.items()))))
+    print("throughput: {:.2f} req/s".format(statuses[200] / wall))
+    print("{:>10s} {}".format("client", percentiles(latencies)))
+    for name, values in server_stats["latency_ms"].items():
+        print("{:>10s} {}".format(name, values))
+
+
+def synthetic_color_image(size, density=1.0, seed=0):
+    """
+    灰色の背景に，グレースケールにするとほぼ同じ輝度になる色で円を塗ったBGRの合成画像
+
+    グレースケールにしてからエッジ検出すると円の境界の多くが消える
+    """
+    rng = np.random.default_rng(seed)
+    img = np.full((size, size, 3), 128, dtype=np.uint8)
+    for _ in range(max(int(density * size / 32), 1)):
+        center = tuple(int(c) for c in rng.integers(0, size, 2))
+        radius = int(rng.integers(size // 32 + 2, size // 8 + 3))
+        b, g = rng.integers(0, 256, 2)
+        # 輝度(0.299R + 0.587G + 0.114B)が背景とほぼ同じになるRを選ぶ
+        r = int(np.clip((128 - 0.587 * g - 0.114 * b) / 0.299, 0, 255))
+        cv2.circle(img, center, radius, (int(b), int(g), r), -1)
+    return img
+
+
+def _trace_image(path, method, e, tile_size, overlap, workers, seed):
+    """
+    画像ファイルのエッジを折れ線に変換し(tile_sizeがNoneなら分割しない)，
+    エッジの画素数，折れ線の点の集合のハッシュ，折れ線の数，時間，ピークRSSの増分(byte)を返す
+    (新しいプロセスで実行する)
+    """
+    # numbaのコンパイルを計測に含めない
+    with contextlib.redirect_stdout(io.StringIO()):
+        list(TRACERS[method](synthetic_edges(64), e))
+    random.seed(seed)
+    monitor = RSSMonitor()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if tile_size is None:
+            edges = detect_edge_headless(path)
+            n_pixels = int(np.count_nonzero(edges == 255))
+            lines = list(TRACERS[method](edges, e))
+        else:
+            stats = Stats()
+            lines = trace_tiles(path, e, method, tile_size=tile_size, overlap=overlap,
+                                workers=workers, stats=stats)
+            n_pixels = stats.counters["edge_pixels"]
+    elapsed = time.perf_counter() - start
+    rss = monitor.stop()
+    # 辿り始める点と向きによらずに比べる
+    point_sets = sorted(tuple(sorted(map(tuple, np.asarray(line).tolist()))) for line in lines)
+    digest = hashlib.sha1(repr(point_sets).encode()).hexdigest()
+    return n_pixels, digest, len(lines), elapsed, rss
+
+
+def bench_tiles(args):
+    print("{:>6s} {:>7s} {:>18s} {:>14s} {:>6s} {:>16s} {:>20s}".format(
+          "size", "method", "edge pixels", "lines", "same", "time[s]", "peak RSS[MB]"))
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as dirname:
+        for size in args.sizes:
+            path = os.path.join(dirname, "color{}.png".format(size))
+            cv2.imwrite(path, synthetic_color_image(size, seed=args.seed))
+            for method in args.methods:
+                res = []
+                for tile_size in (None, args.tile_size):
+                    # ピークRSSを比べるために毎回新しいプロセスで変換する
+                    with ctx.Pool(1) as pool:
+                        res.append(pool.apply(_trace_image, (path, method, args.e, tile_size,
+                                                             args.overlap, args.workers,
+                                                             args.seed)))
+                (pix_u, digest_u, lines_u, t_u, rss_u), (pix_t, digest_t, lines_t, t_t, rss_t) = res
+                # greedyは開始点が乱数なので一致しなくてもよい
+                print("{:6d} {:>7s} {:8d} {:9d} {:6d} {:7d} {:>6s} {:7.2f} {:8.2f} "
+                      "{:9.1f} {:10.1f}".format(
+                          size, method, pix_u, pix_t, lines_u, lines_t, str(digest_u == digest_t),
+                          t_u, t_t, rss_u / 2 ** 20, rss_t / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,20 @@
 from argparse import ArgumentParser
-import pickle
+import os
+
+import pic2formula
 
 
 def main():
     args = get_args()
-    with open(args.path, 'rb') as f:
-        x_picf, y_picf = pickle.load(f)
+    if args.convert is not None:
+        dst = args.convert or os.path.splitext(args.path)[0] + ".bin.picf"
+        pic2formula.convert_picf(args.path, dst)
+        print("converted : {}".format(dst))
+        return
+    if args.frame is not None:
+        x_picf, y_picf = pic2formula.load_picf_frames(args.path)[args.frame]
+    else:
+        x_picf, y_picf = pic2formula.load_picf(args.path)
     print('x = ' + x_picf.str(showmax=None))
     print()
     print('y = ' + y_picf.str(showmax=None))
@@ -13,6 +22,11 @@ def main():
 def get_args():
     parser = ArgumentParser()
     parser.add_argument('path', type=str)
+    parser.add_argument('--convert', type=str, nargs='?', const='', default=None,
+                        metavar='OUT',
+                        help='convert a pickled picf-file to the binary format[PATH.bin.picf]')
+    parser.add_argument('--frame', type=int, default=None,
+                        help='show given frame of a file written by main.py sequence --packed')
     args = parser.parse_args()
     return args
 
@@ -1,13 +1,32 @@
+import collections
+import glob
+import itertools
+import json
 import os
-import pickle
+import string
+import sys
+import time
+import traceback
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import pic2formula
 
 # このファイルがあるディレクトリ
 dir_base = os.path.dirname(os.path.abspath(__file__))
 
+# バッチモードで読み込む画像の拡張子
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+# シーケンスモードで動画として読み込む拡張子
+VIDEO_EXTS = (".mp4", ".avi", ".mov", ".mkv", ".webm", ".gif")
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        batch(get_batch_args(sys.argv[2:]))
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "sequence":
+        sequence(get_sequence_args(sys.argv[2:]))
+        return
     args = get_args()
     path = args.path
     n = args.n
@@ -18,9 +37,17 @@ def main():
     generate_tex_flag = args.tex
     desmos_flag = args.desmos
     tex_showmax = args.showmax
+    method = args.method
+    workers = args.workers
+
+    cache = None
+    if args.cache:
+        cache = pic2formula.StageCache(args.cache, max_bytes=args.cache_size * 2 ** 20)
 
     # 画像を数式に変換
-    x_picf, y_picf = pic2formula.generate(path, n=n, e=e, k=k, ml=ml)
+    x_picf, y_picf = pic2formula.generate(path, n=n, e=e, k=k, ml=ml,
+                                         method=method, workers=workers, cache=cache,
+                                         degree_tol=args.tol, simplify_tol=args.simplify)
 
     # 係数を小数から分数に変換
     x_picff = x_picf.fraction(maxd)
@@ -48,7 +75,7 @@ def main():
         if not os.path.exists(dir_desmos):
             os.mkdir(dir_desmos)
         fname += ".txt"
-        fpath = os.path.join(dir_name, fname)
+        fpath = os.path.join(dir_desmos, fname)
         generate_desmos(fpath, x_picff, y_picff)
 
     # 画像から生成した数式をプロット
@@ -70,8 +97,7 @@ def main():
             os.mkdir(dir_name)
         fname += ".picf"
         fpath = os.path.join(dir_name, fname)
-        with open(fpath, "wb") as f:
-            pickle.dump([x_picff, y_picff], f)
+        pic2formula.save_picf(fpath, x_picff, y_picff)
 
 
 def get_args():
@@ -80,6 +106,12 @@ def get_args():
                         help="path to an image")
     parser.add_argument("-n", type=int, default=500,
                         help="degree of fourier series approximation[500]")
+    parser.add_argument("--tol", type=float, default=None,
+                        help="choose the degree of each curve so that the truncation error "
+                             "is less than given pixels(-n is the maximum)")
+    parser.add_argument("--simplify", type=float, default=None,
+                        help="simplify polylines with given tolerance in pixels before "
+                             "fitting B-Splines")
     parser.add_argument("-e", type=int, default=6,
                         help="connect points which have distance less than given[6]")
     parser.add_argument("-k", type=int, default=4,
@@ -94,12 +126,380 @@ def get_args():
                         help="make a text file for desmos")
     parser.add_argument("--showmax", type=int, default=20,
                         help="maximum of degree to generate tex")
+    parser.add_argument("-m", "--method", type=str, default="greedy",
+                        choices=["greedy", "graph"],
+                        help="method to convert edges to polylines[greedy]")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of processes for the B-Spline and fourier stage")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="directory to cache edges, polylines and coefficients")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="maximum size of the cache in MB[1024]")
     args = parser.parse_args()
     return args
 
 
-def generate_tex(fname, x, y, showmax=5):
-    f = open(fname, "w", encoding="utf-8")
+def get_batch_args(argv):
+    parser = ArgumentParser(prog="main.py batch")
+    parser.add_argument("source", type=str,
+                        help="directory, glob pattern or manifest file(one path per line)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes[cpu count]")
+    parser.add_argument("--outdir", type=str, default=dir_base,
+                        help="directory to write picf/tex/desmos[directory of main.py]")
+    parser.add_argument("--summary", type=str, default=None,
+                        help="path to write a json summary[OUTDIR/summary.json]")
+    parser.add_argument("-n", type=int, default=500,
+                        help="degree of fourier series approximation[500]")
+    parser.add_argument("--tol", type=float, default=None,
+                        help="choose the degree of each curve so that the truncation error "
+                             "is less than given pixels(-n is the maximum)")
+    parser.add_argument("--simplify", type=float, default=None,
+                        help="simplify polylines with given tolerance in pixels before "
+                             "fitting B-Splines")
+    parser.add_argument("-e", type=int, default=6,
+                        help="connect points which have distance less than given[6]")
+    parser.add_argument("-k", type=int, default=4,
+                        help="degree of B-Spline[4]")
+    parser.add_argument("-o", "--omit", type=int, default=6,
+                        help="omit polylines which have length less than given[6]")
+    parser.add_argument("-d", "--maxd", type=int, default=100,
+                        help="maximum of denominator[100]")
+    parser.add_argument("-t", "--tex", action="store_true",
+                        help="generate tex")
+    parser.add_argument("--desmos", action="store_true",
+                        help="make a text file for desmos")
+    parser.add_argument("--showmax", type=int, default=20,
+                        help="maximum of degree to generate tex")
+    parser.add_argument("-m", "--method", type=str, default="greedy",
+                        choices=["greedy", "graph"],
+                        help="method to convert edges to polylines[greedy]")
+    parser.add_argument("--threshold", type=int, nargs=2, default=None,
+                        metavar=("MIN", "MAX"),
+                        help="thresholds of Canny[automatic]")
+    parser.add_argument("--auto", type=str, default="median",
+                        choices=["median", "otsu"],
+                        help="how to decide thresholds automatically[median]")
+    parser.add_argument("--blur", type=int, default=0,
+                        help="kernel size of gaussian blur before Canny[0]")
+    parser.add_argument("--scale", type=float, default=None,
+                        help="resize images by given factor before Canny")
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="detect edges and trace them in tiles of given size in pixels "
+                             "(for very large images)")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="directory to cache edges, polylines and coefficients")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="maximum size of the cache in MB[1024]")
+    args = parser.parse_args(argv)
+    return args
+
+
+def get_sequence_args(argv):
+    parser = ArgumentParser(prog="main.py sequence")
+    parser.add_argument("source", type=str,
+                        help="video file, or directory, glob pattern or manifest file of frames")
+    parser.add_argument("--outdir", type=str, default=dir_base,
+                        help="directory to write picf of each frame[directory of main.py]")
+    parser.add_argument("--packed", type=str, default=None,
+                        help="write all frames to one picf file instead of one file per frame")
+    parser.add_argument("--max-frames", type=int, default=None,
+                        help="convert only the first given frames")
+    parser.add_argument("--no-reuse", action="store_true",
+                        help="convert each frame from scratch")
+    parser.add_argument("-n", type=int, default=500,
+                        help="degree of fourier series approximation[500]")
+    parser.add_argument("--tol", type=float, default=None,
+                        help="choose the degree of each curve so that the truncation error "
+                             "is less than given pixels(-n is the maximum)")
+    parser.add_argument("--simplify", type=float, default=None,
+                        help="simplify polylines with given tolerance in pixels before "
+                             "fitting B-Splines")
+    parser.add_argument("-e", type=int, default=6,
+                        help="connect points which have distance less than given[6]")
+    parser.add_argument("-k", type=int, default=4,
+                        help="degree of B-Spline[4]")
+    parser.add_argument("-o", "--omit", type=int, default=6,
+                        help="omit polylines which have length less than given[6]")
+    parser.add_argument("-d", "--maxd", type=int, default=100,
+                        help="maximum of denominator[100]")
+    parser.add_argument("-m", "--method", type=str, default="greedy",
+                        choices=["greedy", "graph"],
+                        help="method to convert edges to polylines[greedy]")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of processes for the B-Spline and fourier stage")
+    parser.add_argument("--threshold", type=int, nargs=2, default=None,
+                        metavar=("MIN", "MAX"),
+                        help="thresholds of Canny[automatic from the first frame]")
+    parser.add_argument("--auto", type=str, default="median",
+                        choices=["median", "otsu"],
+                        help="how to decide thresholds automatically[median]")
+    parser.add_argument("--blur", type=int, default=0,
+                        help="kernel size of gaussian blur before Canny[0]")
+    parser.add_argument("--scale", type=float, default=None,
+                        help="resize frames by given factor before Canny")
+    args = parser.parse_args(argv)
+    return args
+
+
+def sequence(args):
+    """
+    動画または連番の画像をフレームごとに数式に変換し，変換の速さ(fps)を表示する
+    """
+    source = args.source
+    if os.path.isfile(source) and os.path.splitext(source)[1].lower() in VIDEO_EXTS:
+        frames = pic2formula.iter_video_frames(source)
+    else:
+        frames = collect_paths(source)
+        if not frames:
+            print("no images found: {}".format(source))
+            return
+    if args.max_frames is not None:
+        frames = itertools.islice(frames, args.max_frames)
+    name = "sequence" if glob.has_magic(source) else \
+        os.path.splitext(os.path.basename(os.path.normpath(source)))[0]
+    dir_picf = os.path.join(args.outdir, "picf", name)
+    if args.packed is None:
+        os.makedirs(dir_picf, exist_ok=True)
+
+    stats = pic2formula.Stats()
+    picfs = pic2formula.iter_sequence(
+        frames, n=args.n, e=args.e, k=args.k, ml=args.omit, method=args.method,
+        threshold=args.threshold, auto=args.auto, blur=args.blur, scale=args.scale,
+        workers=args.workers, stats=stats, degree_tol=args.tol,
+        simplify_tol=args.simplify, reuse=not args.no_reuse)
+    packed = []
+    n_frames = 0
+    convert_time = 0.0
+    first_time = 0.0  # 最初のフレームはnumbaのコンパイルを含む
+    start = time.perf_counter()
+    while True:
+        t0 = time.perf_counter()
+        reused = stats.counters.get("polylines_reused", 0)
+        res = next(picfs, None)
+        t1 = time.perf_counter()
+        if res is None:
+            break
+        x_picf, y_picf = res
+        convert_time += t1 - t0
+        if n_frames == 0:
+            first_time = t1 - t0
+        if args.packed is not None:
+            packed.append(res)
+        else:
+            pic2formula.save_picf(os.path.join(dir_picf, "{:05d}.picf".format(n_frames)),
+                                  x_picf.fraction(args.maxd), y_picf.fraction(args.maxd))
+        n_frames += 1
+        print("[{}] {} curves, {} polylines reused ({:.3f}s)".format(
+              n_frames, x_picf.num, stats.counters["polylines_reused"] - reused, t1 - t0))
+    if args.packed is not None and packed:
+        os.makedirs(os.path.dirname(os.path.abspath(args.packed)), exist_ok=True)
+        pic2formula.save_picf_frames(args.packed, packed, maxd=args.maxd)
+    elapsed = time.perf_counter() - start
+
+    print(stats)
+    if n_frames:
+        print("{} frames, {:.2f} fps converting, {:.2f} fps including writing".format(
+              n_frames, n_frames / convert_time, n_frames / elapsed))
+    if n_frames > 1:
+        print("{:.2f} fps converting after the first frame".format(
+              (n_frames - 1) / (convert_time - first_time)))
+    print("saved : {}".format(args.packed if args.packed is not None else dir_picf))
+
+
+def batch(args):
+    """
+    複数の画像をプロセスプールで並列に数式に変換する
+    """
+    paths = collect_paths(args.source)
+    if not paths:
+        print("no images found: {}".format(args.source))
+        return
+    opts = {
+        "n": args.n, "e": args.e, "k": args.k, "ml": args.omit,
+        "maxd": args.maxd, "method": args.method, "tol": args.tol,
+        "simplify": args.simplify, "tile_size": args.tile_size,
+        "threshold": args.threshold, "auto": args.auto,
+        "blur": args.blur, "scale": args.scale,
+        "tex": args.tex, "desmos": args.desmos, "showmax": args.showmax,
+        "outdir": args.outdir, "cache": args.cache, "cache_size": args.cache_size,
+    }
+    workers = max(1, min(args.workers or 1, len(paths)))
+    print("converting {} images with {} workers".format(len(paths), workers))
+
+    start = time.perf_counter()
+    done = []  # (投入した順番, 結果)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(convert_one, path, opts, name): (index, path)
+                   for index, (path, name) in enumerate(zip(paths, output_names(paths)))}
+        for future in as_completed(futures):
+            index, path = futures[future]
+            try:
+                res = future.result()
+            except Exception as exc:
+                # ワーカープロセス自体が落ちた場合
+                res = {"path": path, "ok": False, "timings": {},
+                       "error": "{}: {}".format(type(exc).__name__, exc)}
+            done.append((index, res))
+            status = "ok" if res["ok"] else "FAILED"
+            print("[{}/{}] {} {} ({:.2f}s)".format(
+                  len(done), len(paths), status, res["path"],
+                  sum(res["timings"].values())))
+    elapsed = time.perf_counter() - start
+
+    results = [res for _, res in sorted(done, key=lambda item: item[0])]
+    failed = [res for res in results if not res["ok"]]
+    summary = {"n_images": len(paths), "n_failed": len(failed),
+               "workers": workers, "elapsed": elapsed, "results": results}
+    summary_path = args.summary or os.path.join(args.outdir, "summary.json")
+    os.makedirs(os.path.dirname(os.path.abspath(summary_path)), exist_ok=True)
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+
+    print_summary(results)
+    print("{} images, {} failed, {:.2f}s elapsed".format(
+          len(paths), len(failed), elapsed))
+    for res in failed:
+        print("FAILED {}: {}".format(res["path"], res["error"].strip().splitlines()[-1]))
+    print("summary : {}".format(summary_path))
+
+
+def collect_paths(source):
+    """
+    ディレクトリ，globパターン，またはマニフェストファイルから画像のパスを集める
+    """
+    if os.path.isdir(source):
+        paths = [os.path.join(source, fname) for fname in sorted(os.listdir(source))]
+        return [path for path in paths
+                if os.path.splitext(path)[1].lower() in IMAGE_EXTS]
+    if glob.has_magic(source):
+        return sorted(glob.glob(source, recursive=True))
+    # マニフェストファイル(1行に1つのパス，#以降はコメント)
+    dir_manifest = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                paths.append(os.path.join(dir_manifest, line))
+    return paths
+
+
+def output_names(paths):
+    """
+    各画像の書き出しに使う名前(拡張子を除いた，共通のディレクトリからの相対パス)
+
+    再帰的なglobやマニフェストで別のディレクトリにある同じ名前の画像が
+    上書きし合わないようにする．拡張子だけが違う画像には拡張子を付け，
+    それでも同じになる(同じ画像が2回ある)ものには通し番号を付ける
+    """
+    if not paths:
+        return []
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    names = [os.path.splitext(os.path.relpath(os.path.abspath(path), root))[0]
+             for path in paths]
+    counts = collections.Counter(names)
+    names = [name + "_" + os.path.splitext(path)[1].lstrip(".").lower()
+             if counts[name] > 1 else name for name, path in zip(names, paths)]
+    counts = collections.Counter(names)
+    seen = collections.Counter()
+    res = []
+    for name in names:
+        if counts[name] > 1:
+            seen[name] += 1
+            name = "{}_{}".format(name, seen[name])
+        res.append(name)
+    return res
+
+
+def convert_one(path, opts, name=None):
+    """
+    1枚の画像を数式に変換してpicf/tex/desmosを書き出す(ワーカープロセスで実行)
+
+    書き出すファイルの名前はname(output_names)で，Noneなら画像の名前
+    """
+    timings = {}
+    res = {"path": path, "ok": False, "timings": timings, "error": None}
+    if name is None:
+        name = os.path.splitext(os.path.basename(path))[0]
+    fname = os.path.basename(name)
+    res["name"] = name
+    outdir = opts["outdir"]
+    try:
+        # 進捗はワーカーでは表示せず，段階ごとの時間とカウンタをsummaryに残す
+        stats = pic2formula.Stats()
+        cache = None
+        if opts["cache"]:
+            cache = pic2formula.StageCache(opts["cache"], max_bytes=opts["cache_size"] * 2 ** 20)
+        t0 = time.perf_counter()
+        x_picf, y_picf = pic2formula.generate(
+            path, n=opts["n"], e=opts["e"], k=opts["k"], ml=opts["ml"],
+            method=opts["method"], headless=True,
+            threshold=opts["threshold"], auto=opts["auto"],
+            blur=opts["blur"], scale=opts["scale"], verbose=False, stats=stats,
+            cache=cache, degree_tol=opts["tol"], simplify_tol=opts["simplify"],
+            tile_size=opts["tile_size"])
+        t1 = time.perf_counter()
+        timings["generate"] = t1 - t0
+        res["stats"] = stats.as_dict()
+        x_picff = x_picf.fraction(opts["maxd"])
+        y_picff = y_picf.fraction(opts["maxd"])
+        t2 = time.perf_counter()
+        timings["fraction"] = t2 - t1
+
+        # nameがサブディレクトリを含むときはその下に書き出す
+        path_picf = os.path.join(outdir, "picf", name + ".picf")
+        os.makedirs(os.path.dirname(path_picf), exist_ok=True)
+        pic2formula.save_picf(path_picf, x_picff, y_picff)
+        if opts["tex"]:
+            dir_name = os.path.join(outdir, "tex", name)
+            os.makedirs(dir_name, exist_ok=True)
+            generate_tex(os.path.join(dir_name, fname + ".tex"),
+                         x_picff, y_picff, showmax=opts["showmax"])
+        if opts["desmos"]:
+            path_desmos = os.path.join(outdir, "desmos", name + ".txt")
+            os.makedirs(os.path.dirname(path_desmos), exist_ok=True)
+            generate_desmos(path_desmos, x_picff, y_picff)
+        timings["write"] = time.perf_counter() - t2
+        res["num"] = x_picff.num
+        res["ok"] = True
+    except Exception:
+        res["error"] = traceback.format_exc()
+    return res
+
+
+def print_summary(results):
+    stages = []
+    for res in results:
+        for stage in res["timings"]:
+            if stage not in stages:
+                stages.append(stage)
+    print("{:<40s}".format("image") + "".join("{:>10s}".format(s) for s in stages))
+    for res in results:
+        name = os.path.basename(res["path"])[:40]
+        row = "{:<40s}".format(name)
+        for stage in stages:
+            if stage in res["timings"]:
+                row += "{:10.2f}".format(res["timings"][stage])
+            else:
+                row += "{:>10s}".format("-")
+        print(row)
+
+
+def generate_tex(fname, x, y, showmax=5, chunk_size=None):
+    """
+    x, yの式をLaTeXの文書にしてファイルfnameに書き出す
+    """
+    with open(fname, "w", encoding="utf-8") as f:
+        write_tex(f, x, y, showmax, chunk_size)
+
+
+def write_tex(f, x, y, showmax=5, chunk_size=None):
+    """
+    x, yの式をLaTeXの文書にしてファイルオブジェクトfに書き込む
+
+    式の文字列は全体を作らずに項ごとにファイルへ書き込む
+    """
     s = \
 r"""
 \documentclass[9pt,a4paper]{{jsarticle}}
@@ -133,17 +533,24 @@ y(t) =
 \end{{document}}
 """
 
-    s = s.format(x.latex(showmax), y.latex(showmax))
-    f.write(s)
-    f.close()
+    # {}の部分にx, yの式を順に書き込む
+    picfs = iter((x, y))
+    for literal, field, _, _ in string.Formatter().parse(s):
+        f.write(literal)
+        if field is not None:
+            next(picfs).write_latex(f, showmax, chunk_size)
 
 
-def generate_desmos(fname, x, y):
+def generate_desmos(fname, x, y, chunk_size=None):
     with open(fname, "w", encoding="utf-8") as f:
-        f.write(x.str_desmos(fun_name="f"))
-        f.write(y.str_desmos(fun_name="g"))
-        for i in range(1,x.num + 1):
-            f.write("(f_{{{0:d}}}(t), g_{{{0:d}}}(t))\n".format(i))
+        write_desmos(f, x, y, chunk_size)
+
+
+def write_desmos(f, x, y, chunk_size=None):
+    x.write_desmos(f, fun_name="f", chunk_size=chunk_size)
+    y.write_desmos(f, fun_name="g", chunk_size=chunk_size)
+    for i in range(1,x.num + 1):
+        f.write("(f_{{{0:d}}}(t), g_{{{0:d}}}(t))\n".format(i))
 
 
 if __name__ == '__main__':
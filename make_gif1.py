@@ -1,10 +1,13 @@
-import pickle
 import os
 from datetime import datetime
 from argparse import ArgumentParser
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
+from matplotlib.collections import LineCollection
+
+import pic2formula
+from pic2formula.partial_sum import PartialSums
 
 # このファイルがあるディレクトリ
 dir_base = os.path.dirname(os.path.abspath(__file__))
@@ -13,8 +16,7 @@ def main():
     args = get_args()
     path = args.path
 
-    with open(path, "rb") as f:
-        x_picf, y_picf = pickle.load(f)
+    x_picf, y_picf = pic2formula.load_picf(path)
 
     ani = generate_animation(x_picf, y_picf)
 
@@ -41,28 +43,35 @@ def generate_animation(x_picf, y_picf):
 
     PI = np.pi
 
+    def segments(n=None):
+        # 全ての曲線の(x, y)を(曲線の数, len(tt), 2)の配列にする
+        return np.stack((x_sums(n), y_sums(n)), axis=-1)
+
     def update_plot(n):
-        ii = 0
-        for x_fs, y_fs in zip(x_fs_lst, y_fs_lst):
-            lines[ii].set_data(x_fs(tt, n), y_fs(tt, n))
-            ii += 1
+        # 前のフレームから増えた項だけを足す
+        lines.set_segments(segments(n))
         ax.set_title("n = {}".format(n))
         print("n = {}\r".format(n), end="")
+        return lines,
 
     def init():
-        for x_fs, y_fs in zip(x_fs_lst, y_fs_lst):
-            line, = ax.plot(x_fs(tt), y_fs(tt), color="tab:blue")
-            lines.append(line)
+        # 表示範囲は最大の次数の曲線に合わせる
+        lines.set_segments(segments())
+        ax.autoscale_view()
         ax.set_title("n = {}".format(1))
         ax.axis("equal")
         ax.grid(True, linestyle="--")
+        # 表示範囲は変わらないので，レイアウトは毎フレームではなく最初に一度だけ決める
+        fig.tight_layout()
+        return lines,
 
     fig, ax = plt.subplots()
-    fig.set_tight_layout(True)
-    x_fs_lst = x_picf.fs_lst
-    y_fs_lst = y_picf.fs_lst
     tt = np.linspace(0, 2, 5000) * PI
-    lines = []
+    x_sums = PartialSums(x_picf, tt)
+    y_sums = PartialSums(y_picf, tt)
+    # init()はFuncAnimationから何度か呼ばれるので，曲線の追加はここで一度だけ行う
+    lines = LineCollection([], color="tab:blue")
+    ax.add_collection(lines)
 
     n_lst = list(range(1, 100)) + list(range(100, 501, 5))
     ani = animation.FuncAnimation(fig, update_plot, n_lst, interval=150,
@@ -1,2 +1,6 @@
-from .generate import generate
+from .generate import generate, iter_curves
 from .pic_formula import plot_pf
+from .picf import save_picf, load_picf, convert_picf, save_picf_frames, load_picf_frames
+from .sequence import iter_sequence, iter_video_frames
+from .stats import Stats
+from .cache import StageCache
@@ -1,31 +1,144 @@
 import math
 import numpy as np
-import numba as nb
 
 from .fourier_series import FourierSeries
 
 
 DEFAULT_NS = 2 ** 14
-@nb.jit
-def bspline2fourier_series(bs, n, ns=DEFAULT_NS):
+# 一度にFFTするサンプルの数の上限(DEFAULT_MAX_BATCH * DEFAULT_NS * 2 個分)
+DEFAULT_MAX_BATCH = 128
+# 折り返し(エイリアシング)による振幅の誤差の許容値(px)
+DEFAULT_TOL = 1e-3
+
+
+def bspline2fourier_series(bs, n, ns=None, tol=DEFAULT_TOL, degree_tol=None):
+    x_fs_lst, y_fs_lst = bsplines2fourier_series([bs], n, ns=ns, tol=tol,
+                                                 degree_tol=degree_tol)
+    return [x_fs_lst[0], y_fs_lst[0]]
+
+
+def bsplines2fourier_series(bsplines, n, ns=None, tol=DEFAULT_TOL,
+                            max_batch=DEFAULT_MAX_BATCH, stats=None, degree_tol=None):
+    """
+    閉じたBスプラインをまとめてフーリエ級数に変換する
+
+    Bスプラインを[-pi,pi)のns点でサンプリングし，実数FFT(rfft)でn+1個の
+    係数だけを求める．nsを指定しなければBスプラインごとにsample_countで決める．
+    nsが同じBスプラインは(curves, ns, 2)の配列にまとめて1回のFFTで変換する．
+    statsを指定するとサンプル数の合計をカウンタfft_samplesに加える．
+    degree_tolを指定すると，各曲線の次数をn以下でtruncation_degreesが返す
+    次数にする(曲線ごとに次数が異なる)
+
+    Returns
+    -------
+    x_fs_lst, y_fs_lst : list of FourierSeries
+    """
+    num = len(bsplines)
+    if ns is None:
+        ns_lst = np.array([sample_count(bs, n, tol) for bs in bsplines], dtype=np.int64)
+    else:
+        ns_lst = np.full(num, ns, dtype=np.int64)
+    x_fs_lst = [None] * num
+    y_fs_lst = [None] * num
+    for ns_k in np.unique(ns_lst):
+        ns_k = int(ns_k)
+        idx = np.flatnonzero(ns_lst == ns_k)
+        if stats is not None:
+            stats.count("fft_samples", ns_k * len(idx))
+        batch_size = max(1, max_batch * DEFAULT_NS // ns_k)
+        for start in range(0, len(idx), batch_size):
+            batch = idx[start:start+batch_size]
+            x_fs_batch, y_fs_batch = _fourier_series_batch(
+                [bsplines[ii] for ii in batch], n, ns_k, degree_tol)
+            for ii, x_fs, y_fs in zip(batch, x_fs_batch, y_fs_batch):
+                x_fs_lst[ii] = x_fs
+                y_fs_lst[ii] = y_fs
+    return x_fs_lst, y_fs_lst
+
+
+def _fourier_series_batch(bsplines, n, ns, degree_tol=None):
     PI = math.pi
-    bs_m = modify_domain(bs)  # 定義域を[0,1]から[-pi,pi]に変換
-    tt = np.linspace(-PI, PI, ns)
-    bs_m_arr = bs_m(tt)
-    sp = np.fft.fft(bs_m_arr, axis=0)
-
-    c = sp / ns
-    r = np.absolute(c) * 2
-    p = np.angle(c)
-
-    x_r = r[:, 0]
-    y_r = r[:, 1]
-    x_p = p[:, 0]
-    y_p = p[:, 1]
-
-    x_fs = FourierSeries(x_r, x_p, n=n)
-    y_fs = FourierSeries(y_r, y_p, n=n)
-    return [x_fs, y_fs]
+    tt = np.linspace(-PI, PI, ns, endpoint=False)
+    m = ns // 2 + 1 if n is None else min(n + 1, ns // 2 + 1)  # 残す係数の数
+    samples = np.empty((len(bsplines), ns, 2), dtype=np.float64)
+    for ii, bs in enumerate(bsplines):
+        bs_m = modify_domain(bs)  # 定義域を[0,1]から[-pi,pi]に変換
+        samples[ii] = bs_m(tt)
+    sp = np.fft.rfft(samples, axis=1)
+
+    c = sp[:, :m, :] / ns
+    # (curves, 2, m)にしておくと各曲線の係数が連続したメモリになる
+    r = np.ascontiguousarray((np.absolute(c) * 2).transpose(0, 2, 1))
+    p = np.ascontiguousarray(np.angle(c).transpose(0, 2, 1))
+    if degree_tol is None:
+        degrees = [n] * len(bsplines)
+    else:
+        degrees = truncation_degrees(r[:, 0], r[:, 1], degree_tol)
+    x_fs_lst = []
+    y_fs_lst = []
+    for ii in range(len(bsplines)):
+        x_fs_lst.append(FourierSeries(r[ii, 0], p[ii, 0], n=degrees[ii]))
+        y_fs_lst.append(FourierSeries(r[ii, 1], p[ii, 1], n=degrees[ii]))
+    return x_fs_lst, y_fs_lst
+
+
+def truncation_degrees(r_x, r_y, tol):
+    """
+    各曲線について，打ち切りによる誤差がtol(px)以下になる最小の次数を返す
+
+    m次で打ち切ったときの点のずれは，全てのtで
+        sqrt((sum_{j>m} r_x[j]) ** 2 + (sum_{j>m} r_y[j]) ** 2)
+    以下なので，これがtol以下になる最小のm(1以上)を選ぶ
+
+    Parameters
+    ----------
+    r_x, r_y : ndarray, shape (curves, n+1)
+        x, yの振幅
+
+    Returns
+    -------
+    degrees : ndarray of int
+    """
+    # tail[:, m] = sum_{j>m} r[:, j]
+    tail_x = np.cumsum(r_x[:, :0:-1], axis=1)[:, ::-1]
+    tail_y = np.cumsum(r_y[:, :0:-1], axis=1)[:, ::-1]
+    err = np.hypot(tail_x, tail_y)  # err[:, m-1]がm-1次で打ち切ったときの誤差
+    ok = err <= tol
+    # m-1次で打ち切れる最小のm-1．最後(n次)まで足せば誤差は0
+    degrees = np.where(ok.any(axis=1), ok.argmax(axis=1), r_x.shape[1] - 1)
+    return np.maximum(degrees, 1)
+
+
+def sample_count(bs, n, tol=DEFAULT_TOL, ns_max=DEFAULT_NS):
+    """
+    n次までの係数を求めるのに必要なサンプル数(2の冪)を返す
+
+    closed_bsplineが返すBスプラインは，N = len(bs.c) - bs.k 個の制御点を持つ
+    一様な周期Bスプラインなので，そのフーリエ係数は
+        |c_m| <= R * (N / (pi * m)) ** (k + 1)
+    を満たす(Rは制御点の重心からの距離の最大値)．ns点でサンプリングすると
+    c_mはc_{m + j*ns}(j != 0)と折り返して混ざるので，n次以下の振幅の誤差は
+        4 * R * (N / (pi * (ns - n))) ** (k + 1) * (1 + (ns - n) / k)
+    以下になる(aliasing_bound)．これがtol以下になる最小のnsを返す．
+    ただしnsは2 * (n + 1)以上とし，ns_maxを超えるときはns_maxとする
+    """
+    k = bs.k
+    N = len(bs.c) - k
+    c = bs.c[:N]
+    R = float(np.sqrt(((c - c.mean(axis=0)) ** 2).sum(axis=1)).max())
+    n_min = 2 * (n + 1) if n else 2
+    ns = 1 << (n_min - 1).bit_length()
+    while ns < ns_max and aliasing_bound(ns, n or 0, N, k, R) > tol:
+        ns *= 2
+    return ns
+
+
+def aliasing_bound(ns, n, N, k, R):
+    """
+    sample_countで使う振幅の誤差の上界
+    """
+    m = ns - n
+    return 4 * R * (N / (math.pi * m)) ** (k + 1) * (1 + m / k)
 
 
 def modify_domain(bs):
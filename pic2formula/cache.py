@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+from .fourier_series import FourierSeries
+from .polyline import Polyline
+
+
+# キャッシュの形式や各段階の計算方法を変えたら上げる
+CACHE_VERSION = 1
+# キャッシュの大きさの上限(byte)
+DEFAULT_MAX_BYTES = 2 ** 30
+# これより古い書き込み途中の一時ファイルは消す(s)
+STALE_TMP_SECONDS = 3600
+
+
+class StageCache:
+    """
+    generateの途中結果(エッジ，折れ線，フーリエ係数)をディスクに保存するキャッシュ
+
+    キーは画像の内容のハッシュと各段階のパラメータから作り，前の段階のキーを
+    次の段階のキーに含める．各エントリは1つのnpzファイルで，一時ファイルに
+    書いてからos.replaceで置き換えるので，複数のプロセスから同時に使っても
+    読み込むときに書き込み途中のファイルが見えることは無い．
+    読み込んだエントリは更新時刻を新しくし，合計の大きさがmax_bytesを超えたら
+    更新時刻の古いものから消す(LRU)
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, stage, **params):
+        """
+        段階stageとパラメータparams(JSONにできる値)からキーを作る
+        """
+        data = json.dumps({"version": CACHE_VERSION, "stage": stage, "params": params},
+                          sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _path(self, stage, key):
+        return os.path.join(self.directory, "{}-{}.npz".format(stage, key))
+
+    def load(self, stage, key):
+        """
+        保存された配列の辞書を返す(無ければNone)
+        """
+        path = self._path(stage, key)
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # 壊れたファイルは消して無かったことにする
+            _remove(path)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return arrays
+
+    def store(self, stage, key, **arrays):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=stage + "-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            # mkstempは所有者しか読めないファイルを作るので他のユーザーにも読めるようにする
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self._path(stage, key))
+        except OSError:
+            # 他のプロセスが同じエントリを使っているときなど．保存しなくても困らない
+            _remove(tmp)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        合計の大きさがmax_bytes以下になるまで更新時刻の古いエントリから消す
+        """
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith(".tmp"):
+                if now - st.st_mtime > STALE_TMP_SECONDS:
+                    _remove(entry.path)
+                continue
+            if entry.name.endswith(".npz"):
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith((".npz", ".tmp")):
+                _remove(entry.path)
+
+
+def open_cache(cache):
+    """
+    StageCache，キャッシュのディレクトリ，またはNoneからStageCache(またはNone)を返す
+    """
+    if cache is None or isinstance(cache, StageCache):
+        return cache
+    return StageCache(cache)
+
+
+def hash_image(src):
+    """
+    画像ファイルの内容または画像の配列のハッシュ
+    """
+    h = hashlib.sha256()
+    if isinstance(src, np.ndarray):
+        h.update(json.dumps([src.shape, src.dtype.str]).encode("utf-8"))
+        h.update(np.ascontiguousarray(src).tobytes())
+    else:
+        with open(src, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def pack_polylines(polylines):
+    offsets = np.zeros(len(polylines) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(polyline) for polyline in polylines])
+    points = np.empty((offsets[-1], 2), dtype=np.float64)
+    for polyline, a, b in zip(polylines, offsets[:-1], offsets[1:]):
+        if b > a:
+            points[a:b] = polyline.points
+    return {"points": points, "offsets": offsets}
+
+
+def unpack_polylines(arrays):
+    points = arrays["points"]
+    offsets = arrays["offsets"]
+    return [Polyline(points[a:b]) for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def pack_fs_lst(x_fs_lst, y_fs_lst):
+    offsets = np.zeros(len(x_fs_lst) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([fs.n + 1 for fs in x_fs_lst])
+    arrays = {"offsets": offsets}
+    for axis, fs_lst in (("x", x_fs_lst), ("y", y_fs_lst)):
+        for name in ("r", "p"):
+            arrays["{}_{}".format(axis, name)] = np.concatenate(
+                [np.asarray(getattr(fs, name), dtype=np.float64) for fs in fs_lst]
+                or [np.zeros(0)])
+    return arrays
+
+
+def unpack_fs_lst(arrays):
+    offsets = arrays["offsets"]
+    res = []
+    for axis in ("x", "y"):
+        r = arrays[axis + "_r"]
+        p = arrays[axis + "_p"]
+        res.append([FourierSeries(r[a:b], p[a:b]) for a, b in zip(offsets[:-1], offsets[1:])])
+    return res
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
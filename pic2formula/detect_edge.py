@@ -1,14 +1,27 @@
+import collections
+import math
+
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.widgets import Slider, Button
 
 
+# しきい値の調節中に覚えておくCanny法の結果の数
+PREVIEW_CACHE_SIZE = 32
+# スライダーを動かしている間にプレビューを描き直す間隔(ms)
+PREVIEW_INTERVAL = 50
+
 
 def detect_edge(path):
     """
     Canny法で画像のエッジ検出を行い結果を返す
+
+    しきい値はスライダーで調節する．GUIを使わない場合はdetect_edge_headlessを使う．
+    調節中はウィンドウの大きさに縮小した画像で結果を表示し(CannyPreview)，
+    元の大きさの画像でのエッジ検出はOKを押した後に1回だけ行う．
+    スライダーのイベントはPREVIEW_INTERVALごとにまとめて最後の値だけを描く
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import Slider, Button
 
     MIN_INIT = 100
     MAX_INIT = 200
@@ -28,22 +41,58 @@ def detect_edge(path):
     fig = plt.figure(2)
     # 初期値で一旦描画
     threshold = [MIN_INIT, MAX_INIT]  # しきい値[min, max]
-    edges = cv2.Canny(img, MIN_INIT, MAX_INIT, L2gradient=True)
-    ai = plt.imshow(edges, cmap="gray")
+    preview = CannyPreview(img)
+    h, w = img.shape[:2]
+    # 縮小した画像も元の画像の座標で表示する
+    ai = plt.imshow(np.zeros((1, 1), dtype=np.uint8), cmap="gray", vmin=0, vmax=255,
+                    extent=(-0.5, w - 0.5, h - 0.5, -0.5))
+    ax = ai.axes
     #plt.xticks([]), plt.yticks([])
+    # エッジの画素数(折れ線への変換にかかる時間の目安)
+    count_text = fig.text(0.02, 0.06, "")
+
+    def fit():
+        bbox = ax.get_window_extent()
+        preview.fit(bbox.width, bbox.height)
+
+    def redraw():
+        pending[0] = False
+        edges, count = preview.edges(threshold)
+        ai.set_data(edges)
+        count_text.set_text("edge pixels: {:,} (about {:,} in the original image)".format(
+                            count, preview.estimate_count(count)))
+        fig.canvas.draw_idle()
+
+    # 描き直しを待っている間のイベントはしきい値を覚えるだけにする
+    pending = [False]
+    timer = fig.canvas.new_timer(interval=PREVIEW_INTERVAL)
+    timer.single_shot = True
+    timer.add_callback(redraw)
+
+    def schedule():
+        if not pending[0]:
+            pending[0] = True
+            timer.start()
+
+    def on_resize(event):
+        fit()
+        schedule()
+    fig.canvas.mpl_connect("resize_event", on_resize)
+    fit()
+    redraw()
 
     # minValスライダーの設定
     axmin = plt.axes([0.2, 0.90, 0.6, 0.03])
     smin = Slider(axmin, "minVal", 0, 1000,
                   valinit=MIN_INIT, valstep=1, valfmt="%d")
-    update_min = lambda value: _update_base(value, 0, threshold, img, ai, fig)
+    update_min = lambda value: _update_base(value, 0, threshold, schedule)
     smin.on_changed(update_min)  # スライダーが操作されるとupdate_minが実行される
 
     # maxValスライダーの設定
     axmax = plt.axes([0.2, 0.95, 0.6, 0.03])
     smax = Slider(axmax, "maxVal", 0, 1000,
                   valinit=MAX_INIT, valstep=1, valfmt="%d")
-    update_max = lambda value: _update_base(value, 1, threshold, img, ai, fig)
+    update_max = lambda value: _update_base(value, 1, threshold, schedule)
     smax.on_changed(update_max)  # スライダーが操作されるとupdate_manが実行される
 
     # OKボタンの設定
@@ -60,8 +109,168 @@ def detect_edge(path):
     return edges
 
 
-def _update_base(value, index, threshold, img, ai, fig):
-    threshold[index] = value
+def _update_base(value, index, threshold, schedule):
+    threshold[index] = int(value)
+    schedule()
+
+
+class CannyPreview:
+    """
+    しきい値を調節するときのプレビュー用に，縮小した画像でCanny法の結果を返す
+
+    画像はcv2.pyrDownで半分ずつ縮小したピラミッドで持ち，表示する大きさ以上で
+    最も小さい段を使う．結果は(段, min, max)ごとに最近使ったものから
+    cache_size個まで覚えておく．縮小した画像のエッジは元の画像のエッジと
+    完全には一致しない
+    """
+
+    def __init__(self, img, cache_size=PREVIEW_CACHE_SIZE, min_size=64):
+        """
+        Parameters
+        ----------
+        img : ndarray
+            元の画像(BGRまたはグレースケール)
+        cache_size : int
+            覚えておく結果の数
+        min_size : int
+            ピラミッドの最も小さい段の短辺の長さの下限(px)
+        """
+        self.pyramid = [img]
+        while min(self.pyramid[-1].shape[:2]) >= 2 * min_size:
+            self.pyramid.append(cv2.pyrDown(self.pyramid[-1]))
+        self.level = 0
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+    def fit(self, width, height):
+        """
+        縦横比を保って幅width, 高さheight(px)に表示するときに使う段を選ぶ
+        """
+        h, w = self.pyramid[0].shape[:2]
+        ratio = min(width / w, height / h)
+        level = 0
+        if ratio > 0:
+            level = int(math.floor(-math.log2(ratio))) if ratio < 1 else 0
+        self.level = min(level, len(self.pyramid) - 1)
+        return self.level
+
+    def edges(self, threshold):
+        """
+        今の段の画像のエッジ検出結果とエッジの画素数
+
+        Returns
+        -------
+        edges : ndarray
+        count : int
+        """
+        key = (self.level, int(threshold[0]), int(threshold[1]))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        edges = cv2.Canny(self.pyramid[self.level], key[1], key[2], L2gradient=True)
+        res = (edges, int(np.count_nonzero(edges)))
+        self._cache[key] = res
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return res
+
+    def estimate_count(self, count):
+        """
+        今の段のエッジの画素数から元の画像のエッジの画素数を見積もる
+
+        エッジは線なので画素数は縮小率にほぼ比例する
+        """
+        return int(round(count * self.pyramid[0].shape[1] / self.pyramid[self.level].shape[1]))
+
+
+def detect_edge_headless(src, threshold=None, auto="median", sigma=0.33,
+                         blur=0, scale=None):
+    """
+    ウィンドウを表示せずにCanny法で画像のエッジ検出を行い結果を返す
+
+    Parameters
+    ----------
+    src : str or ndarray
+        画像へのパスまたは画像(BGRまたはグレースケール)
+    threshold : (int, int)
+        しきい値[min, max]．Noneならautoの方法で画像から決める
+    auto : str
+        しきい値を自動で決める方法("median" or "otsu")
+    sigma : float
+        autoが"median"のときの中央値からの幅
+    blur : int
+        エッジ検出前にかけるガウシアンフィルタのカーネルサイズ(0ならかけない)
+    scale : float
+        エッジ検出前に画像を拡大縮小する倍率(Noneならそのまま)
+
+    Returns
+    -------
+    edges : ndarray
+    """
+    img = prepare_image(src, blur=blur, scale=scale)
+    if threshold is None:
+        threshold = auto_threshold(img, method=auto, sigma=sigma)
     edges = cv2.Canny(img, threshold[0], threshold[1], L2gradient=True)
-    ai.set_data(edges)
-    fig.canvas.draw_idle()
+    return edges
+
+
+def prepare_image(src, blur=0, scale=None):
+    """
+    Canny法にかける前の画像(拡大縮小とぼかしをかけたもの)を返す
+
+    色はそのまま残す(BGRの画像ならCanny法は各チャンネルの勾配の最大を使う)．
+    detect_edge_headlessと同じ結果にするときはこの画像をCanny法にかける
+
+    Parameters
+    ----------
+    src : str or ndarray
+        画像へのパスまたは画像(BGRまたはグレースケール)
+    blur, scale
+        detect_edge_headlessと同じ
+
+    Returns
+    -------
+    img : ndarray
+    """
+    img = load_image(src)
+    if scale and scale != 1:
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        img = cv2.resize(img, None, fx=scale, fy=scale,
+                         interpolation=interpolation)
+    if blur:
+        ksize = blur if blur % 2 == 1 else blur + 1  # カーネルサイズは奇数
+        img = cv2.GaussianBlur(img, (ksize, ksize), 0)
+    return img
+
+
+def load_image(src):
+    """
+    画像へのパスまたは画像から画像を返す
+    """
+    if isinstance(src, np.ndarray):
+        return src
+    img = cv2.imread(src)
+    if img is None:
+        raise FileNotFoundError("could not read an image: {}".format(src))
+    return img
+
+
+def auto_threshold(img, method="median", sigma=0.33):
+    """
+    Canny法のしきい値[min, max]を画像の輝度から決める
+
+    "median" : 輝度の中央値vに対して[(1-sigma)v, (1+sigma)v]
+    "otsu" : 大津の二値化のしきい値vに対して[v/2, v]
+    """
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if method == "median":
+        v = float(np.median(gray))
+        lower = int(max(0, (1 - sigma) * v))
+        upper = int(min(255, (1 + sigma) * v))
+    elif method == "otsu":
+        v, _ = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        lower = int(v / 2)
+        upper = int(v)
+    else:
+        raise ValueError('method must be "median" or "otsu".')
+    return [lower, upper]
@@ -0,0 +1,191 @@
+import math
+import numpy as np
+import numba as nb
+
+from .polyline import Polyline
+
+
+def edges2polylines_graph(edges, neighborhood_size=6, max_cost=None, stats=None):
+    """
+    エッジ画素の8近傍グラフを一度だけ構築し，端点・分岐点から順に経路を辿って
+    折れ線に変換する(画素数に対して線形時間)
+
+    edges2polylinesと同じ目的関数で次の点を選ぶが，開始点はランダムではなく
+    端点 -> 分岐点 -> その他の順に選ぶ．8近傍に未訪問の点が無いときだけ
+    半径neighborhood_size以内の点へ飛び移る．
+
+    Parameters
+    ----------
+    edges : ndarray
+        エッジ検出結果(255がエッジ)．edges2polylinesと異なり変更しない
+    neighborhood_size : int or float
+        同一の折れ線とみなす点間の最大距離(px)
+    max_cost : float
+        目的関数の閾値
+    stats : Stats
+        進捗を通知するStats(終わったときだけ通知する)
+
+    Returns
+    -------
+    line_bag : list of Polyline
+    """
+    max_cost = max_cost or neighborhood_size ** 2
+    mask = edges == 255
+    ys, xs = np.nonzero(mask)
+    n_points = len(ys)
+    if n_points == 0:
+        return []
+
+    # 各エッジ画素に通し番号を振った画像(エッジでない画素は-1)
+    label = np.full(edges.shape, -1, dtype=np.int32)
+    label[ys, xs] = np.arange(n_points, dtype=np.int32)
+
+    # 8近傍の次数から端点(1)・分岐点(3以上)を求め，辿り始める順番を決める
+    degree = neighbor_degree(mask)[ys, xs]
+    order = np.concatenate((np.flatnonzero(degree == 1),
+                            np.flatnonzero(degree >= 3),
+                            np.flatnonzero(degree == 2),
+                            np.flatnonzero(degree == 0)))
+
+    offsets, n8 = _graph_stencil(neighborhood_size)
+    path, bounds = _walk(label, ys.astype(np.int64), xs.astype(np.int64),
+                         order.astype(np.int64), offsets, n8, float(max_cost))
+
+    # imshowの座標系からplotの座標系へ変換
+    points = np.empty((n_points, 2), dtype=np.float64)
+    points[:, 0] = xs
+    points[:, 1] = -ys
+    line_bag = []
+    for ii in range(len(bounds) - 1):
+        line_bag.append(Polyline(points[path[bounds[ii]:bounds[ii+1]]]))
+    if stats is not None:
+        stats.report("edges2polylines", n_points, n_points)
+    return line_bag
+
+
+def neighbor_degree(mask):
+    """
+    各画素について8近傍にあるエッジ画素の数を求める
+    """
+    h, w = mask.shape
+    padded = np.zeros((h + 2, w + 2), dtype=np.uint8)
+    padded[1:-1, 1:-1] = mask
+    degree = np.zeros((h, w), dtype=np.uint8)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy == 0 and dx == 0:
+                continue
+            degree += padded[1+dy:h+1+dy, 1+dx:w+1+dx]
+    return degree
+
+
+def _graph_stencil(r):
+    """
+    半径r以内の格子点への相対座標(imshowの座標系)を距離の近い順に並べて返す
+
+    Returns
+    -------
+    offsets : ndarray of int64, shape (m, 2)
+    n8 : int
+        offsetsの先頭から何個が8近傍か
+    """
+    ri = max(int(math.floor(r)), 1)
+    dy, dx = np.mgrid[-ri:ri+1, -ri:ri+1]
+    dy = dy.ravel()
+    dx = dx.ravel()
+    d2 = dy ** 2 + dx ** 2
+    inside = (d2 > 0) & ((d2 <= r ** 2) | (np.maximum(abs(dy), abs(dx)) == 1))
+    dy, dx, d2 = dy[inside], dx[inside], d2[inside]
+    idx = np.lexsort((dx, dy, d2))
+    offsets = np.stack((dy[idx], dx[idx]), axis=1).astype(np.int64)
+    n8 = int(np.count_nonzero(d2 <= 2))
+    return offsets, n8
+
+
+@nb.jit(nopython=True, cache=True)
+def _walk(label, ys, xs, order, offsets, n8, max_cost):
+    """
+    orderの順に未訪問の点から折れ線を辿る
+
+    Returns
+    -------
+    path : ndarray
+        折れ線ごとに並べた点の番号
+    bounds : ndarray
+        path[bounds[i]:bounds[i+1]]がi番目の折れ線
+    """
+    h, w = label.shape
+    n_points = ys.shape[0]
+    m = offsets.shape[0]
+    visited = np.zeros(n_points, dtype=np.bool_)
+    path = np.empty(n_points, dtype=np.int64)
+    bounds = np.empty(n_points + 1, dtype=np.int64)
+    pos = 0
+    n_lines = 0
+    for s in order:
+        if visited[s]:
+            continue
+        start = pos
+        bounds[n_lines] = start
+        n_lines += 1
+        path[pos] = s
+        pos += 1
+        visited[s] = True
+        could_reverse = True
+        while True:
+            last = path[pos-1]
+            y0 = ys[last]
+            x0 = xs[last]
+            use_cost = pos - start > 3
+            dx_ = 0.0
+            dy_ = 0.0
+            if use_cost:
+                # line[-2]とline[-3]の中点からline[-1]へ向かうベクトル(plotの座標系)
+                p2 = path[pos-2]
+                p3 = path[pos-3]
+                dx_ = (x0 - xs[p2]) + 0.47 * (xs[p2] - xs[p3])
+                dy_ = -(y0 - ys[p2]) - 0.47 * (ys[p2] - ys[p3])
+                norm = math.sqrt(dx_ * dx_ + dy_ * dy_)
+                if norm > 0:
+                    dx_ /= norm
+                    dy_ /= norm
+            best = -1
+            best_cost = np.inf
+            # まず8近傍を調べ，無ければ半径neighborhood_size以内を調べる
+            lo = 0
+            hi = n8
+            while best < 0 and lo < m:
+                for j in range(lo, hi):
+                    y = y0 + offsets[j, 0]
+                    x = x0 + offsets[j, 1]
+                    if y < 0 or x < 0 or y >= h or x >= w:
+                        continue
+                    q = label[y, x]
+                    if q < 0 or visited[q]:
+                        continue
+                    if not use_cost:
+                        # 近い順に並んでいるので最初に見つかった点が最も近い
+                        best = q
+                        break
+                    rx = offsets[j, 1]
+                    ry = -offsets[j, 0]
+                    cost = rx * rx + ry * ry - 0.99 * (rx * dx_ + ry * dy_)
+                    if cost < best_cost:
+                        best_cost = cost
+                        best = q
+                lo = hi
+                hi = m
+            if best >= 0 and use_cost and best_cost > max_cost:
+                best = -1
+            if best < 0:
+                if could_reverse:
+                    # 反転して反対側の端から辿る
+                    path[start:pos] = path[start:pos][::-1].copy()
+                    could_reverse = False
+                    continue
+                break
+            path[pos] = best
+            pos += 1
+            visited[best] = True
+    bounds[n_lines] = pos
+    return path, bounds[:n_lines+1]
@@ -4,9 +4,78 @@ import numpy as np
 import numba as nb
 
 from .polyline import Polyline
+from .stats import Stats, print_progress as print_stage_progress
 
 
-def edges2polylines(edges, neighborhood_size=6, max_cost=None):
+def edges2polylines(edges, neighborhood_size=6, max_cost=None, stats=None):
+    """
+    エッジ検出結果を折れ線に変換する(iter_edges2polylinesの結果のリスト)
+
+    Returns
+    -------
+    line_bag : list of Polyline
+    """
+    return list(iter_edges2polylines(edges, neighborhood_size, max_cost, stats))
+
+
+def iter_edges2polylines(edges, neighborhood_size=6, max_cost=None, stats=None):
+    """
+    エッジ検出結果を折れ線に変換し，折れ線を1本辿るごとにyieldする
+
+    折れ線を1本辿る処理は_trace_lineでまとめてコンパイルされている．
+    開始点の選び方はedges2polylines_pyと同じなので，乱数のシードを固定すれば
+    同じ結果が得られる．edgesの点は使用済みになると0に書き換えられる．
+
+    Parameters
+    ----------
+    edges : ndarray
+        エッジ検出結果(255がエッジ)
+    neighborhood_size : int or float
+        同一の折れ線とみなす点間の最大距離(px)
+    max_cost : float
+        目的関数の閾値
+    stats : Stats
+        カウンタを加え，進捗を通知するStats(Noneなら進捗をコンソールに表示する)
+
+    Yields
+    ------
+    line : Polyline
+    """
+    if stats is None:
+        stats = Stats(progress=print_stage_progress)
+    max_cost = max_cost or neighborhood_size ** 2
+    stencil = neighbor_stencil(neighborhood_size)
+    rows, cols = np.nonzero(edges == 255)
+    init_n_points = len(rows)
+    # 各エッジ画素にnp.whereの順で通し番号を振った画像(エッジでない画素は-1)
+    label = np.full(edges.shape, -1, dtype=np.int32)
+    label[rows, cols] = np.arange(init_n_points, dtype=np.int32)
+    tree = _fenwick_init(init_n_points)
+    buf = np.empty((init_n_points, 2), dtype=np.int64)
+    # 調べた近傍の画素の数，目的関数を計算した回数，反転した回数
+    counters = np.zeros(3, dtype=np.int64)
+    count = 0
+    stats.report("edges2polylines", count, init_n_points)
+    try:
+        while count < init_n_points:
+            init_idx = random.randrange(init_n_points - count)
+            m = _trace_line(edges, label, tree, rows, cols, init_idx,
+                            stencil, float(max_cost), buf, counters)
+            count += m
+            line = Polyline(buf[:m])
+            stats.report("edges2polylines", count, init_n_points)
+            yield line
+    finally:
+        # 途中で止められたときもそれまでのカウンタは加える
+        stats.count("neighbor_lookups", counters[0])
+        stats.count("cost_evaluations", counters[1])
+        stats.count("reversals", counters[2])
+
+
+def edges2polylines_py(edges, neighborhood_size=6, max_cost=None):
+    """
+    edges2polylinesのPythonによる実装(動作確認用)
+    """
     max_cost = max_cost or neighborhood_size ** 2
     pl = make_pointlist(edges)
     init_n_points = len(pl)
@@ -64,6 +133,125 @@ def edges2polylines(edges, neighborhood_size=6, max_cost=None):
     return line_bag
 
 
+def neighbor_stencil(r):
+    """
+    points_inside_circleが返す格子点(plotの座標系の相対座標)を
+    中心からの距離が近い順に安定ソートして返す
+    """
+    pl = np.array(points_inside_circle(np.zeros(2), r)).astype(np.int64)
+    d2 = pl[:, 0] ** 2 + pl[:, 1] ** 2
+    return pl[np.argsort(d2, kind="stable")]
+
+
+@nb.jit(nopython=True)
+def _fenwick_init(n):
+    """
+    全要素が1の配列に対するFenwick木
+    """
+    tree = np.zeros(n + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        tree[i] = i & (-i)
+    return tree
+
+
+@nb.jit(nopython=True)
+def _fenwick_remove(tree, i):
+    i += 1
+    n = tree.shape[0] - 1
+    while i <= n:
+        tree[i] -= 1
+        i += i & (-i)
+
+
+@nb.jit(nopython=True)
+def _fenwick_find(tree, k):
+    """
+    残っている要素のうちk番目(0始まり)の番号を返す
+    """
+    n = tree.shape[0] - 1
+    step = 1
+    while step * 2 <= n:
+        step *= 2
+    pos = 0
+    rem = k + 1
+    while step > 0:
+        if pos + step <= n and tree[pos + step] < rem:
+            pos += step
+            rem -= tree[pos]
+        step //= 2
+    return pos
+
+
+@nb.jit(nopython=True)
+def _trace_line(edges, label, tree, rows, cols, init_idx, stencil, max_cost, buf,
+                counters):
+    """
+    残っている点のうちinit_idx番目の点から折れ線を1本辿り，
+    bufに点(plotの座標系)を書き込んで点の数を返す
+
+    counters[0], [1], [2]に調べた近傍の画素の数，目的関数を計算した回数，
+    反転した回数を加える
+    """
+    h, w = edges.shape
+    m = stencil.shape[0]
+    i0 = _fenwick_find(tree, init_idx)
+    _fenwick_remove(tree, i0)
+    edges[rows[i0], cols[i0]] = 0
+    buf[0, 0] = cols[i0]
+    buf[0, 1] = -rows[i0]
+    n = 1
+    could_reverse = True
+    while True:
+        x0 = buf[n-1, 0]
+        y0 = buf[n-1, 1]
+        if n > 3:
+            # line[-2]とline[-3]の中点からline[-1]へ向かうベクトル
+            dx = (x0 - buf[n-2, 0]) + 0.47 * (buf[n-2, 0] - buf[n-3, 0])
+            dy = (y0 - buf[n-2, 1]) + 0.47 * (buf[n-2, 1] - buf[n-3, 1])
+            norm = math.sqrt(dx * dx + dy * dy)
+            dx = dx / norm
+            dy = dy / norm
+        best = -1
+        best_cost = np.inf
+        # stencilは近い順に並んでいるので，最初に見つかった最小値が
+        # sortedで並び替えたときの先頭と一致する
+        for j in range(m):
+            row = -(y0 + stencil[j, 1])
+            col = x0 + stencil[j, 0]
+            counters[0] += 1
+            if row < 0 or col < 0 or row >= h or col >= w:
+                continue
+            if edges[row, col] != 255:
+                continue
+            if n <= 3:
+                best = j
+                break
+            counters[1] += 1
+            rx = stencil[j, 0]
+            ry = stencil[j, 1]
+            r_norm = math.sqrt(rx * rx + ry * ry)
+            cost = r_norm ** 2 - 0.99 * (rx * dx + ry * dy)
+            if best < 0 or cost < best_cost:
+                best = j
+                best_cost = cost
+        if best < 0 or (n > 3 and best_cost > max_cost):
+            # 近くに点が無いか，目的関数の最小が閾値を超えたら末端処理
+            if could_reverse:
+                buf[:n] = buf[:n][::-1].copy()
+                could_reverse = False
+                counters[2] += 1
+                continue
+            break
+        x = x0 + stencil[best, 0]
+        y = y0 + stencil[best, 1]
+        buf[n, 0] = x
+        buf[n, 1] = y
+        n += 1
+        edges[-y, x] = 0
+        _fenwick_remove(tree, label[-y, x])
+    return n
+
+
 def cost_function(candidate, line_end, d):
     """
     目的関数
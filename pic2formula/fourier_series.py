@@ -1,5 +1,84 @@
+import math
 import numpy as np
-from fractions import Fraction
+
+from .rational import coefficients2fractions, ratios2fractions, ratios2ndarray
+
+
+# 評価時に作る一時配列の大きさの上限(byte)
+DEFAULT_MAX_BYTES = 2 ** 26
+# 等間隔なtとみなして高速に評価するときに許す誤差
+UNIFORM_TOL = 1e-10
+# 等間隔なtの高速な評価を試すtの長さの下限
+UNIFORM_MIN_LEN = 64
+
+
+def evaluate_series(r, p, t, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    sum_k r_k cos(k t + p_k) を評価する(r[0]は半分にして使う)
+
+    tが等間隔なら，刻み幅が2pi/M(Mは整数)のときは長さMの逆FFTで，
+    そうでなければ e^{ik(t0 + (bB + j)dt)} = e^{ik(t0 + bB dt)} e^{ikj dt} と
+    分解した行列積で評価する．等間隔からのずれによる誤差は
+    (tのずれの最大値) * sum_k k r_k で抑えられるので，これがUNIFORM_TOL以下の
+    ときだけ使う．それ以外はtをmax_bytes以下の一時配列で済む長さに分けて評価する
+
+    Returns
+    -------
+    res : ndarray
+        1次元に並べたtに対する値
+    """
+    t = np.asarray(t, dtype=np.float64).ravel()
+    r = np.array(r, dtype=np.float64)
+    p = np.asarray(p, dtype=np.float64)
+    r[0] /= 2  # 定数項の振幅は半分にしておく
+    if len(t) >= UNIFORM_MIN_LEN:
+        res = _evaluate_uniform(r, p, t)
+        if res is not None:
+            return res
+    return _evaluate_chunked(r, p, t, max_bytes)
+
+
+def _evaluate_chunked(r, p, t, max_bytes):
+    omega_lst = np.arange(len(r))
+    rows = max(1, int(max_bytes // (8 * len(r))))
+    res = np.empty(len(t))
+    for start in range(0, len(t), rows):
+        o_t = np.outer(t[start:start+rows], omega_lst)
+        o_t += p
+        np.cos(o_t, out=o_t)
+        res[start:start+rows] = o_t.dot(r)
+    return res
+
+
+def _evaluate_uniform(r, p, t):
+    T = len(t)
+    t0 = t[0]
+    dt = (t[-1] - t0) / (T - 1)
+    if dt == 0:
+        return None
+    omega_lst = np.arange(len(r))
+    lipschitz = np.dot(omega_lst, np.abs(r))
+    jj = np.arange(T)
+    a = r * np.exp(1j * p)
+
+    # 刻み幅が2pi/Mなら長さMの逆FFT
+    M = int(round(2 * math.pi / dt))
+    if 0 < M <= 4 * T and \
+            np.abs(t - (t0 + jj * (2 * math.pi / M))).max() * lipschitz <= UNIFORM_TOL:
+        b = a * np.exp(1j * omega_lst * t0)
+        q = omega_lst % M
+        b = np.bincount(q, b.real, M) + 1j * np.bincount(q, b.imag, M)
+        f = np.fft.ifft(b) * M
+        return f.real[jj % M]
+
+    if np.abs(t - (t0 + jj * dt)).max() * lipschitz > UNIFORM_TOL:
+        return None
+    B = int(math.ceil(math.sqrt(T)))
+    n_blocks = -(-T // B)
+    V = a * np.exp(1j * np.outer(t0 + np.arange(n_blocks) * (B * dt), omega_lst))
+    W = np.exp(1j * np.outer(np.arange(B) * dt, omega_lst))
+    f = V.dot(W.T)
+    return f.real.ravel()[:T]
 
 
 class FourierSeries:
@@ -24,7 +103,7 @@ class FourierSeries:
         self.p = p
         self.n = len(r) - 1
 
-    def __call__(self, t, n=None):
+    def __call__(self, t, n=None, max_bytes=DEFAULT_MAX_BYTES):
         """
         Parameters
         ----------
@@ -32,49 +111,22 @@ class FourierSeries:
             変数
         n : int
             次数
+        max_bytes : int
+            評価時に作る一時配列の大きさの上限(byte)
         """
-        t = np.array(t)
         if n and n < self.n:
-            r = self.r[:n+1].copy()
-            p = self.p[:n+1].copy()
-            omega_lst = np.arange(n+1)
+            r = self.r[:n+1]
+            p = self.p[:n+1]
         else:
-            r = self.r.copy()
-            p = self.p.copy()
-            omega_lst = np.arange(self.n+1)
-        r[0] /= 2  # 定数項の振幅は半分にしておく
-        o_t = np.outer(t, omega_lst) + p
-        cos_mat = np.cos(o_t)
-        return cos_mat.dot(r)
+            r = self.r
+            p = self.p
+        return evaluate_series(r, p, t, max_bytes)
 
     def __str__(self):
         return self.str(showmax=10)
 
     def str(self, showmax):
-        r = self.r
-        p = self.p
-        omega_lst = np.arange(self.n+1)
-        if showmax and showmax < self.n:
-            r_e = r[:showmax+1]
-            p_e = p[:showmax+1]
-            omega_lst_e = omega_lst[:showmax]
-        else:
-            r_e = r.copy()
-            p_e = p.copy()
-            omega_lst_e = omega_lst.copy()
-        if p_e[0] == 0:
-            s = "{:.3f}".format(r_e[0]/2)
-        else:
-            s = "- {:.3f}".format(r_e[0]/2)
-        for rk, pk, omegak in zip(r_e[1:], p_e[1:], omega_lst_e[1:]):
-            s += " + {:.3f} cos({}t{:+.3f})".format(rk, omegak, pk)
-        if showmax and showmax < self.n:
-            rk = r[-1]
-            pk = p[-1]
-            omegak = omega_lst[-1]
-            s += " ... "
-            s += " + {:.3f} cos({}t{:+.3f})".format(rk, omegak, pk)
-        return s
+        return series_str(self.r, self.p, showmax)
 
     def fraction(self, maxd=100):
         return FourierSeriesFraction(self.r, self.p, self.n, maxd)
@@ -85,9 +137,8 @@ class FourierSeriesFraction(FourierSeries):
     @staticmethod
     def _ndarray2fractions(arr, max_denominator):
         # 最初の項(定数項)の振幅は半分にするので分母の最大値も半分にする
-        tmp = [Fraction(arr[0]).limit_denominator(int(max_denominator/2))]
-        tmp += [Fraction(i).limit_denominator(max_denominator) for i in arr[1:]]
-        return tmp
+        num, den = coefficients2fractions(arr, [0, len(arr)], max_denominator)
+        return ratios2fractions(num, den)
 
     @staticmethod
     def _fractions2ndarray(fracs):
@@ -121,81 +172,202 @@ class FourierSeriesFraction(FourierSeries):
         """
         super().__init__(r, p, n)
         self.maxd = maxd
-        self.r_f = self._ndarray2fractions(self.r, maxd)
-        self.p_f = self._ndarray2fractions(self.p, maxd)
-        self.r = self._fractions2ndarray(self.r_f)
-        self.p = self._fractions2ndarray(self.p_f)
+        offsets = [0, len(self.r)]
+        self._set_ratios(*coefficients2fractions(self.r, offsets, maxd),
+                         *coefficients2fractions(self.p, offsets, maxd))
+
+    def _set_ratios(self, r_num, r_den, p_num, p_den):
+        # Fraction(r_f, p_f)は文字列にするときに__getattr__で作る
+        self._r_num = r_num
+        self._r_den = r_den
+        self._p_num = p_num
+        self._p_den = p_den
+        self.r = ratios2ndarray(r_num, r_den)
+        self.p = ratios2ndarray(p_num, p_den)
+        self.n = len(self.r) - 1
+
+    def __getattr__(self, name):
+        # 以前のpickleやfrom_fractionsで作ったものはr_f, p_fを最初から持っている
+        if name not in ("r_f", "p_f"):
+            raise AttributeError(name)
+        self.r_f = ratios2fractions(self._r_num, self._r_den)
+        self.p_f = ratios2fractions(self._p_num, self._p_den)
+        return self.__dict__[name]
+
+    @classmethod
+    def from_ratios(cls, r_num, r_den, p_num, p_den, maxd=100):
+        """
+        分子・分母の整数配列から作る(分数への変換はしない)
+        """
+        self = cls.__new__(cls)
+        self.maxd = maxd
+        self._set_ratios(r_num, r_den, p_num, p_den)
+        return self
+
+    @classmethod
+    def from_fractions(cls, r_f, p_f, maxd=100):
+        """
+        既に分数になっている振幅r_f，位相p_fから作る(分数への変換はしない)
+        """
+        self = cls.__new__(cls)
+        FourierSeries.__init__(self, cls._fractions2ndarray(r_f),
+                               cls._fractions2ndarray(p_f))
+        self.maxd = maxd
+        self.r_f = list(r_f)
+        self.p_f = list(p_f)
+        return self
 
     def __str__(self):
         return self.str(showmax=10)
 
     def str(self, showmax=None):
-        r_f = self.r_f
-        p_f = self.p_f
-        omega_lst = np.arange(self.n+1)
-        if showmax and showmax < self.n:
-            r_e = r_f[:showmax+1]
-            p_e = p_f[:showmax+1]
-            omega_lst_e = omega_lst[:showmax+1]
-        else:
-            r_e = r_f.copy()
-            p_e = p_f.copy()
-            omega_lst_e = omega_lst.copy()
-        if p_e[0] == 0:
-            s = "{}".format(r_e[0]/2)
-        else:
-            s = "- {}".format(r_e[0]/2)
-        for rk, pk, omegak in zip(r_e[1:], p_e[1:], omega_lst_e[1:]):
-            if pk >= 0:
-                s += " + {} cos({}t + {})".format(rk, omegak, pk)
-            else:
-                s += " + {} cos({}t - {})".format(rk, omegak, -pk)
-        if showmax and showmax < self.n:
-            s += " + ..."
-            if p_f[-1] >= 0:
-                s += " + {} cos({}t + {})".format(r_f[-1], omega_lst[-1], p_f[-1])
-            else:
-                s += " + {} cos({}t + {})".format(r_f[-1], omega_lst[-1], -p_f[-1])
-        return s
+        return fraction_series_str(self.r_f, self.p_f, showmax)
 
     def latex(self, showmax=None):
-        r_f = self.r_f
-        p_f = self.p_f
-        fl = self._frac2latex
-        omega_lst = np.arange(self.n+1)
-        if showmax and showmax < self.n:
-            r_e = r_f[:showmax+1]
-            p_e = p_f[:showmax+1]
-            omega_lst_e = omega_lst[:showmax+1]
+        return fraction_series_latex(self.r_f, self.p_f, showmax)
+
+    def iter_latex(self, showmax=None):
+        return iter_fraction_series_latex(self.r_f, self.p_f, showmax)
+
+    def get_ratios(self):
+        """
+        振幅・位相の分子・分母の配列 (r_num, r_den, p_num, p_den)
+        """
+        if "_r_num" not in self.__dict__:
+            self._r_num, self._r_den = self._fractions2ratios(self.r_f)
+            self._p_num, self._p_den = self._fractions2ratios(self.p_f)
+        return self._r_num, self._r_den, self._p_num, self._p_den
+    ratios = property(get_ratios)
+
+    @staticmethod
+    def _fractions2ratios(fracs):
+        num = np.array([frac.numerator for frac in fracs], dtype=np.int64)
+        den = np.array([frac.denominator for frac in fracs], dtype=np.int64)
+        return num, den
+
+
+def fraction_fs_lst(fs_lst, maxd=100):
+    """
+    FourierSeriesのリストの係数をまとめて分数にし，FourierSeriesFractionのリストを返す
+
+    fs.fraction(maxd)を順に呼ぶのと同じ結果になる
+    """
+    if not fs_lst:
+        return []
+    offsets = np.zeros(len(fs_lst) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([fs.n + 1 for fs in fs_lst])
+    r_num, r_den = coefficients2fractions(
+        np.concatenate([np.asarray(fs.r, dtype=np.float64) for fs in fs_lst]), offsets, maxd)
+    p_num, p_den = coefficients2fractions(
+        np.concatenate([np.asarray(fs.p, dtype=np.float64) for fs in fs_lst]), offsets, maxd)
+    res = []
+    for a, b in zip(offsets[:-1], offsets[1:]):
+        res.append(FourierSeriesFraction.from_ratios(r_num[a:b], r_den[a:b],
+                                                     p_num[a:b], p_den[a:b], maxd))
+    return res
+
+
+def series_str(r, p, showmax):
+    """
+    振幅r，位相pのフーリエ級数を文字列にする
+    """
+    n = len(r) - 1
+    omega_lst = np.arange(n+1)
+    if showmax and showmax < n:
+        r_e = r[:showmax+1]
+        p_e = p[:showmax+1]
+        omega_lst_e = omega_lst[:showmax]
+    else:
+        r_e = r.copy()
+        p_e = p.copy()
+        omega_lst_e = omega_lst.copy()
+    if p_e[0] == 0:
+        s = "{:.3f}".format(r_e[0]/2)
+    else:
+        s = "- {:.3f}".format(r_e[0]/2)
+    for rk, pk, omegak in zip(r_e[1:], p_e[1:], omega_lst_e[1:]):
+        s += " + {:.3f} cos({}t{:+.3f})".format(rk, omegak, pk)
+    if showmax and showmax < n:
+        rk = r[-1]
+        pk = p[-1]
+        omegak = omega_lst[-1]
+        s += " ... "
+        s += " + {:.3f} cos({}t{:+.3f})".format(rk, omegak, pk)
+    return s
+
+
+def fraction_series_str(r_f, p_f, showmax=None):
+    """
+    分数の振幅r_f，位相p_fのフーリエ級数を文字列にする
+    """
+    n = len(r_f) - 1
+    omega_lst = np.arange(n+1)
+    if showmax and showmax < n:
+        r_e = r_f[:showmax+1]
+        p_e = p_f[:showmax+1]
+        omega_lst_e = omega_lst[:showmax+1]
+    else:
+        r_e = r_f.copy()
+        p_e = p_f.copy()
+        omega_lst_e = omega_lst.copy()
+    if p_e[0] == 0:
+        s = "{}".format(r_e[0]/2)
+    else:
+        s = "- {}".format(r_e[0]/2)
+    for rk, pk, omegak in zip(r_e[1:], p_e[1:], omega_lst_e[1:]):
+        if pk >= 0:
+            s += " + {} cos({}t + {})".format(rk, omegak, pk)
         else:
-            r_e = r_f.copy()
-            p_e = p_f.copy()
-            omega_lst_e = omega_lst.copy()
-        if p_e[0] == 0:
-            s = r"{}".format(fl(r_e[0]/2)) + "\n"
+            s += " + {} cos({}t - {})".format(rk, omegak, -pk)
+    if showmax and showmax < n:
+        s += " + ..."
+        if p_f[-1] >= 0:
+            s += " + {} cos({}t + {})".format(r_f[-1], omega_lst[-1], p_f[-1])
         else:
-            s = r"- {}".format(fl(r_e[0]/2)) + "\n"
-        for rk, pk, omegak in zip(r_e[1:], p_e[1:], omega_lst_e[1:]):
-            if rk != 0:
-                if pk == 0:
-                    s += r" + {} \cos \left( {}t \right)".format(fl(rk), fl(omegak)) + "\n"
-                elif pk >= 0:
-                    s += r" + {} \cos \left( {}t + {} \right)".format(fl(rk), fl(omegak), fl(pk, False)) + "\n"
-                else:
-                    s += r" + {} \cos \left( {}t - {} \right)".format(fl(rk), fl(omegak), fl(-pk, False)) + "\n"
-        if showmax and showmax < self.n:
-            r_np = self._fractions2ndarray(r_f)
-            non_zero = np.where(r_np != 0)[0]
-            if non_zero[-1] <= showmax:
-                return s
-            rk = r_f[non_zero[-1]]
-            pk = p_f[non_zero[-1]]
-            omegak = omega_lst[non_zero[-1]]
-            s += r" + \cdots " + "\n"
-            if pk == 0:
-                s += r" + {} \cos \left( {}t \right)".format(fl(rk), fl(omegak))
-            elif pk >= 0:
-                s += r" + {} \cos \left( {}t + {} \right)".format(fl(rk), fl(omegak), fl(pk, False))
-            else:
-                s += r" + {} \cos \left( {}t - {} \right)".format(fl(rk), fl(omegak), fl(-pk, False))
-        return s
+            s += " + {} cos({}t + {})".format(r_f[-1], omega_lst[-1], -p_f[-1])
+    return s
+
+
+def fraction_series_latex(r_f, p_f, showmax=None):
+    """
+    分数の振幅r_f，位相p_fのフーリエ級数をLaTeXの文字列にする
+    """
+    return "".join(iter_fraction_series_latex(r_f, p_f, showmax))
+
+
+def iter_fraction_series_latex(r_f, p_f, showmax=None):
+    """
+    fraction_series_latexの文字列を項ごとに順に返すジェネレータ
+    """
+    n = len(r_f) - 1
+    fl = FourierSeriesFraction._frac2latex
+    omega_lst = np.arange(n+1)
+    if showmax and showmax < n:
+        m = showmax + 1
+    else:
+        m = n + 1
+    if p_f[0] == 0:
+        yield r"{}".format(fl(r_f[0]/2)) + "\n"
+    else:
+        yield r"- {}".format(fl(r_f[0]/2)) + "\n"
+    for k in range(1, m):
+        if r_f[k] != 0:
+            yield _fraction_term_latex(r_f[k], p_f[k], omega_lst[k]) + "\n"
+    if showmax and showmax < n:
+        r_np = FourierSeriesFraction._fractions2ndarray(r_f)
+        non_zero = np.where(r_np != 0)[0]
+        if non_zero[-1] <= showmax:
+            return
+        yield r" + \cdots " + "\n"
+        yield _fraction_term_latex(r_f[non_zero[-1]], p_f[non_zero[-1]],
+                                   omega_lst[non_zero[-1]])
+
+
+def _fraction_term_latex(rk, pk, omegak):
+    fl = FourierSeriesFraction._frac2latex
+    if pk == 0:
+        return r" + {} \cos \left( {}t \right)".format(fl(rk), fl(omegak))
+    elif pk >= 0:
+        return r" + {} \cos \left( {}t + {} \right)".format(fl(rk), fl(omegak), fl(pk, False))
+    else:
+        return r" + {} \cos \left( {}t - {} \right)".format(fl(rk), fl(omegak), fl(-pk, False))
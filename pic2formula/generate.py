@@ -1,73 +1,405 @@
-import matplotlib.pyplot as plt
+import collections
 import numpy as np
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from .detect_edge import detect_edge
-from .edges2polylines import edges2polylines
-from .bspline2fourier_series import bspline2fourier_series
+from .detect_edge import detect_edge, detect_edge_headless
+from .edges2polylines import iter_edges2polylines
+from .edge_graph import edges2polylines_graph
+from .bspline2fourier_series import bsplines2fourier_series
+from .polyline import Polyline, simplify_mask, subdivide_points
 from .pic_formula import PicFormula, plot_pf
+from .stats import Stats, print_progress
+from .cache import (open_cache, hash_image, pack_polylines, unpack_polylines,
+                    pack_fs_lst, unpack_fs_lst)
 
+# 折れ線への変換方法
+TRACERS = {
+    "greedy": iter_edges2polylines,
+    "graph": edges2polylines_graph,
+}
 
-def generate(path, n, e=6, k=4, ml=10):
+
+# 並列化するときの1チャンクあたりの制御点の数の下限
+MIN_CHUNK_POINTS = 2000
+
+# 折れ線を間引いた後の点の間隔の上限(simplify_tolに対する倍率)
+SIMPLIFY_STEP_RATIO = 4
+
+
+def generate(path, n, e=6, k=4, ml=10, method="greedy", headless=False,
+             threshold=None, auto="median", blur=0, scale=None,
+             workers=None, pool="process", verbose=True, progress=None, stats=None,
+             cache=None, degree_tol=None, simplify_tol=None, tile_size=None):
     """
     画像からPicFormulaを生成する
 
     Parameters
     ----------
-    path : str
-        画像へのパス
+    path : str or ndarray
+        画像へのパス(headlessがTrueなら画像でもよい)
     n : int
-        展開次数
+        展開次数(degree_tolを指定したときは次数の上限)
     e : int or float
         同一の折れ線とみなす点間の最大距離(px)
     k : int
         Bスプラインの次数
     ml : int or float
         折れ線の最小長さ(これより短い折れ線はフィルタリングされる)(px)
+    method : str
+        エッジを折れ線に変換する方法("greedy" or "graph")
+    headless : bool
+        Trueならウィンドウや確認を出さずに最後まで処理する
+    threshold, auto, blur, scale
+        headlessがTrueのときにdetect_edge_headlessに渡す
+    workers : int
+        Bスプライン・フーリエ級数への変換を並列に行うワーカーの数
+        (Noneなら並列化しない)
+    pool : str
+        並列化に使うプール("process" or "thread")
+    verbose : bool
+        Falseならコンソールに何も表示しない
+    progress : callable
+        各段階の進捗を受け取る関数progress(stage, done, total)
+        (Noneでverboseなら折れ線への変換の進捗をコンソールに表示する)．
+        フーリエ級数への変換は折れ線を辿りながら行うのでtotalはNone
+    stats : Stats
+        各段階の時間とカウンタを記録するStats．渡したオブジェクトに書き込まれる
+    cache : StageCache or str
+        エッジ・折れ線・フーリエ係数を保存するキャッシュ(またはそのディレクトリ)．
+        画像とその段階までのパラメータが同じなら計算せずに読み込む．
+        headlessでないときはエッジ検出の結果から後の段階だけを使う
+    degree_tol : float
+        指定すると，各曲線の次数を打ち切りによる誤差がdegree_tol(px)以下に
+        なる最小の次数にする(n以下，曲線ごとに次数が異なる)
+    simplify_tol : float
+        指定すると，Bスプラインに変換する前に折れ線の点をRamer-Douglas-Peucker法で
+        元の点との距離がsimplify_tol(px)以下の範囲で間引く．角で曲線が大きく
+        ずれないように，点の間隔はSIMPLIFY_STEP_RATIO * simplify_tol以下にする
+    tile_size : int
+        指定すると，画像をtile_size(px)四方のタイルに分けてエッジ検出と折れ線への
+        変換を行い，境界でつなぐ(iter_trace_tiles)．画像全体のエッジ検出結果を
+        作らないので大きな画像でもメモリが少なくて済む．workersを指定すると
+        タイルも並列に処理する．headlessのときのみ
 
     Returns
     -------
     [x_picf, y_picf] : list of PicFormula
     """
+    if stats is None:
+        stats = Stats()
+    if progress is None and verbose:
+        progress = print_progress
+    if progress is not None:
+        stats.progress = progress
+    if method not in TRACERS:
+        raise ValueError("method must be one of {}.".format(list(TRACERS)))
+    if tile_size is not None:
+        if not headless:
+            raise ValueError("tile_size can be used only in headless mode.")
+        # tilesはgenerateをimportするので使うときにimportする
+        from .tiles import iter_trace_tiles, DEFAULT_OVERLAP
+    cache = open_cache(cache)
+    ml = max(ml, k+1)
+
     # 画像からエッジを検出
-    edges = detect_edge(path)
+    with stats.stage("detect_edge"):
+        if headless:
+            edges_key = None
+            if cache is not None:
+                tiles = {} if tile_size is None else {"tiles": [tile_size, DEFAULT_OVERLAP]}
+                edges_key = cache.key(
+                    "edges", image=hash_image(path), auto=auto, blur=blur, scale=scale,
+                    threshold=None if threshold is None else [int(v) for v in threshold],
+                    **tiles)
+                # フーリエ係数があれば前の段階は読み込まない
+                arrays = cache.load("fourier_series",
+                                    _fs_key(cache, edges_key, method, e, ml, k, n, degree_tol,
+                                            simplify_tol))
+                if arrays is not None:
+                    stats.count("cache_hits")
+                    x_fs_lst, y_fs_lst = unpack_fs_lst(arrays)
+                    return [PicFormula(x_fs_lst), PicFormula(y_fs_lst)]
+            if tile_size is None:
+                edges = _cached(cache, stats, "edges", edges_key,
+                                lambda: detect_edge_headless(path, threshold=threshold,
+                                                             auto=auto, blur=blur, scale=scale),
+                                lambda edges: {"edges": edges}, lambda arrays: arrays["edges"])
+        else:
+            edges = detect_edge(path)
+            edges_key = None if cache is None else cache.key("edges", edges=hash_image(edges))
+        if tile_size is None:
+            stats.count("edge_pixels", np.count_nonzero(edges == 255))
+
+    # エッジを折れ線に変換(キャッシュを使わなければ変換しながら次の段階に渡す)
+    if tile_size is None:
+        trace = lambda: _trace(edges, method, e, stats)
+    else:
+        # エッジ検出もタイルごとに行う
+        trace = lambda: iter_trace_tiles(path, e, method, tile_size, DEFAULT_OVERLAP, workers,
+                                         threshold, auto, blur, scale, stats)
+    if cache is not None:
+        with stats.stage("edges2polylines"):
+            polylines_key = cache.key("polylines", edges=edges_key, method=method, e=e)
+            polylines = _cached(cache, stats, "polylines", polylines_key,
+                                lambda: list(trace()), pack_polylines, unpack_polylines)
+    else:
+        polylines = trace()
+
+    # 確認
+    if not headless:
+        with stats.stage("edges2polylines"):
+            polylines = list(polylines)
+        if verbose:
+            print("the number of lines : {}".format(len(polylines)))
+            print("the number of lines (filterd): {}".format(
+                  sum(1 for polyline in polylines if len(polyline) >= ml)))
+        dic = {"y": True, "yes": True, "n": False, "no": False, "":False}
+        while True:
+            inp = input("ok?[y/N] ").lower()
+            if inp in dic:
+                inp = dic[inp]
+                break
+            print("Error! Input again.")
+        if not inp:
+            sys.exit(0)
+
+    # 短い折れ線を除き，閉じたBスプラインに変換してフーリエ係数を求める
+    fs_key = None
+    arrays = None
+    if cache is not None:
+        fs_key = _fs_key(cache, edges_key, method, e, ml, k, n, degree_tol, simplify_tol)
+        with stats.stage("fourier_series"):
+            arrays = cache.load("fourier_series", fs_key)
+    if arrays is not None:
+        stats.count("cache_hits")
+        x_fs_lst, y_fs_lst = unpack_fs_lst(arrays)
+    else:
+        if cache is not None:
+            stats.count("cache_misses")
+        n_lines = stats.counters.get("polylines", 0)
+        curves = []
+        for polyline, x_fs, y_fs in iter_fourier_series(
+                polylines, n, k, ml, workers=workers, pool=pool, stats=stats,
+                degree_tol=degree_tol, simplify_tol=simplify_tol):
+            # 折れ線そのものは並べ替えに使う長さだけ残す
+            curves.append((polyline.length(), x_fs, y_fs))
+        if verbose and headless:
+            print("the number of lines : {}".format(stats.counters.get("polylines", 0) - n_lines))
+            print("the number of lines (filterd): {}".format(len(curves)))
+        # 短い曲線から順に並べる
+        curves.sort(key=lambda curve: curve[0])
+        x_fs_lst = [x_fs for _, x_fs, _ in curves]
+        y_fs_lst = [y_fs for _, _, y_fs in curves]
+        if cache is not None:
+            cache.store("fourier_series", fs_key, **pack_fs_lst(x_fs_lst, y_fs_lst))
+
+    stats.count("terms", sum(fs.n + 1 for fs in x_fs_lst))
+
+    # PicFormulaの生成
+    with stats.stage("pic_formula"):
+        x_picf = PicFormula(x_fs_lst)
+        y_picf = PicFormula(y_fs_lst)
+
+    return [x_picf, y_picf]
+
+
+def iter_curves(path, n, e=6, k=4, ml=10, method="greedy", threshold=None,
+                auto="median", blur=0, scale=None, workers=None, pool="process",
+                stats=None, degree_tol=None, simplify_tol=None):
+    """
+    画像から曲線を1本ずつ生成する(ウィンドウや確認は出さない)
 
-    # エッジを折れ線に変換
-    polylines = edges2polylines(edges, e)
-    print("the number of lines : {}".format(len(polylines)))
+    折れ線を辿るとすぐにBスプライン・フーリエ級数に変換して返すので，
+    全ての曲線が揃うのを待たずに書き出しや表示を始められる．
+    パラメータはgenerateと同じ
 
-    # 短い折れ線を排除
+    Yields
+    ------
+    (polyline, x_fs, y_fs) : (Polyline, FourierSeries, FourierSeries)
+        辿った順(generateはこれを折れ線の長さの順に並べ替える)
+    """
+    if stats is None:
+        stats = Stats()
+    if method not in TRACERS:
+        raise ValueError("method must be one of {}.".format(list(TRACERS)))
     ml = max(ml, k+1)
-    polylines = list(filter(lambda polyline: len(polyline) >= ml, polylines))
-    polylines = sorted(polylines, key=lambda pl: pl.length())
-    print("the number of lines (filterd): {}".format(len(polylines)))
+    with stats.stage("detect_edge"):
+        edges = detect_edge_headless(path, threshold=threshold, auto=auto,
+                                     blur=blur, scale=scale)
+        stats.count("edge_pixels", np.count_nonzero(edges == 255))
+    yield from iter_fourier_series(_trace(edges, method, e, stats), n, k, ml,
+                                   workers=workers, pool=pool, stats=stats,
+                                   degree_tol=degree_tol, simplify_tol=simplify_tol)
 
-    # 確認
-    dic = {"y": True, "yes": True, "n": False, "no": False, "":False}
+
+def iter_fourier_series(polylines, n, k=4, ml=0, workers=None, pool="process",
+                        stats=None, degree_tol=None, simplify_tol=None,
+                        chunk_points=MIN_CHUNK_POINTS):
+    """
+    折れ線を順に受け取り，点の数がml未満のものを除いて閉じたBスプラインに変換し，
+    フーリエ級数を求めて(polyline, x_fs, y_fs)を折れ線の順にyieldする
+
+    折れ線は制御点の数がchunk_points以上になるまで溜めてからまとめて変換する．
+    workersが2以上ならまとめた折れ線をプールに投入し，結果を待っているものが
+    workersの2倍を超えないようにする．polylinesはジェネレーターでもよく，
+    メモリに持つのは変換中の折れ線だけになる．simplify_tolを指定したときは
+    間引いた折れ線をBスプラインにするが，yieldするのは元の折れ線
+
+    Parameters
+    ----------
+    polylines : iterable of Polyline
+    n, k, workers, pool, stats, degree_tol, simplify_tol
+        generateと同じ
+    ml : int
+        これより点の少ない折れ線は除く
+    chunk_points : int
+        まとめて変換する制御点の数
+
+    Yields
+    ------
+    (polyline, x_fs, y_fs) : (Polyline, FourierSeries, FourierSeries)
+    """
+    if stats is None:
+        stats = Stats()
+    batches = _batch_polylines(polylines, ml, chunk_points, stats)
+    if not workers or workers <= 1:
+        done = 0
+        for batch in batches:
+            simplified = _simplify_batch(batch, simplify_tol, k, stats)
+            with stats.stage("fourier_series"):
+                x_fs_lst, y_fs_lst = _polylines2fourier_series(simplified, n, k, stats,
+                                                               degree_tol)
+            done += len(batch)
+            stats.report("fourier_series", done, None)
+            yield from zip(batch, x_fs_lst, y_fs_lst)
+        return
+
+    if pool == "process":
+        executor = ProcessPoolExecutor(max_workers=workers)
+    elif pool == "thread":
+        executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError('pool must be "process" or "thread".')
+    pending = collections.deque()
+    done = 0
+
+    def results(max_pending):
+        # 投入した順に，待っているものがmax_pending以下になるまで結果を返す
+        nonlocal done
+        while len(pending) > max_pending:
+            batch, future = pending.popleft()
+            with stats.stage("fourier_series"):
+                x_fs_lst, y_fs_lst, chunk_stats = future.result()
+            stats.merge(chunk_stats)
+            done += len(batch)
+            stats.report("fourier_series", done, None)
+            yield from zip(batch, x_fs_lst, y_fs_lst)
+
+    with executor:
+        for batch in batches:
+            simplified = _simplify_batch(batch, simplify_tol, k, stats)
+            pending.append((batch, executor.submit(_polylines2fourier_series_chunk,
+                                                   simplified, n, k, degree_tol)))
+            yield from results(2 * workers)
+        yield from results(0)
+
+
+def _trace(edges, method, e, stats):
+    # 最初の折れ線を取り出すときに変換を始める
+    yield from TRACERS[method](edges, e, stats=stats)
+
+
+def _batch_polylines(polylines, ml, chunk_points, stats):
+    """
+    点の数がml以上の折れ線を，制御点の数がchunk_points以上になるまでまとめる
+    """
+    polylines = iter(polylines)
+    batch = []
+    points = 0
     while True:
-        inp = input("ok?[y/N] ").lower()
-        if inp in dic:
-            inp = dic[inp]
+        with stats.stage("edges2polylines"):
+            polyline = next(polylines, None)
+        if polyline is None:
             break
-        print("Error! Input again.")
-    if not inp:
-        sys.exit(0)
-
-    # 折れ線を閉じたBスプラインに変換
-    bsplines = []
-    for polyline in polylines:
-        bs = polyline.closed_bspline(k=k)
-        bsplines.append(bs)
-
-    # Bスプラインをフーリエ変換してさらにフーリエ係数を求める
-    x_fs_lst = []
-    y_fs_lst = []
-    for bs in bsplines:
-        x_fs, y_fs = bspline2fourier_series(bs, n=n)
-        x_fs_lst.append(x_fs)
-        y_fs_lst.append(y_fs)
-    # PicFormulaの生成
-    x_picf = PicFormula(x_fs_lst)
-    y_picf = PicFormula(y_fs_lst)
+        stats.count("polylines")
+        if len(polyline) < ml:
+            continue
+        stats.count("polylines_filtered")
+        batch.append(polyline)
+        points += len(polyline)
+        if points >= chunk_points:
+            yield batch
+            batch = []
+            points = 0
+    if batch:
+        yield batch
 
-    return [x_picf, y_picf]
+
+def _simplify_batch(batch, tol, k, stats):
+    if tol is None:
+        return batch
+    with stats.stage("simplify"):
+        stats.count("points", sum(len(polyline) for polyline in batch))
+        simplified = simplify_polylines(batch, tol, k, SIMPLIFY_STEP_RATIO * tol)
+        stats.count("points_simplified", sum(len(polyline) for polyline in simplified))
+    return simplified
+
+
+def _fs_key(cache, edges_key, method, e, ml, k, n, degree_tol=None, simplify_tol=None):
+    polylines_key = cache.key("polylines", edges=edges_key, method=method, e=e)
+    params = {"ml": ml, "k": k, "n": n}
+    # 指定しないときのキーは以前と同じにする
+    if degree_tol is not None:
+        params["degree_tol"] = float(degree_tol)
+    if simplify_tol is not None:
+        params["simplify_tol"] = float(simplify_tol)
+    return cache.key("fourier_series", polylines=polylines_key, **params)
+
+
+def _cached(cache, stats, stage, key, compute, pack, unpack):
+    """
+    cacheにkeyの結果があれば読み込み，無ければcompute()の結果を保存して返す
+    """
+    if cache is None:
+        return compute()
+    arrays = cache.load(stage, key)
+    if arrays is not None:
+        stats.count("cache_hits")
+        return unpack(arrays)
+    stats.count("cache_misses")
+    res = compute()
+    cache.store(stage, key, **pack(res))
+    return res
+
+
+def simplify_polylines(polylines, tol, k=4, max_step=None):
+    """
+    各折れ線の点を間引く(Polyline.simplify)
+
+    全ての折れ線の点を1つの配列にまとめて一度に間引く．
+    Bスプラインにするには次数kより多くの点が必要なので，間引くとk個以下に
+    なる折れ線はそのまま残す
+    """
+    arrays = pack_polylines(polylines)
+    keep = simplify_mask(arrays["points"], arrays["offsets"], tol)
+    points = arrays["points"][keep]
+    offsets = np.concatenate(([0], np.cumsum(keep)))[arrays["offsets"]]
+    if max_step is not None:
+        points, offsets = subdivide_points(points, offsets, max_step)
+    res = []
+    for polyline, a, b in zip(polylines, offsets[:-1], offsets[1:]):
+        res.append(Polyline(points[a:b]) if b - a > k else polyline)
+    return res
+
+
+def _polylines2fourier_series(polylines, n, k, stats=None, degree_tol=None):
+    bsplines = [polyline.closed_bspline(k=k) for polyline in polylines]
+    return bsplines2fourier_series(bsplines, n=n, stats=stats, degree_tol=degree_tol)
+
+
+def _polylines2fourier_series_chunk(polylines, n, k, degree_tol=None):
+    # ワーカーで実行し，数えたカウンタも返す
+    stats = Stats()
+    x_fs_lst, y_fs_lst = _polylines2fourier_series(polylines, n, k, stats, degree_tol)
+    return x_fs_lst, y_fs_lst, stats
@@ -0,0 +1,271 @@
+import numpy as np
+
+from .fourier_series import (FourierSeries, FourierSeriesFraction, evaluate_series,
+                             series_str, fraction_series_str, iter_fraction_series_latex)
+from .pic_formula import (evaluate_segments, join_str, iter_join_latex, iter_join_desmos,
+                          write_chunks)
+from .rational import coefficients2fractions, ratios2fractions, ratios2ndarray
+
+
+class PackedPicFormula:
+    """
+    全ての曲線の係数を1つの配列にまとめたPicFormula
+
+    k番目の曲線の振幅と位相は r[offsets[k]:offsets[k+1]], p[offsets[k]:offsets[k+1]]
+    で，次数は degrees[k] = offsets[k+1] - offsets[k] - 1 である．
+    曲線ごとに次数が違ってもよい
+    """
+
+    __slots__ = ("_r", "_p", "_offsets", "_fs_lst")
+
+    def __init__(self, r, p, offsets):
+        """
+        Parameters
+        ----------
+        r : ndarray
+            全ての曲線の振幅を並べた配列
+        p : ndarray
+            全ての曲線の位相を並べた配列
+        offsets : ndarray of int
+            各曲線の係数の開始位置(長さは曲線の数+1)
+        """
+        r = np.asarray(r, dtype=np.float64)
+        p = np.asarray(p, dtype=np.float64)
+        if r.shape != p.shape:
+            raise ValueError("r and p must be the same length!")
+        self._r = r
+        self._p = p
+        self._set_offsets(offsets, len(r))
+
+    def _set_offsets(self, offsets, size):
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if offsets[0] != 0 or offsets[-1] != size or np.any(np.diff(offsets) < 1):
+            raise ValueError("offsets must increase from 0 to the number of coefficients.")
+        self._offsets = offsets
+        self._fs_lst = None
+
+    @classmethod
+    def from_fs_lst(cls, fs_lst):
+        offsets = np.zeros(len(fs_lst) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([fs.n + 1 for fs in fs_lst])
+        r = np.concatenate([fs.r for fs in fs_lst])
+        p = np.concatenate([fs.p for fs in fs_lst])
+        return cls(r, p, offsets)
+
+    def _coef(self, k, n=None):
+        """
+        k番目の曲線のn次までの振幅と位相(配列のビュー)
+        """
+        a = self._offsets[k]
+        b = self._offsets[k+1]
+        if n and n < b - a - 1:
+            b = a + n + 1
+        return self._r[a:b], self._p[a:b]
+
+    def __call__(self, t, n=None):
+        """
+        Parameters
+        ----------
+        t : int or float or array-like
+            変数
+        n : int
+            次数
+        """
+        return evaluate_segments(t, self.num,
+                                 lambda idx_k, tk: evaluate_series(*self._coef(idx_k, n), tk))
+
+    def __str__(self):
+        return self.str(showmax=10)
+
+    def str(self, showmax=None):
+        return join_str(series_str(*self._coef(k), showmax)
+                        for k in range(self.num))
+
+    def fraction(self, maxd=100):
+        return PackedPicFormulaFraction.from_packed(self, maxd)
+
+    def _slices(self, curves, n):
+        """
+        curvesの各曲線のn次までの係数の位置と，それを詰めたときのoffsets
+        """
+        curves = np.arange(self.num)[curves] if not np.isscalar(curves) else [curves]
+        starts = self._offsets[curves]
+        sizes = self._offsets[np.asarray(curves) + 1] - starts
+        if n is not None:
+            sizes = np.minimum(sizes, n + 1)
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)
+        idx = np.repeat(starts - offsets[:-1], sizes) + np.arange(offsets[-1])
+        return idx, offsets
+
+    def select(self, curves=slice(None), n=None):
+        """
+        curvesの曲線だけをn次まで取り出した新しいPackedPicFormulaを返す
+
+        係数が読み出されるのは選んだ部分だけなので，load_picfで開いたファイルから
+        一部の曲線や低次の係数だけを読むのに使える
+        """
+        idx, offsets = self._slices(curves, n)
+        return PackedPicFormula(self._r[idx], self._p[idx], offsets)
+
+    def get_fs_lst(self):
+        # 互換性のため，必要になったときに係数のビューを持つFourierSeriesを作る
+        if self._fs_lst is None:
+            self._fs_lst = [FourierSeries(*self._coef(k)) for k in range(self.num)]
+        return self._fs_lst
+    fs_lst = property(get_fs_lst)
+
+    def get_num(self):
+        return len(self._offsets) - 1
+    num = property(get_num)
+
+    def get_degree(self):
+        # 曲線ごとに次数が異なるときは最大の次数
+        return int(np.diff(self._offsets).max() - 1)
+    degree = property(get_degree)
+
+    def get_degrees(self):
+        return np.diff(self._offsets) - 1
+    degrees = property(get_degrees)
+
+    def get_offsets(self):
+        return self._offsets
+    offsets = property(get_offsets)
+
+    def get_r(self):
+        return self._r
+    r = property(get_r)
+
+    def get_p(self):
+        return self._p
+    p = property(get_p)
+
+
+class PackedPicFormulaFraction(PackedPicFormula):
+    """
+    係数を分子・分母の整数配列で持つPackedPicFormula
+
+    Fractionは文字列にするときにだけ作る
+    """
+
+    __slots__ = ("maxd", "_r_num", "_r_den", "_p_num", "_p_den")
+
+    def __init__(self, r_num, r_den, p_num, p_den, offsets, maxd=100):
+        r_num, r_den, p_num, p_den = [np.asarray(a, dtype=np.int64)
+                                      for a in (r_num, r_den, p_num, p_den)]
+        if not r_num.shape == r_den.shape == p_num.shape == p_den.shape:
+            raise ValueError("r and p must be the same length!")
+        self.maxd = maxd
+        self._r_num = r_num
+        self._r_den = r_den
+        self._p_num = p_num
+        self._p_den = p_den
+        # 小数の係数は必要になったときに作る
+        self._r = None
+        self._p = None
+        self._set_offsets(offsets, len(r_num))
+
+    @classmethod
+    def from_fs_lst(cls, fs_lst, maxd=100):
+        """
+        FourierSeriesFractionのリストから作る
+        """
+        offsets = np.zeros(len(fs_lst) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([fs.n + 1 for fs in fs_lst])
+        ratios = [fs.ratios for fs in fs_lst]
+        r_num, r_den, p_num, p_den = [
+            np.concatenate([ratio[ii] for ratio in ratios]) if ratios
+            else np.zeros(0, dtype=np.int64) for ii in range(4)]
+        return cls(r_num, r_den, p_num, p_den, offsets, maxd)
+
+    @classmethod
+    def from_packed(cls, packed, maxd=100):
+        """
+        PackedPicFormulaの係数を分母がmaxd以下の分数にする
+        """
+        r_num, r_den = coefficients2fractions(packed.r, packed.offsets, maxd)
+        p_num, p_den = coefficients2fractions(packed.p, packed.offsets, maxd)
+        return cls(r_num, r_den, p_num, p_den, packed.offsets, maxd)
+
+    def _coef(self, k, n=None):
+        a = self._offsets[k]
+        b = self._offsets[k+1]
+        if n and n < b - a - 1:
+            b = a + n + 1
+        if self._r is not None:
+            return self._r[a:b], self._p[a:b]
+        return (ratios2ndarray(self._r_num[a:b], self._r_den[a:b]),
+                ratios2ndarray(self._p_num[a:b], self._p_den[a:b]))
+
+    def _fractions(self, k):
+        """
+        k番目の曲線の振幅と位相のFractionのリスト
+        """
+        a = self._offsets[k]
+        b = self._offsets[k+1]
+        return (ratios2fractions(self._r_num[a:b], self._r_den[a:b]),
+                ratios2fractions(self._p_num[a:b], self._p_den[a:b]))
+
+    def str(self, showmax=None):
+        return join_str(fraction_series_str(*self._fractions(k), showmax)
+                        for k in range(self.num))
+
+    def latex(self, showmax=None):
+        return "".join(self.iter_latex(showmax))
+
+    def str_desmos(self, fun_name="f"):
+        return "".join(self.iter_desmos(fun_name))
+
+    def iter_latex(self, showmax=None):
+        return iter_join_latex(iter_fraction_series_latex(*self._fractions(k), showmax)
+                               for k in range(self.num))
+
+    def iter_desmos(self, fun_name="f"):
+        return iter_join_desmos((iter_fraction_series_latex(*self._fractions(k))
+                                 for k in range(self.num)), fun_name)
+
+    def write_latex(self, f, showmax=None, chunk_size=None):
+        write_chunks(f, self.iter_latex(showmax), chunk_size)
+
+    def write_desmos(self, f, fun_name="f", chunk_size=None):
+        write_chunks(f, self.iter_desmos(fun_name), chunk_size)
+
+    def fraction(self, maxd=100):
+        if maxd == self.maxd:
+            return self
+        return PackedPicFormulaFraction.from_packed(self, maxd)
+
+    def select(self, curves=slice(None), n=None):
+        idx, offsets = self._slices(curves, n)
+        return PackedPicFormulaFraction(self._r_num[idx], self._r_den[idx],
+                                        self._p_num[idx], self._p_den[idx],
+                                        offsets, self.maxd)
+
+    def get_r(self):
+        if self._r is None:
+            self._r = ratios2ndarray(self._r_num, self._r_den)
+        return self._r
+    r = property(get_r)
+
+    def get_p(self):
+        if self._p is None:
+            self._p = ratios2ndarray(self._p_num, self._p_den)
+        return self._p
+    p = property(get_p)
+
+    def get_fractions(self):
+        """
+        分子・分母の配列 (r_num, r_den, p_num, p_den)
+        """
+        return self._r_num, self._r_den, self._p_num, self._p_den
+    fractions = property(get_fractions)
+
+    def get_fs_lst(self):
+        if self._fs_lst is None:
+            o = self._offsets
+            self._fs_lst = [FourierSeriesFraction.from_ratios(
+                self._r_num[o[k]:o[k+1]], self._r_den[o[k]:o[k+1]],
+                self._p_num[o[k]:o[k+1]], self._p_den[o[k]:o[k+1]], self.maxd)
+                for k in range(self.num)]
+        return self._fs_lst
+    fs_lst = property(get_fs_lst)
@@ -0,0 +1,69 @@
+import numpy as np
+
+from .fourier_series import DEFAULT_MAX_BYTES
+from .packed_pic_formula import PackedPicFormula
+
+
+class PartialSums:
+    """
+    PicFormulaの全ての曲線の部分和を共通のtで持ち，次数を上げるときは
+    増えた項だけを足す
+
+    次数を上げながら何度も評価する(アニメーションなど)ときに，毎回全ての項を
+    計算し直さずに済む．次数を下げるときは0次から計算し直す
+    """
+
+    def __init__(self, picf, t, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Parameters
+        ----------
+        picf : PicFormula or PackedPicFormula
+        t : array-like
+            全ての曲線で共通の変数
+        max_bytes : int
+            項を足すときに作る一時配列の大きさの上限(byte)
+        """
+        if not isinstance(picf, PackedPicFormula):
+            picf = picf.pack()
+        self.t = np.asarray(t, dtype=np.float64).ravel()
+        self.max_bytes = max_bytes
+        self.degrees = picf.degrees
+        # a[j, k] = r_k e^{i p_k} (j番目の曲線，次数の低い曲線は0で埋める)
+        offsets = picf.offsets
+        sizes = np.diff(offsets)
+        rows = np.repeat(np.arange(picf.num), sizes)
+        cols = np.arange(offsets[-1]) - np.repeat(offsets[:-1], sizes)
+        self._a = np.zeros((picf.num, sizes.max()), dtype=np.complex128)
+        self._a[rows, cols] = picf.r * np.exp(1j * picf.p)
+        self._a[:, 0] /= 2  # 定数項の振幅は半分にしておく
+        self.reset()
+
+    def reset(self):
+        self._values = np.zeros((len(self._a), len(self.t)))
+        self._n = -1
+
+    def __call__(self, n=None):
+        """
+        n次までの部分和を返す
+
+        Returns
+        -------
+        values : ndarray, shape (曲線の数, len(t))
+            内部の配列なので書き換えないこと
+        """
+        n_max = self._a.shape[1] - 1
+        n = n_max if n is None else min(n, n_max)
+        if n < self._n:
+            self.reset()
+        # k = _n+1, ..., n の項をmax_bytes以下の一時配列で済む数ずつ足す
+        step = max(1, int(self.max_bytes // (16 * len(self.t))))
+        for start in range(self._n + 1, n + 1, step):
+            stop = min(start + step, n + 1)
+            z = np.exp(1j * np.outer(np.arange(start, stop), self.t))
+            self._values += self._a[:, start:stop].dot(z).real
+        self._n = n
+        return self._values
+
+    def get_degree(self):
+        return self._n
+    degree = property(get_degree)
@@ -1,22 +1,17 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import numba as nb
 
 
 
 def plot_pf(x_picf, y_picf, n=1000, show=True, **kwargs):
-    DLT = 1e-8  # 不連続点に空けておく隙間の大きさ
+    import matplotlib.pyplot as plt
     if x_picf.num != y_picf.num:
         raise ValueError("x and y must be the same length!")
     kwargs = kwargs or {}
     kwargs["color"] = "tab:blue"
-    PI = np.pi
-    num = x_picf.num
     plt.figure("N = {:d}".format(x_picf.degree))
-    for ii in range(num+1):
-        # 不連続点には若干の隙間を空けておく
-        tt = np.linspace(2*(ii-1)+DLT, 2*ii-DLT, n) * PI
-        plt.plot(x_picf(tt), y_picf(tt), **kwargs)
+    for x, y in sample_pf(x_picf, y_picf, n):
+        plt.plot(x, y, **kwargs)
     plt.axis("equal")
     plt.grid(True, linestyle="--")
     plt.tight_layout()
@@ -24,6 +19,56 @@ def plot_pf(x_picf, y_picf, n=1000, show=True, **kwargs):
         plt.show()
 
 
+def sample_pf(x_picf, y_picf, n=1000):
+    """
+    plot_pfで描く点を2piごとの区間ごとにn点ずつ求める
+
+    Returns
+    -------
+    points : list of (ndarray, ndarray)
+        区間ごとのx, yの値
+    """
+    DLT = 1e-8  # 不連続点に空けておく隙間の大きさ
+    PI = np.pi
+    points = []
+    for ii in range(x_picf.num+1):
+        # 不連続点には若干の隙間を空けておく
+        tt = np.linspace(2*(ii-1)+DLT, 2*ii-DLT, n) * PI
+        points.append((x_picf(tt), y_picf(tt)))
+    return points
+
+
+def evaluate_segments(t, num, fun):
+    """
+    tを2piごとの区間に分け，k番目の区間の値をfun(k, tの区間内の部分)で求める
+
+    区間は一度だけ求め，値を持つ区間についてだけfunを呼ぶ．
+    plot_pfなどはソート済みのtを渡すので，そのときは並び替えない
+    """
+    PI = np.pi
+    t = np.array(t, dtype=np.float64)
+    shape = t.shape
+    t = t.ravel()
+    idx = np.array(t // (2*PI), dtype=np.int64)
+    np.clip(idx, 0, num - 1, out=idx)
+    if np.all(idx[1:] >= idx[:-1]):
+        order = None
+    else:
+        order = np.argsort(idx, kind="stable")
+        idx = idx[order]
+        t = t[order]
+    bounds = np.searchsorted(idx, np.arange(num + 1))
+    res = np.zeros(t.shape)
+    for idx_k in np.flatnonzero(bounds[1:] > bounds[:-1]):
+        a, b = bounds[idx_k], bounds[idx_k+1]
+        res[a:b] = fun(idx_k, t[a:b])
+    if order is not None:
+        tmp = np.empty_like(res)
+        tmp[order] = res
+        res = tmp
+    return res.reshape(shape)
+
+
 class PicFormula:
 
     def __init__(self, fs_lst):
@@ -40,38 +85,26 @@ class PicFormula:
         n : int
             次数
         """
-        PI = np.pi
-        num = self._num
-        t = np.array(t)
-        idx = np.array(t // (2*PI), dtype=np.int64)
-        idx[idx < 0] = 0
-        idx[idx > num - 1] = num - 1
-        res = np.zeros(t.shape)
-        for idx_k in range(num):
-            match = idx == idx_k
-            res[match] = self._fs_lst[idx_k](t[match], n)
-        return res
+        return evaluate_segments(t, self._num,
+                                 lambda idx_k, tk: self._fs_lst[idx_k](tk, n))
 
     def __str__(self):
         return self.str(showmax=10)
 
     def str(self, showmax=None):
-        res = ""
-        for ii, fs in enumerate(self._fs_lst):
-            if ii == 0:
-                res += "({})".format(fs.str(showmax=showmax))
-                res += "θ(t)θ(2π - t)"
-                continue
-            res += " +"
-            res += " ({})".format(fs.str(showmax=showmax))
-            res += "θ(t - {:d}π)".format(ii * 2)
-            res += "θ({:d}π - t)".format((ii + 1) * 2)
-        return res
+        return join_str(fs.str(showmax=showmax) for fs in self._fs_lst)
 
 
     def fraction(self, maxd=100):
         return PicFormulaFraction(self._fs_lst, maxd)
 
+    def pack(self):
+        """
+        係数を1つの配列にまとめたPackedPicFormulaに変換する
+        """
+        from .packed_pic_formula import PackedPicFormula
+        return PackedPicFormula.from_fs_lst(self._fs_lst)
+
     def get_fs_lst(self):
         return self._fs_lst
     fs_lst = property(get_fs_lst)
@@ -81,35 +114,141 @@ class PicFormula:
     num = property(get_num)
 
     def get_degree(self):
-        return self._fs_lst[0].n
+        # 曲線ごとに次数が異なるときは最大の次数
+        return max(fs.n for fs in self._fs_lst)
     degree = property(get_degree)
 
+    def get_degrees(self):
+        return np.array([fs.n for fs in self._fs_lst], dtype=np.int64)
+    degrees = property(get_degrees)
+
 
 class PicFormulaFraction(PicFormula):
 
     def __init__(self, fs_lst, maxd=100):
         super().__init__(fs_lst)
         self.maxd = maxd
-        # _fs_lstをfraction化する
-        self._fs_lst = [fs.fraction(self.maxd) for fs in self.fs_lst]
+        # _fs_lstをfraction化する(全ての曲線の係数をまとめて分数にする)
+        from .fourier_series import fraction_fs_lst
+        self._fs_lst = fraction_fs_lst(self.fs_lst, self.maxd)
+
+    def pack(self):
+        from .packed_pic_formula import PackedPicFormulaFraction
+        return PackedPicFormulaFraction.from_fs_lst(self._fs_lst, self.maxd)
     
     def str_desmos(self, fun_name = "f"):
-        res = ""
-        for ii, fs in enumerate(self._fs_lst):
-            tmp = fs.latex().replace("\n","")
-            res += "{:s}_{{{:d}}}(t) = {:s}".format(fun_name, ii + 1, tmp) + "\n"
-        return res
+        return "".join(self.iter_desmos(fun_name))
 
     def latex(self, showmax=None):
-        res = ""
-        for ii, fs in enumerate(self._fs_lst):
-            if ii == 0:
-                res += r"\biggl\{{ {} \biggr\}}".format(fs.latex(showmax=showmax)) + "\n"
-                res += r" \theta \left( t \right)"
-                res += r" \theta \left( 2 \pi - t \right)" + "\n"
-                continue
-            res += r" +"
-            res += r"\biggl\{{ {} \biggr\}}".format(fs.latex(showmax=showmax)) + "\n"
-            res += r" \theta \left( t - {:d} \pi \right)".format(ii * 2)
-            res += r" \theta \left( {:d} \pi - t \right)".format((ii + 1) * 2) + "\n"
-        return res
+        return "".join(self.iter_latex(showmax))
+
+    def iter_latex(self, showmax=None):
+        """
+        latex()の文字列を項ごとに順に返すジェネレータ
+        """
+        return iter_join_latex(fs.iter_latex(showmax=showmax) for fs in self._fs_lst)
+
+    def iter_desmos(self, fun_name="f"):
+        """
+        str_desmos()の文字列を項ごとに順に返すジェネレータ
+        """
+        return iter_join_desmos((fs.iter_latex() for fs in self._fs_lst), fun_name)
+
+    def write_latex(self, f, showmax=None, chunk_size=None):
+        """
+        latex()の文字列を全体を作らずにファイルfへ書き込む
+        """
+        write_chunks(f, self.iter_latex(showmax), chunk_size)
+
+    def write_desmos(self, f, fun_name="f", chunk_size=None):
+        """
+        str_desmos()の文字列を全体を作らずにファイルfへ書き込む
+        """
+        write_chunks(f, self.iter_desmos(fun_name), chunk_size)
+
+
+def join_str(strs):
+    """
+    各曲線の文字列を区間ごとの階段関数でつないで1つの式にする
+    """
+    res = ""
+    for ii, s in enumerate(strs):
+        if ii == 0:
+            res += "({})".format(s)
+            res += "θ(t)θ(2π - t)"
+            continue
+        res += " +"
+        res += " ({})".format(s)
+        res += "θ(t - {:d}π)".format(ii * 2)
+        res += "θ({:d}π - t)".format((ii + 1) * 2)
+    return res
+
+
+def join_latex(latexs):
+    """
+    各曲線のLaTeXの文字列を区間ごとの階段関数でつないで1つの式にする
+    """
+    return "".join(iter_join_latex([s] for s in latexs))
+
+
+def iter_join_latex(latex_chunks):
+    """
+    join_latexの文字列を順に返すジェネレータ
+
+    latex_chunksの各要素は1つの曲線のLaTeXの文字列を分割して順に返すiterable
+    """
+    for ii, chunks in enumerate(latex_chunks):
+        if ii == 0:
+            yield r"\biggl\{ "
+        else:
+            yield r" +" + r"\biggl\{ "
+        yield from chunks
+        yield r" \biggr\}" + "\n"
+        if ii == 0:
+            yield r" \theta \left( t \right)" + r" \theta \left( 2 \pi - t \right)" + "\n"
+        else:
+            yield r" \theta \left( t - {:d} \pi \right)".format(ii * 2) \
+                + r" \theta \left( {:d} \pi - t \right)".format((ii + 1) * 2) + "\n"
+
+
+def join_desmos(latexs, fun_name="f"):
+    """
+    各曲線のLaTeXの文字列をdesmos用に1行ずつの関数にする
+    """
+    return "".join(iter_join_desmos(([s] for s in latexs), fun_name))
+
+
+def iter_join_desmos(latex_chunks, fun_name="f"):
+    """
+    join_desmosの文字列を順に返すジェネレータ
+    """
+    for ii, chunks in enumerate(latex_chunks):
+        yield "{:s}_{{{:d}}}(t) = ".format(fun_name, ii + 1)
+        for chunk in chunks:
+            yield chunk.replace("\n", "")
+        yield "\n"
+
+
+def write_chunks(f, chunks, chunk_size=None):
+    """
+    文字列のiterableを順にファイルfに書き込む
+
+    chunk_sizeを指定すると，chunk_size文字以上たまるごとにまとめて書き込んでflushする
+    """
+    if chunk_size is None:
+        for chunk in chunks:
+            f.write(chunk)
+        return
+    buf = []
+    size = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            f.write("".join(buf))
+            f.flush()
+            buf = []
+            size = 0
+    if buf:
+        f.write("".join(buf))
+    f.flush()
@@ -0,0 +1,242 @@
+import json
+import pickle
+import struct
+
+import numpy as np
+
+from .packed_pic_formula import PackedPicFormula, PackedPicFormulaFraction
+from .pic_formula import PicFormula
+
+
+# picfファイルの形式
+#
+#   MAGIC(8 byte) | ヘッダの長さ(uint32, little endian) | ヘッダ(JSON, UTF-8)
+#   | 配列 | 配列 | ...
+#
+# ヘッダには形式のバージョン，係数の種類("fraction" or "float")，maxdと，
+# 各配列の名前・dtype・shape・ファイル先頭からの位置が書かれている．
+# 配列はlittle endianでALIGN byteごとの位置に置かれるので，ファイル全体を
+# np.memmapで開いてそのまま配列のビューとして読める
+#
+# 複数フレームのファイル(save_picf_frames)はx, yに全てのフレームの曲線を
+# 重複なく並べ，ヘッダの"frames"にフレームの数を書く．i番目のフレームの曲線は
+# frame_curves[frame_offsets[i]:frame_offsets[i+1]]番目の曲線である
+MAGIC = b"PICF\x00BIN"
+FORMAT_VERSION = 1
+ALIGN = 64
+
+FRACTION_FIELDS = ("offsets", "r_num", "r_den", "p_num", "p_den")
+FLOAT_FIELDS = ("offsets", "r", "p")
+
+
+def save_picf(path, x_picf, y_picf):
+    """
+    x, yのPicFormulaをpicfファイルに保存する
+
+    PicFormula(Fraction)はpackしてから保存する．pathはバイナリモードの
+    ファイルオブジェクト(io.BytesIOなど)でもよい
+    """
+    header, arrays = _picf_arrays(x_picf, y_picf)
+    _save_arrays(path, header, arrays)
+
+
+def save_picf_frames(path, frames, maxd=None):
+    """
+    複数のフレームの[x_picf, y_picf]を1つのpicfファイルに保存する
+
+    フレーム間で同じFourierSeriesのオブジェクトを使っている曲線(iter_sequenceで
+    前のフレームから引き継いだ曲線)は1回だけ保存する．maxdを指定すると
+    重複を除いた曲線の係数をまとめて分数にして保存する
+
+    Parameters
+    ----------
+    frames : iterable of [x_picf, y_picf]
+        各フレームのPicFormula(packしていないもの)
+    """
+    x_fs_lst = []
+    y_fs_lst = []
+    index = {}
+    frame_curves = []
+    frame_offsets = [0]
+    for x_picf, y_picf in frames:
+        for x_fs, y_fs in zip(x_picf.fs_lst, y_picf.fs_lst):
+            key = (id(x_fs), id(y_fs))
+            if key not in index:
+                index[key] = len(x_fs_lst)
+                x_fs_lst.append(x_fs)
+                y_fs_lst.append(y_fs)
+            frame_curves.append(index[key])
+        frame_offsets.append(len(frame_curves))
+    x_picf = PicFormula(x_fs_lst)
+    y_picf = PicFormula(y_fs_lst)
+    if maxd is not None:
+        x_picf = x_picf.fraction(maxd)
+        y_picf = y_picf.fraction(maxd)
+    header, arrays = _picf_arrays(x_picf, y_picf)
+    header["frames"] = len(frame_offsets) - 1
+    arrays["frame_offsets"] = np.asarray(frame_offsets, dtype="<i8")
+    arrays["frame_curves"] = np.asarray(frame_curves, dtype="<i8")
+    _save_arrays(path, header, arrays)
+
+
+def _picf_arrays(x_picf, y_picf):
+    """
+    x, yのPicFormulaを保存する配列と，配列の位置を除いたヘッダ
+    """
+    kinds = set()
+    arrays = {}
+    maxd = None
+    for axis, picf in (("x", x_picf), ("y", y_picf)):
+        if not isinstance(picf, PackedPicFormula):
+            picf = picf.pack()
+        if isinstance(picf, PackedPicFormulaFraction):
+            kinds.add("fraction")
+            maxd = picf.maxd
+            fields = dict(zip(FRACTION_FIELDS, (picf.offsets,) + picf.fractions))
+            dtype = "<i8"
+        else:
+            kinds.add("float")
+            fields = dict(zip(FLOAT_FIELDS, (picf.offsets, picf.r, picf.p)))
+            dtype = None
+        for name, arr in fields.items():
+            if name == "offsets":
+                arr = np.asarray(arr, dtype="<i8")
+            else:
+                arr = np.asarray(arr, dtype=dtype or "<f8")
+            arrays["{}_{}".format(axis, name)] = arr
+    if len(kinds) != 1:
+        raise ValueError("x and y must be the same kind of PicFormula!")
+    header = {"version": FORMAT_VERSION, "kind": kinds.pop(), "maxd": maxd}
+    return header, arrays
+
+
+def _save_arrays(path, header, arrays):
+    # 配列の位置は仮の値(最大の桁数)でヘッダの長さを見積もってから決める
+    header["arrays"] = {}
+    for name, arr in arrays.items():
+        header["arrays"][name] = {"dtype": arr.dtype.str, "shape": list(arr.shape),
+                                  "offset": 10 ** 18}
+    pos = _align(len(MAGIC) + 4 + len(json.dumps(header).encode("utf-8")))
+    for name, arr in arrays.items():
+        header["arrays"][name]["offset"] = pos
+        pos = _align(pos + arr.nbytes)
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    if hasattr(path, "write"):
+        _write_picf(path, header, header_bytes, arrays)
+    else:
+        with open(path, "wb") as f:
+            _write_picf(f, header, header_bytes, arrays)
+
+
+def _write_picf(f, header, header_bytes, arrays):
+    # 配列の位置は書き始めた位置からの相対位置
+    start = f.tell()
+    f.write(MAGIC)
+    f.write(struct.pack("<I", len(header_bytes)))
+    f.write(header_bytes)
+    for name, arr in arrays.items():
+        f.write(b"\x00" * (header["arrays"][name]["offset"] - (f.tell() - start)))
+        f.write(arr.tobytes())
+
+
+def load_picf(path, mmap=True):
+    """
+    picfファイルを読み込んで[x_picf, y_picf]を返す
+
+    バイナリ形式ならPackedPicFormula(Fraction)を返す．mmapがTrueなら係数は
+    ファイルを直接参照するビューで，使った部分だけが読み込まれる．
+    以前のpickle形式のファイルならpickleに保存されたオブジェクトをそのまま返す．
+    複数フレームのファイルなら全てのフレームの曲線を重複なく並べたものを返す
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            f.seek(0)
+            return pickle.load(f)
+    header, arrays = _load_arrays(path, mmap)
+    return _picfs_from_arrays(header, arrays)
+
+
+def load_picf_frames(path, mmap=True):
+    """
+    save_picf_framesで保存したファイルを読み込んで各フレームの[x_picf, y_picf]の
+    リストを返す(1フレームのpicfファイルなら長さ1のリスト)
+
+    Returns
+    -------
+    frames : list of [PackedPicFormula, PackedPicFormula]
+    """
+    header, arrays = _load_arrays(path, mmap)
+    x_picf, y_picf = _picfs_from_arrays(header, arrays)
+    if "frames" not in header:
+        return [[x_picf, y_picf]]
+    offsets = arrays["frame_offsets"]
+    curves = arrays["frame_curves"]
+    res = []
+    for a, b in zip(offsets[:-1], offsets[1:]):
+        res.append([x_picf.select(curves[a:b]), y_picf.select(curves[a:b])])
+    return res
+
+
+def _load_arrays(path, mmap):
+    """
+    バイナリ形式のpicfファイルのヘッダと配列(名前 -> 配列)
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a binary picf file: {}".format(path))
+        header = _read_header(f)
+    if mmap:
+        buf = np.memmap(path, dtype=np.uint8, mode="r")
+    else:
+        with open(path, "rb") as f:
+            buf = np.frombuffer(f.read(), dtype=np.uint8)
+    arrays = {}
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"])
+        count = int(np.prod(info["shape"]))
+        start = info["offset"]
+        arr = buf[start:start + count * dtype.itemsize].view(dtype)
+        arrays[name] = arr.reshape(info["shape"])
+    return header, arrays
+
+
+def _picfs_from_arrays(header, all_arrays):
+    res = []
+    for axis in ("x", "y"):
+        arrays = {name[2:]: arr for name, arr in all_arrays.items()
+                  if name.startswith(axis + "_")}
+        if header["kind"] == "fraction":
+            res.append(PackedPicFormulaFraction(
+                arrays["r_num"], arrays["r_den"], arrays["p_num"], arrays["p_den"],
+                arrays["offsets"], header["maxd"]))
+        else:
+            res.append(PackedPicFormula(arrays["r"], arrays["p"], arrays["offsets"]))
+    return res
+
+
+def convert_picf(src, dst):
+    """
+    pickle形式のpicfファイルをバイナリ形式に変換する
+    """
+    x_picf, y_picf = load_picf(src)
+    save_picf(dst, x_picf, y_picf)
+
+
+def is_binary_picf(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _read_header(f):
+    (length,) = struct.unpack("<I", f.read(4))
+    header = json.loads(f.read(length).decode("utf-8"))
+    if header["version"] > FORMAT_VERSION:
+        msg = "picf format version {} is not supported (supported: <= {})."
+        raise ValueError(msg.format(header["version"], FORMAT_VERSION))
+    return header
+
+
+def _align(pos):
+    return -(-pos // ALIGN) * ALIGN
@@ -3,19 +3,63 @@ import numpy as np
 from scipy import interpolate
 
 
-class Polyline(list):
+# 点を追加するバッファの最小の大きさ(点の数)
+MIN_CAPACITY = 8
+
+
+class Polyline:
+    """
+    折れ線(2次元の点の列)
+
+    点は(容量, 2)のfloat64のバッファの_head:_tailの部分に並べて持つ．
+    容量が足りなくなったら倍にして確保し直すので，appendは償却O(1)で済む．
+    reverseは向きのフラグを反転するだけで(O(1))，反転しているときのappendは
+    バッファの前側に書き込む．インデックスやnp.array(polyline)で見える順番は
+    以前のlistの派生クラスと同じ
+    """
+
+    __slots__ = ("_buf", "_head", "_tail", "_reversed")
+
     @staticmethod
     def _2Dcheck(value):
         if len(value) != 2:
             raise ValueError("Value must be 2-D.")
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, points=None):
+        self._buf = np.empty((0, 2), dtype=np.float64)
+        self._head = 0
+        self._tail = 0
+        self._reversed = False
+        if points is not None:
+            self.extend(points)
+
+    def get_points(self):
+        """
+        点を順番に並べた(点の数, 2)の配列(バッファのビュー)
+        """
+        points = self._buf[self._head:self._tail]
+        return points[::-1] if self._reversed else points
+    points = property(get_points)
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.points, dtype=dtype)
+
+    def __iter__(self):
+        return iter(self.points.copy())
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return Polyline(self.points[key])
+        return self.points[key].copy()
 
     def __setitem__(self, key, value):
-        self._2Dcheck(value)
-        value = np.array(value, np.float64)
-        super().__setitem__(key, value)
+        value = np.asarray(value, dtype=np.float64)
+        if value.shape[-1:] != (2,):
+            raise ValueError("Value must be 2-D.")
+        self.points[key] = value
 
     def __str__(self):
         s = ""
@@ -27,32 +71,99 @@ class Polyline(list):
         s = "[{}]".format(s[:-2])
         return s
 
+    def __repr__(self):
+        return "Polyline({})".format(self)
+
+    def __getstate__(self):
+        return (np.array(self.points),)
+
+    def __setstate__(self, state):
+        self.__init__(state[0])
+
+    def _reserve(self, n, front):
+        """
+        バッファの後ろ(frontなら前)にn点分の空きを作る
+        """
+        if front and self._head >= n or not front and len(self._buf) - self._tail >= n:
+            return
+        size = len(self)
+        capacity = max(2 * len(self._buf), size + n, MIN_CAPACITY)
+        buf = np.empty((capacity, 2), dtype=np.float64)
+        # 追加する側に空きを残す
+        head = capacity - size if front else 0
+        buf[head:head+size] = self._buf[self._head:self._tail]
+        self._buf = buf
+        self._head = head
+        self._tail = head + size
+
     def append(self, value):
         self._2Dcheck(value)
-        value = np.array(value, np.float64)
-        super().append(value)
+        if self._reversed:
+            self._reserve(1, front=True)
+            self._head -= 1
+            self._buf[self._head] = value
+        else:
+            self._reserve(1, front=False)
+            self._buf[self._tail] = value
+            self._tail += 1
 
     def extend(self, sequence):
-        for value in sequence:
-            self.append(value)
+        values = np.asarray(sequence, dtype=np.float64)
+        if values.size == 0:
+            return
+        if values.ndim != 2 or values.shape[1] != 2:
+            raise ValueError("Value must be 2-D.")
+        n = len(values)
+        if len(self) == 0 and len(self._buf) < n:
+            # 空の折れ線にまとめて追加するときはちょうどの大きさで確保する
+            self._buf = np.empty((n, 2), dtype=np.float64)
+            self._head = self._tail = n if self._reversed else 0
+        if self._reversed:
+            self._reserve(n, front=True)
+            self._head -= n
+            self._buf[self._head:self._head+n] = values[::-1]
+        else:
+            self._reserve(n, front=False)
+            self._buf[self._tail:self._tail+n] = values
+            self._tail += n
+
+    def reverse(self):
+        self._reversed = not self._reversed
+
+    def copy(self):
+        return Polyline(self.points)
 
     def length(self):
-        res = 0
-        n = len(self)
-        for i in range(n-1):
-            e = self[i+1] - self[i]
-            d = math.sqrt(np.dot(e, e))
-            res += d
+        if len(self) < 2:
+            return 0
+        d = np.diff(self.points, axis=0)
+        return float(np.hypot(d[:, 0], d[:, 1]).sum())
+
+    def simplify(self, tol, max_step=None):
+        """
+        Ramer-Douglas-Peucker法で点を間引いた折れ線を返す
+
+        Parameters
+        ----------
+        tol : float
+            間引いた折れ線と元の点の距離の上限(px)
+        max_step : float
+            指定すると，間引いた後の点の間隔がmax_step以下になるように
+            長い線分に等間隔に点を足す
+        """
+        res = Polyline()
+        if len(self) > 0:
+            res.extend(simplify_points(self.points, tol, max_step))
         return res
 
     def get_x_arr(self):
-        return np.array([p[0] for p in self])
+        return np.array(self.points[:, 0])
 
     def get_y_arr(self):
-        return np.array([p[1] for p in self])
+        return np.array(self.points[:, 1])
 
     def bspline(self, k=2):
-        c = np.array(self)
+        c = np.array(self.points)
         n = c.shape[0]
         if n <= k:
             msg = "The number of points must be more than {}."
@@ -63,8 +174,7 @@ class Polyline(list):
         return interpolate.BSpline(t, c, k, axis=0)
 
     def closed_bspline(self, epsilon=2, k=2):
-        pl = self._close_polyline(epsilon=epsilon)
-        c = np.array(pl)
+        c = self._close_polyline(epsilon=epsilon).points
         if np.any(c[0, :] != c[-1, :]):
             c = np.vstack((c, c[0, :]))
         c = np.vstack((c, c[1:k, :]))
@@ -79,14 +189,123 @@ class Polyline(list):
         """
         折れ線を閉じる
         """
-        res = self.copy()
-        r = self[-1] - self[0]
+        c = self.points
+        r = c[-1] - c[0]
         delta = math.sqrt(r[0] ** 2 + r[1] ** 2)
 
         if delta < epsilon:
-            res.append(self[0])
+            return Polyline(np.vstack((c, c[:1])))
         else:
-            tmp = res[:-1]
-            tmp.reverse()
-            res.extend(tmp)
-        return res
+            # 端まで行ったら同じ点を逆向きに辿って戻る
+            return Polyline(np.vstack((c, c[-2::-1])))
+
+
+def simplify_points(points, tol, max_step=None):
+    """
+    Ramer-Douglas-Peucker法で点列を間引く
+
+    両端を結ぶ線分から最も遠い点の距離がtolより大きければその点で分割する，
+    ということを繰り返す．同じ深さの区間はまとめてnumpyで処理するので，
+    Pythonのループは分割の深さの回数だけになる
+
+    Parameters
+    ----------
+    points : ndarray, shape (n, 2)
+    tol : float
+        間引いた点列と元の点の距離の上限
+    max_step : float
+        指定すると，間引いた後に点の間隔がmax_step以下になるように点を足す
+        (subdivide_points)
+
+    Returns
+    -------
+    ndarray, shape (m, 2)
+        残した点(両端は必ず残す)
+    """
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    if n > 2:
+        points = points[simplify_mask(points, np.array([0, n]), tol)]
+    if max_step is not None:
+        points, _ = subdivide_points(points, np.array([0, len(points)]), max_step)
+    return points.copy()
+
+
+def simplify_mask(points, offsets, tol):
+    """
+    points[offsets[j]:offsets[j+1]]をj番目の点列として，全ての点列を
+    まとめてRamer-Douglas-Peucker法で間引き，残す点をTrueにした配列を返す
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    keep = np.zeros(len(points), dtype=bool)
+    nonempty = offsets[1:] > offsets[:-1]
+    starts = offsets[:-1][nonempty]
+    ends = offsets[1:][nonempty] - 1
+    keep[starts] = keep[ends] = True
+    inner = ends - starts > 1
+    starts, ends = starts[inner], ends[inner]
+    while len(starts) > 0:
+        # 各区間の内側の点を1つの配列に並べる
+        sizes = ends - starts - 1
+        offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        seg = np.repeat(np.arange(len(starts)), sizes)
+        idx = np.arange(sizes.sum()) - offsets[seg] + starts[seg] + 1
+        a = points[starts][seg]
+        d = points[ends][seg] - a
+        q = points[idx] - a
+        # 線分(両端が同じ点なら点)への距離
+        dd = np.einsum("ij,ij->i", d, d)
+        s = np.einsum("ij,ij->i", q, d) / np.where(dd > 0, dd, 1)
+        np.clip(s, 0, 1, out=s)
+        dist = np.hypot(q[:, 0] - s * d[:, 0], q[:, 1] - s * d[:, 1])
+        # 各区間で最も遠い点(同じ距離なら先頭側)
+        dmax = np.maximum.reduceat(dist, offsets)
+        first = np.flatnonzero(dist == dmax[seg])
+        _, pos = np.unique(seg[first], return_index=True)
+        split = dmax > tol
+        mid = idx[first[pos]][split]
+        keep[mid] = True
+        # 分割した区間のうち内側に点があるものだけ次に調べる
+        starts, ends = (np.concatenate((starts[split], mid)),
+                        np.concatenate((mid, ends[split])))
+        inner = ends - starts > 1
+        starts, ends = starts[inner], ends[inner]
+    return keep
+
+
+def subdivide_points(points, offsets, max_step):
+    """
+    各点列の隣り合う点の間隔がmax_step以下になるように，長い線分を等分する点を足す
+
+    Bスプラインは点を制御点にするので，間引いて点の間隔が広くなると角で
+    曲線が大きく内側にずれる．間隔を抑えるとずれも抑えられる
+
+    Parameters
+    ----------
+    points : ndarray, shape (n, 2)
+    offsets : ndarray
+        points[offsets[j]:offsets[j+1]]がj番目の点列
+
+    Returns
+    -------
+    points : ndarray, shape (m, 2)
+    offsets : ndarray
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n = len(points)
+    # i番目の点とその次の点の間をcounts[i]等分する(各点列の最後の点は1)
+    counts = np.ones(n, dtype=np.int64)
+    last = np.zeros(n, dtype=bool)
+    last[offsets[1:][offsets[1:] > offsets[:-1]] - 1] = True
+    if n > 1:
+        steps = np.hypot(*(points[1:] - points[:-1]).T)
+        counts[:-1] = np.maximum(np.ceil(steps / max_step), 1)
+    counts[last] = 1
+    # 各点とそれに続く線分の内側の点を並べる
+    src = np.repeat(np.arange(n), counts)
+    starts = np.cumsum(counts) - counts
+    frac = (np.arange(len(src)) - starts[src]) / counts[src]
+    nxt = np.minimum(src + 1, n - 1)
+    res = points[src] + frac[:, None] * (points[nxt] - points[src])
+    new_offsets = np.concatenate(([0], np.cumsum(counts)))[offsets]
+    return res, new_offsets
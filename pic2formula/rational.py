@@ -0,0 +1,155 @@
+import math
+from fractions import Fraction
+
+import numpy as np
+import numba as nb
+
+
+# limit_denominatorが返せる分子の範囲
+INT64_MIN = int(np.iinfo(np.int64).min)
+INT64_MAX = int(np.iinfo(np.int64).max)
+
+
+def limit_denominator(arr, max_denominator):
+    """
+    配列の各要素を分母がmax_denominator以下の最も近い分数にする
+
+    Fraction(x).limit_denominator(max_denominator)と同じ結果を，Fractionを
+    作らずに分子・分母の整数配列として返す．
+
+    floatは x = N / 2^s (Nは整数)と表せるので，2^sが64bit整数に収まるときは
+    limit_denominatorと同じ連分数展開を整数のまま行う．2^sが収まらないほど
+    |x|が小さいときは，答えが 0 か ±1/max_denominator のどちらかになることを
+    使って決める．どちらでも決められない要素だけFractionで計算する
+
+    Returns
+    -------
+    num, den : ndarray of int64
+        arrと同じshapeの分子と分母
+
+    Raises
+    ------
+    ValueError
+        arrにinfやnanがあるとき，または分子がint64に収まらないほど|x|が大きいとき
+    """
+    if max_denominator < 1:
+        raise ValueError("max_denominator should be at least 1")
+    x = np.ascontiguousarray(arr, dtype=np.float64)
+    if not np.isfinite(x).all():
+        raise ValueError("arr must not contain inf or nan")
+    shape = x.shape
+    x = x.ravel()
+    num = np.empty(len(x), dtype=np.int64)
+    den = np.empty(len(x), dtype=np.int64)
+    ok = np.empty(len(x), dtype=np.bool_)
+    _limit_denominator(x, int(max_denominator), num, den, ok)
+    for ii in np.flatnonzero(~ok):
+        frac = Fraction(x[ii]).limit_denominator(max_denominator)
+        if not INT64_MIN <= frac.numerator <= INT64_MAX:
+            raise ValueError("{!r} is too large for an int64 numerator".format(float(x[ii])))
+        num[ii] = frac.numerator
+        den[ii] = frac.denominator
+    return num.reshape(shape), den.reshape(shape)
+
+
+def coefficients2fractions(arr, offsets, max_denominator):
+    """
+    offsetsで区切られた各曲線の係数を分数にする
+
+    FourierSeriesFraction._ndarray2fractionsと同じく，各曲線の最初の項(定数項)は
+    振幅を半分にして使うので分母の最大値もint(max_denominator/2)にする
+    """
+    arr = np.asarray(arr, dtype=np.float64)
+    starts = np.asarray(offsets, dtype=np.int64)[:-1]
+    num, den = limit_denominator(arr, max_denominator)
+    num0, den0 = limit_denominator(arr[starts], int(max_denominator/2))
+    num[starts] = num0
+    den[starts] = den0
+    return num, den
+
+
+def ratios2ndarray(num, den):
+    """
+    分子・分母の配列をfloatの配列にする(float(Fraction(num, den))と同じ値)
+    """
+    num = np.asarray(num, dtype=np.int64)
+    den = np.asarray(den, dtype=np.int64)
+    res = num / den
+    # 2^53を超える整数はfloatに変換するときに丸められるので，Pythonの整数で割る
+    for ii in np.flatnonzero((np.abs(num) > 2 ** 53) | (den > 2 ** 53)):
+        res.flat[ii] = int(num.flat[ii]) / int(den.flat[ii])
+    return res
+
+
+def ratios2fractions(num, den):
+    """
+    分子・分母の配列をFractionのリストにする
+    """
+    return [Fraction(int(n), int(d)) for n, d in zip(num, den)]
+
+
+@nb.jit(nopython=True, cache=True)
+def _limit_denominator(x, maxd, num, den, ok):
+    TWO53 = 2.0 ** 53
+    for ii in range(len(x)):
+        xi = x[ii]
+        ok[ii] = True
+        if xi == 0:
+            num[ii] = 0
+            den[ii] = 1
+            continue
+        if not math.isfinite(xi) or abs(xi) * maxd >= 2.0 ** 62:
+            ok[ii] = False
+            continue
+        m, e = math.frexp(xi)
+        N = np.int64(m * TWO53)  # xi = N / 2^s
+        s = 53 - e
+        if s <= 0:
+            # 整数
+            num[ii] = np.int64(xi)
+            den[ii] = 1
+            continue
+        # 既約分数にする
+        while s > 0 and N % 2 == 0:
+            N //= 2
+            s -= 1
+        if s > 62:
+            # |xi| < 2^-9 なので，|xi| <= 1/(maxd+1) なら答えは 0 か ±1/maxd で，
+            # |xi| <= 1/(2maxd) なら 0 になる
+            a = abs(xi) * (maxd + 1)
+            b = abs(xi) * (2 * maxd)
+            if a > 1 - 1e-12 or abs(b - 1) < 1e-12:
+                ok[ii] = False
+            elif b <= 1:
+                num[ii] = 0
+                den[ii] = 1
+            else:
+                num[ii] = 1 if xi > 0 else -1
+                den[ii] = maxd
+            continue
+        D = np.int64(1) << s
+        if D <= maxd:
+            num[ii] = N
+            den[ii] = D
+            continue
+
+        # Fraction.limit_denominatorと同じ連分数展開
+        p0, q0, p1, q1 = 0, 1, 1, 0
+        n, d = N, D
+        while True:
+            a = n // d
+            # q0 + a*q1 > maxd を桁あふれしないように判定する
+            if q1 > 0 and a > (maxd - q0) // q1:
+                break
+            q2 = q0 + a * q1
+            p0, q0, p1, q1 = p1, q1, p0 + a * p1, q2
+            n, d = d, n - a * d
+        k = (maxd - q0) // q1
+        q = q0 + k * q1
+        # |p1/q1 - x| <= |(p0+k*p1)/q - x| は 2*d*q <= D と同値
+        if d <= (D // 2) // q:
+            num[ii] = p1
+            den[ii] = q1
+        else:
+            num[ii] = p0 + k * p1
+            den[ii] = q
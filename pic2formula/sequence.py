@@ -0,0 +1,139 @@
+import math
+
+import cv2
+import numpy as np
+
+from .cache import pack_polylines
+from .detect_edge import auto_threshold, prepare_image
+from .generate import TRACERS, iter_fourier_series
+from .pic_formula import PicFormula
+from .stats import Stats
+
+
+def iter_video_frames(path):
+    """
+    動画ファイルのフレームを順に返す
+
+    Yields
+    ------
+    frame : ndarray
+        BGRの画像
+    """
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise FileNotFoundError("could not open a video: {}".format(path))
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        cap.release()
+
+
+def iter_sequence(frames, n, e=6, k=4, ml=10, method="greedy", threshold=None,
+                  auto="median", blur=0, scale=None, workers=None, pool="process",
+                  stats=None, degree_tol=None, simplify_tol=None, reuse=True):
+    """
+    連続したフレームを順に数式に変換し，フレームごとに[x_picf, y_picf]をyieldする
+
+    各フレームのエッジ検出結果を前のフレームと比べ，変化した画素からe以内に
+    点が無い折れ線はそのまま使い，その曲線もFourierSeriesのオブジェクトごと
+    引き継ぐ．残りのエッジ画素だけを折れ線に変換し直す．折れ線を辿るときは
+    距離e以内の点をつなぐので，引き継いだ折れ線は変化した画素の影響を受けない．
+    動かない部分の曲線が変わらないので，フレームごとに最初から変換するよりも
+    速く，ちらつきも少ない
+
+    しきい値を指定しないときは最初のフレームから決め，全てのフレームで同じ
+    しきい値を使う．曲線は引き継いだものを前のフレームと同じ順番で並べ，
+    その後に新しく変換したものを短い順に並べる
+
+    Parameters
+    ----------
+    frames : iterable of str or ndarray
+        各フレームの画像へのパスまたは画像
+    n, e, k, ml, method, threshold, auto, blur, scale, workers, pool, degree_tol, simplify_tol
+        generateと同じ
+    stats : Stats
+        全てのフレームの合計を記録する．frames, changed_pixels(前のフレームから
+        変化したエッジ画素の数)，polylines_reused(引き継いだ折れ線の数)を加える
+    reuse : bool
+        Falseなら前のフレームの結果を使わずにフレームごとに最初から変換する
+
+    Yields
+    ------
+    [x_picf, y_picf] : list of PicFormula
+    """
+    if stats is None:
+        stats = Stats()
+    if method not in TRACERS:
+        raise ValueError("method must be one of {}.".format(list(TRACERS)))
+    ml = max(ml, k+1)
+    # 変化した画素からe以内を辿り直す範囲にする
+    radius = int(math.ceil(e))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+    prev_edges = None
+    lines = []  # 前のフレームの全ての折れ線(mlより短いものも含む)
+    curves = []  # linesの各折れ線の(x_fs, y_fs)(mlより短いものはNone)
+    for frame in frames:
+        with stats.stage("detect_edge"):
+            img = prepare_image(frame, blur=blur, scale=scale)
+            if threshold is None:
+                threshold = auto_threshold(img, method=auto)
+            edges = cv2.Canny(img, threshold[0], threshold[1], L2gradient=True)
+            stats.count("edge_pixels", np.count_nonzero(edges == 255))
+
+        with stats.stage("diff"):
+            keep = np.zeros(len(lines), dtype=bool)
+            if reuse and prev_edges is not None and prev_edges.shape == edges.shape:
+                changed = (edges != prev_edges).view(np.uint8)
+                stats.count("changed_pixels", np.count_nonzero(changed))
+                dirty = cv2.dilate(changed, kernel)
+                keep = ~_touched(lines, dirty)
+            lines = [line for line, flag in zip(lines, keep) if flag]
+            curves = [curve for curve, flag in zip(curves, keep) if flag]
+            stats.count("polylines_reused", len(lines))
+            # 引き継いだ折れ線の点を除いたエッジ画素だけを辿る
+            remaining = edges.copy()
+            if lines:
+                points = np.rint(pack_polylines(lines)["points"]).astype(np.int64)
+                remaining[-points[:, 1], points[:, 0]] = 0
+        prev_edges = edges
+
+        traced = []
+        new_curves = {}
+
+        def trace():
+            for line in TRACERS[method](remaining, e, stats=stats):
+                traced.append(line)
+                yield line
+
+        for polyline, x_fs, y_fs in iter_fourier_series(
+                trace(), n, k, ml, workers=workers, pool=pool, stats=stats,
+                degree_tol=degree_tol, simplify_tol=simplify_tol):
+            new_curves[id(polyline)] = (x_fs, y_fs)
+        traced.sort(key=lambda line: line.length())
+        lines += traced
+        curves += [new_curves.get(id(line)) for line in traced]
+        stats.count("frames")
+
+        x_fs_lst = [curve[0] for curve in curves if curve is not None]
+        y_fs_lst = [curve[1] for curve in curves if curve is not None]
+        stats.count("terms", sum(fs.n + 1 for fs in x_fs_lst))
+        yield [PicFormula(x_fs_lst), PicFormula(y_fs_lst)]
+
+
+def _touched(lines, mask):
+    """
+    各折れ線がmaskの0でない画素に点を持つか
+    """
+    if not lines:
+        return np.zeros(0, dtype=bool)
+    arrays = pack_polylines(lines)
+    points = np.rint(arrays["points"]).astype(np.int64)
+    hit = mask[-points[:, 1], points[:, 0]] != 0
+    # 折れ線ごとの数
+    count = np.concatenate(([0], np.cumsum(hit)))
+    offsets = arrays["offsets"]
+    return count[offsets[1:]] > count[offsets[:-1]]
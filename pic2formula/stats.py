@@ -0,0 +1,93 @@
+import contextlib
+import time
+
+
+class Stats:
+    """
+    generateの各段階の時間とカウンタを集める
+
+    stagesは段階の名前から{"wall": 経過時間(s), "cpu": このプロセスのCPU時間(s)}
+    への辞書，countersはカウンタの名前から値への辞書．
+    progressを指定すると，各段階の進捗がprogress(stage, done, total)で通知される
+
+    カウンタ
+    --------
+    edge_pixels : エッジの画素数
+    polylines : 折れ線の数
+    polylines_filtered : 短い折れ線を除いた後の折れ線の数
+    points, points_simplified : 間引く前/後の折れ線の点の数の合計(simplify_tolを指定したときのみ)
+    neighbor_lookups : 折れ線を辿るときに調べた近傍の画素の数(greedyのみ)
+    cost_evaluations : 目的関数を計算した回数(greedyのみ)
+    reversals : 折れ線を反転して反対側の端から辿り直した回数(greedyのみ)
+    tiles, seam_pixels, stitches : タイルの数，境界の近くで辿り直した点の数，辿り直さずに
+        端点をつないだ回数(tile_sizeを指定したときのみ)
+    fft_samples : FFTしたBスプラインのサンプル数の合計(x, yで1つと数える)
+    terms : 全ての曲線の項の数の合計(x, yで1つと数える)
+    cache_hits, cache_misses : キャッシュから読み込めた/読み込めなかった段階の数
+    """
+
+    def __init__(self, progress=None):
+        self.stages = {}
+        self.counters = {}
+        self.progress = progress
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        with文の中の時間を段階nameの時間に加える
+        """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield self
+        finally:
+            times = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+            times["wall"] += time.perf_counter() - wall
+            times["cpu"] += time.process_time() - cpu
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def report(self, stage, done, total):
+        if self.progress is not None:
+            self.progress(stage, done, total)
+
+    def merge(self, other):
+        """
+        別のStats(ワーカーで集めたものなど)のカウンタと時間を加える
+        """
+        for name, value in other.counters.items():
+            self.count(name, value)
+        for name, times in other.stages.items():
+            mine = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+            mine["wall"] += times["wall"]
+            mine["cpu"] += times["cpu"]
+
+    def as_dict(self):
+        return {"stages": {name: dict(times) for name, times in self.stages.items()},
+                "counters": dict(self.counters)}
+
+    def __getstate__(self):
+        # progressはpickleできるとは限らないのでワーカーには渡さない
+        state = self.__dict__.copy()
+        state["progress"] = None
+        return state
+
+    def __str__(self):
+        lines = ["{:<24s} {:>10s} {:>10s}".format("stage", "wall[s]", "cpu[s]")]
+        for name, times in self.stages.items():
+            lines.append("{:<24s} {:10.3f} {:10.3f}".format(name, times["wall"], times["cpu"]))
+        for name, value in self.counters.items():
+            lines.append("{:<24s} {:>21d}".format(name, value))
+        return "\n".join(lines)
+
+
+def print_progress(stage, done, total):
+    """
+    進捗をコンソールに表示するprogress(generateのデフォルト)
+    """
+    if stage == "edges2polylines":
+        # 以前のedges2polylinesと同じ表示
+        print("converting pointlist to lines ... {} / {}\r".format(done, total), end="")
+        if done == total:
+            print()
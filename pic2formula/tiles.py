@@ -0,0 +1,390 @@
+import collections
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from .cache import pack_polylines
+from .detect_edge import auto_threshold, prepare_image
+from .generate import TRACERS
+from .polyline import Polyline
+from .stats import Stats
+
+
+# タイルの大きさ(px)
+DEFAULT_TILE_SIZE = 2048
+# エッジ検出のときにタイルの外側に余分に読む幅(px)
+DEFAULT_OVERLAP = 32
+
+
+def trace_tiles(src, e=6, method="greedy", tile_size=DEFAULT_TILE_SIZE,
+                overlap=DEFAULT_OVERLAP, workers=None, threshold=None, auto="median",
+                blur=0, scale=None, stats=None):
+    """
+    iter_trace_tilesの結果のリスト
+
+    Returns
+    -------
+    line_bag : list of Polyline
+    """
+    return list(iter_trace_tiles(src, e, method, tile_size, overlap, workers,
+                                 threshold, auto, blur, scale, stats))
+
+
+def iter_trace_tiles(src, e=6, method="greedy", tile_size=DEFAULT_TILE_SIZE,
+                     overlap=DEFAULT_OVERLAP, workers=None, threshold=None, auto="median",
+                     blur=0, scale=None, stats=None):
+    """
+    大きな画像をタイルに分けてエッジ検出と折れ線への変換を行う
+
+    画像全体のエッジ検出結果は作らず，各タイルで周りにoverlapだけ広げた範囲を
+    Canny法にかけてタイルの内側だけを折れ線に変換する．detect_edge_headlessと
+    同じ前処理(prepare_image)を画像全体にかけ，しきい値も画像全体で決めるので，
+    エッジはoverlapより遠くまで続くヒステリシスの連結を除いて分割しない場合と
+    同じになる．タイルの境界からe以内に点がある折れ線と，それと端点で
+    つながっている同じタイルの折れ線は，全てのタイルが終わった後でその点を
+    まとめて辿り直す(retrace_seams)．一度に辿り直す範囲は2 * tile_size四方までに
+    する．それ以外の折れ線はタイルが終わるごとにyieldする
+
+    workersが2以上ならタイルをプロセスプールで並列に処理する．画像は一時ファイルに
+    書いてワーカーからはメモリマップで読むので，ワーカーのメモリはタイルの大きさで決まる
+
+    Parameters
+    ----------
+    src : str or ndarray
+        画像へのパスまたは画像
+    e : int or float
+        同一の折れ線とみなす点間の最大距離(px)
+    method : str
+        エッジを折れ線に変換する方法("greedy" or "graph")
+    tile_size : int
+        タイルの大きさ(px)
+    overlap : int
+        エッジ検出のときにタイルの外側に余分に読む幅(px)
+    workers : int
+        並列に処理するプロセスの数(Noneなら並列化しない)
+    threshold, auto, blur, scale
+        detect_edge_headlessと同じ
+    stats : Stats
+        edge_pixels, tiles, seam_pixels, stitchesと折れ線への変換のカウンタを加える．
+        時間は呼び出し側で測る(generateではedges2polylinesの時間になる)
+
+    Yields
+    ------
+    line : Polyline
+    """
+    if stats is None:
+        stats = Stats()
+    if method not in TRACERS:
+        raise ValueError("method must be one of {}.".format(list(TRACERS)))
+    img = prepare_image(src, blur=blur, scale=scale)
+    if threshold is None:
+        threshold = auto_threshold(img, method=auto)
+    threshold = [int(v) for v in threshold]
+    h, w = img.shape[:2]
+    boxes = [(y0, min(y0 + tile_size, h), x0, min(x0 + tile_size, w))
+             for y0 in range(0, h, tile_size) for x0 in range(0, w, tile_size)]
+    stats.count("tiles", len(boxes))
+
+    tmpdir = None
+    executor = None
+    try:
+        if workers and workers > 1 and len(boxes) > 1:
+            # ワーカーにはファイルの名前だけを渡す
+            tmpdir = tempfile.mkdtemp(prefix="pic2formula-tiles-")
+            source = os.path.join(tmpdir, "image.npy")
+            mm = np.lib.format.open_memmap(source, mode="w+", dtype=img.dtype, shape=img.shape)
+            mm[:] = img
+            mm.flush()
+            del mm, img
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = _map_bounded(executor, 2 * workers, _trace_tile, [
+                (source, box, overlap, threshold, e, method) for box in boxes])
+        else:
+            source = img
+            results = (_trace_tile(source, box, overlap, threshold, e, method)
+                       for box in boxes)
+
+        # 境界の近くに点がある折れ線は最後に辿り直す
+        seam_lines = []
+        done = 0
+        for tile_index, (arrays, tile_stats) in enumerate(results):
+            stats.merge(tile_stats)
+            points, offsets = arrays["points"], arrays["offsets"]
+            near = _near_seam(points, offsets, boxes[tile_index], h, w, e)
+            if near.any():
+                # 境界の近くの折れ線と端点でつながる折れ線も辿り直す
+                piece_src, piece_dst = _adjacent_pieces(points, offsets, e)
+                near[piece_dst[near[piece_src]]] = True
+                near[piece_src[near[piece_dst]]] = True
+            for ii, (a, b) in enumerate(zip(offsets[:-1], offsets[1:])):
+                if near[ii]:
+                    seam_lines.append(points[a:b])
+                else:
+                    yield Polyline(points[a:b])
+            done += 1
+            stats.report("tiles", done, len(boxes))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    yield from retrace_seams(seam_lines, e, method, tile_size, stats)
+
+
+def retrace_seams(lines, e, method="greedy", tile_size=None, stats=None):
+    """
+    タイルの境界の近くの折れ線の点をまとめて折れ線に変換し直す
+
+    端点が他の折れ線の点からe以内にある折れ線を(間接的なものも含めて)1つの組にし，
+    組ごとにその点だけを描いた外接矩形の大きさのエッジ画像を作って辿り直す．
+    境界をまたぐ曲線も，分割しない場合と同じように両側の点から1本の折れ線になる．
+    外接矩形の縦か横が2 * tile_sizeより大きい組(いくつもの境界をまたいで
+    つながるエッジなど)は，タイルの角を中心とするtile_size四方のセルに折れ線を
+    始点で分けてセルごとに辿り直し，セルの間は端点をつなぐ(stitch_polylines)．
+    各折れ線は1つのタイルの内側にあるので，作る画像は2 * tile_size四方までになる
+
+    Parameters
+    ----------
+    lines : list of ndarray
+        各タイルで辿った折れ線の点(画像全体のplotの座標系)
+    e : int or float
+        同一の折れ線とみなす点間の最大距離(px)
+    method : str
+        エッジを折れ線に変換する方法("greedy" or "graph")
+    tile_size : int
+        タイルの大きさ(px)．Noneなら組を分けない
+    stats : Stats
+        seam_pixels(辿り直した点の数)，stitches(セルの間でつないだ回数)と
+        折れ線への変換のカウンタを加える
+
+    Yields
+    ------
+    line : Polyline
+    """
+    if stats is None:
+        stats = Stats()
+    if not lines:
+        return
+    points = np.rint(np.concatenate(lines)).astype(np.int64)
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(line) for line in lines])
+    stats.count("seam_pixels", len(points))
+    a, b = _adjacent_pieces(points, offsets, e)
+    graph = coo_matrix((np.ones(len(a), dtype=np.int8), (a, b)),
+                       shape=(len(lines), len(lines)))
+    _, group = connected_components(graph, directed=False)
+
+    order = np.argsort(group, kind="stable")
+    bounds = np.flatnonzero(np.diff(group[order])) + 1
+    for pieces in np.split(order, bounds):
+        pts = np.concatenate([points[offsets[ii]:offsets[ii+1]] for ii in pieces])
+        if tile_size is None or (pts.max(axis=0) - pts.min(axis=0)).max() < 2 * tile_size:
+            for line in _retrace(pts, e, method, stats):
+                yield Polyline(line)
+            continue
+        # (列, 行)からタイルの角を中心とするセルの番号を決める
+        starts = points[offsets[pieces]] * [1, -1]
+        _, cell = np.unique((starts + tile_size // 2) // tile_size, axis=0,
+                            return_inverse=True)
+        cell = cell.ravel()
+        retraced = []
+        labels = []
+        for label in range(cell.max() + 1):
+            cell_pts = np.concatenate([points[offsets[ii]:offsets[ii+1]]
+                                       for ii in pieces[cell == label]])
+            for line in _retrace(cell_pts, e, method, stats):
+                retraced.append(line)
+                labels.append(label)
+        stitched, n_stitches = stitch_polylines(retraced, labels, e)
+        stats.count("stitches", n_stitches)
+        for line in stitched:
+            yield Polyline(line)
+
+
+def _retrace(points, e, method, stats):
+    """
+    点(画像全体のplotの座標系の整数)だけを描いた外接矩形の大きさのエッジ画像を辿り直す
+    """
+    cols = points[:, 0]
+    rows = -points[:, 1]
+    c0, r0 = cols.min(), rows.min()
+    window = np.zeros((rows.max() - r0 + 1, cols.max() - c0 + 1), dtype=np.uint8)
+    window[rows - r0, cols - c0] = 255
+    for line in TRACERS[method](window, e, stats=stats):
+        # 窓の座標系から画像全体の座標系へ
+        arr = np.asarray(line, dtype=np.float64)
+        arr[:, 0] += c0
+        arr[:, 1] -= r0
+        yield arr
+
+
+def stitch_polylines(lines, labels, e):
+    """
+    ラベルの異なる折れ線の端点同士がe以内なら，近い組から順につなぐ
+
+    1つの端点は1回しかつながず，つなぐと輪になる組はつながない
+
+    Parameters
+    ----------
+    lines : list of ndarray
+        折れ線の点
+    labels : list of int
+        各折れ線のラベル(同じラベルの折れ線同士はつながない)
+    e : int or float
+        つなぐ端点間の最大距離
+
+    Returns
+    -------
+    lines : list of ndarray
+        つないだ折れ線(つながなかったものもそのまま含む)
+    n_stitches : int
+        つないだ回数
+    """
+    num = len(lines)
+    if num == 0:
+        return [], 0
+    # 端点2k, 2k+1はk番目の折れ線の始点と終点
+    ends = np.array([[line[0], line[-1]] for line in lines]).reshape(-1, 2)
+    end_labels = np.repeat(np.asarray(labels), 2)
+    pairs = cKDTree(ends).query_pairs(e, output_type="ndarray")
+    pairs = pairs[(end_labels[pairs[:, 0]] != end_labels[pairs[:, 1]])
+                  & (pairs[:, 0] // 2 != pairs[:, 1] // 2)]
+    d = np.hypot(*(ends[pairs[:, 0]] - ends[pairs[:, 1]]).T)
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0], d))]
+
+    link = np.full(2 * num, -1, dtype=np.int64)  # 端点がつながる相手の端点
+    parent = np.arange(num)
+
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    n_stitches = 0
+    for a, b in pairs:
+        if link[a] >= 0 or link[b] >= 0:
+            continue
+        ra, rb = find(a // 2), find(b // 2)
+        if ra == rb:
+            continue
+        parent[ra] = rb
+        link[a] = b
+        link[b] = a
+        n_stitches += 1
+
+    # つながっていない端点から順に辿る
+    res = []
+    visited = np.zeros(num, dtype=bool)
+    for start in range(2 * num):
+        if visited[start // 2] or link[start] >= 0:
+            continue
+        parts = []
+        end = start
+        while True:
+            k = end // 2
+            visited[k] = True
+            # endから入って反対側の端点から出る
+            parts.append(lines[k] if end % 2 == 0 else lines[k][::-1])
+            end = link[end ^ 1]
+            if end < 0:
+                break
+        res.append(np.concatenate(parts))
+    return res, n_stitches
+
+
+def _trace_tile(source, box, overlap, threshold, e, method):
+    """
+    1つのタイルのエッジを検出して折れ線に変換する(ワーカーで実行する)
+
+    Returns
+    -------
+    arrays : dict
+        画像全体の座標系(plotの座標系)の折れ線をpack_polylinesでまとめたもの
+    stats : Stats
+    """
+    if isinstance(source, str):
+        source = np.load(source, mmap_mode="r")
+    h, w = source.shape[:2]
+    y0, y1, x0, x1 = box
+    ya, yb = max(y0 - overlap, 0), min(y1 + overlap, h)
+    xa, xb = max(x0 - overlap, 0), min(x1 + overlap, w)
+    window = np.ascontiguousarray(source[ya:yb, xa:xb])
+    edges = cv2.Canny(window, threshold[0], threshold[1], L2gradient=True)
+    # タイルの内側だけを使う
+    edges = np.ascontiguousarray(edges[y0-ya:y1-ya, x0-xa:x1-xa])
+    stats = Stats()
+    stats.count("edge_pixels", np.count_nonzero(edges == 255))
+    lines = list(TRACERS[method](edges, e, stats=stats))
+    arrays = pack_polylines(lines)
+    # plotの座標系は(列, -行)
+    arrays["points"][:, 0] += x0
+    arrays["points"][:, 1] -= y0
+    return arrays, stats
+
+
+def _near_seam(points, offsets, box, h, w, e):
+    """
+    各折れ線が隣のタイルとの境界からe以内に点を持つか
+    """
+    y0, y1, x0, x1 = box
+    num = len(offsets) - 1
+    if num == 0:
+        return np.zeros(0, dtype=bool)
+    cols = points[:, 0]
+    rows = -points[:, 1]
+    near = np.zeros(len(points), dtype=bool)
+    if x0 > 0:
+        near |= cols - x0 < e
+    if x1 < w:
+        near |= x1 - 1 - cols < e
+    if y0 > 0:
+        near |= rows - y0 < e
+    if y1 < h:
+        near |= y1 - 1 - rows < e
+    # 折れ線ごとの数
+    count = np.concatenate(([0], np.cumsum(near)))
+    return count[offsets[1:]] > count[offsets[:-1]]
+
+
+def _adjacent_pieces(points, offsets, e):
+    """
+    端点が他の折れ線の点からe以内にある折れ線の組
+
+    折れ線は端からしか伸ばさないので，辿り直したときにつながりうるのはこの組だけ
+
+    Returns
+    -------
+    a, b : ndarray
+        a[i]番目の折れ線の端点がb[i]番目の折れ線の点からe以内にある
+    """
+    num = len(offsets) - 1
+    if num == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    piece = np.repeat(np.arange(num), np.diff(offsets))
+    ends = np.concatenate((offsets[:-1], offsets[1:] - 1))
+    hits = cKDTree(points).query_ball_point(points[ends], e, return_sorted=False)
+    sizes = np.array([len(hit) for hit in hits])
+    a = np.repeat(piece[ends], sizes)
+    b = piece[np.concatenate(hits).astype(np.int64)] if len(a) else a
+    other = a != b
+    return a[other], b[other]
+
+
+def _map_bounded(executor, max_pending, fun, args_lst):
+    # 投入した順に結果を返し，結果を待っているものはmax_pending個までにする
+    pending = collections.deque()
+    for args in args_lst:
+        pending.append(executor.submit(fun, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
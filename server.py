@@ -0,0 +1,440 @@
+import asyncio
+import collections
+import io
+import json
+import os
+import signal
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import cv2
+import numpy as np
+
+import pic2formula
+from main import write_tex, write_desmos
+
+# クエリで指定できる変換のパラメータ: 名前 -> (型, デフォルト)
+# デフォルトはmain.pyと同じ
+PARAMS = {
+    "n": (int, 500),
+    "e": (int, 6),
+    "k": (int, 4),
+    "ml": (int, 6),
+    "maxd": (int, 100),
+    "method": (str, "greedy"),
+    "auto": (str, "median"),
+    "blur": (int, 0),
+    "scale": (float, None),
+    "tol": (float, None),
+    "simplify": (float, None),
+    "showmax": (int, 20),
+}
+# 受け付けるリクエストの本文の大きさの上限(MB)
+DEFAULT_MAX_BODY = 64
+# keep-aliveの接続で次のリクエストを待つ時間(s)
+IDLE_TIMEOUT = 60
+# レイテンシの統計に使う直近のリクエストの数
+LATENCY_WINDOW = 1000
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           411: "Length Required", 413: "Payload Too Large", 422: "Unprocessable Entity",
+           500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+def main():
+    args = get_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="convert images to formulas over HTTP "
+                    "(POST /convert, GET /stats, GET /health)")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="host to listen on[127.0.0.1]")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="port to listen on[8765]")
+    parser.add_argument("--unix", type=str, default=None,
+                        help="listen on a Unix socket instead of TCP")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes[cpu count]")
+    parser.add_argument("--queue", type=int, default=None,
+                        help="number of requests waiting for a worker before "
+                             "responding 503[2 * workers]")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="timeout of a request in seconds, including the wait[60]")
+    parser.add_argument("--max-body", type=int, default=DEFAULT_MAX_BODY,
+                        help="maximum size of an image in MB[{}]".format(DEFAULT_MAX_BODY))
+    args = parser.parse_args()
+    return args
+
+
+async def serve(args):
+    server = ConversionServer(args.workers, args.queue, args.timeout,
+                              args.max_body * 2 ** 20)
+    await server.start()
+    if args.unix:
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix)
+        address = args.unix
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port)
+        address = "http://{}:{}".format(args.host, args.port)
+    print("listening on {} ({} workers, queue {})".format(
+          address, server.workers, server.queue_size), flush=True)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with listener:
+        await stop.wait()
+    server.close()
+    if args.unix and os.path.exists(args.unix):
+        os.remove(args.unix)
+    print(json.dumps(server.get_stats(), indent=2))
+
+
+class RequestError(Exception):
+    """
+    クライアントに返すエラー(ステータスコードとメッセージ)
+    """
+
+    def __init__(self, status, message):
+        super().__init__(status, message)
+        self.status = status
+        self.message = message
+
+
+class ConversionServer:
+    """
+    画像を数式に変換するHTTPサーバー
+
+    変換は起動時に温めておいたプロセスプールで行う．ワーカーで実行中のものと
+    空きを待っているものを合わせてworkers + queue_sizeを超えるリクエストは
+    すぐに503で断る(バックプレッシャー)．待ち時間を含めてtimeoutを超えた
+    リクエストには504を返す．実行中の変換は止められないので，ワーカーの枠は
+    変換が終わるまで空かない
+
+    エンドポイント
+    --------------
+    POST /convert?n=500&e=6&k=4&ml=6&maxd=100&threshold=MIN,MAX&format=json&latex=1&desmos=1
+        本文は画像ファイルのバイト列．formatが"json"なら係数(とlatex, desmosの
+        テキスト)をJSONで，"picf"ならpicfファイルのバイト列を返す
+    GET /stats
+        リクエスト数とレイテンシのパーセンタイル(ms)
+    GET /health
+    """
+
+    def __init__(self, workers=None, queue_size=None, timeout=60,
+                 max_body=DEFAULT_MAX_BODY * 2 ** 20):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = 2 * self.workers if queue_size is None else queue_size
+        self.timeout = timeout
+        self.max_body = max_body
+        self.executor = None
+        self.slots = None
+        # 受け付けて，まだワーカーでの変換が終わっていないリクエストの数
+        self.pending = 0
+        self.status_counts = collections.Counter()
+        self.latencies = {name: collections.deque(maxlen=LATENCY_WINDOW)
+                          for name in ("total", "queue", "service")}
+
+    async def start(self):
+        """
+        プロセスプールを起動し，全てのワーカーで初期化(numbaのコンパイルなど)を済ませる
+        """
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                            initializer=init_worker)
+        self.slots = asyncio.Semaphore(self.workers)
+        loop = asyncio.get_running_loop()
+        # 同時に投入するとワーカーの数だけプロセスが起動する
+        await asyncio.gather(*[loop.run_in_executor(self.executor, ping)
+                               for _ in range(self.workers)])
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def handle(self, reader, writer):
+        """
+        1つの接続のリクエストを順に処理する(keep-alive)
+        """
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not line:
+                    break
+                keep_alive = await self._handle_request(line, reader, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, line, reader, writer):
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            _write_response(writer, 400, _error_body("malformed request line"), False)
+            return False
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            _write_response(writer, 411, _error_body("Content-Length is required"), False)
+            return False
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            _write_response(writer, 400, _error_body("invalid Content-Length"), False)
+            return False
+        if length > self.max_body:
+            # 本文を読まずに接続を閉じる
+            _write_response(writer, 413, _error_body(
+                "image is larger than {} bytes".format(self.max_body)), False)
+            return False
+        body = await reader.readexactly(length)
+
+        url = urlsplit(target)
+        status, ctype, payload, extra = await self.dispatch(method, url.path, url.query, body)
+        _write_response(writer, status, payload, keep_alive, ctype, extra)
+        return keep_alive
+
+    async def dispatch(self, method, path, query, body):
+        """
+        Returns
+        -------
+        (status, content_type, payload, extra_headers)
+        """
+        routes = {"/convert": ("POST", self.convert),
+                  "/stats": ("GET", self.stats_response),
+                  "/health": ("GET", self.health_response)}
+        if path not in routes:
+            return 404, "application/json", _error_body("not found"), {}
+        allowed, fun = routes[path]
+        if method != allowed:
+            return 405, "application/json", _error_body("use " + allowed), {"Allow": allowed}
+        return await fun(query, body)
+
+    async def health_response(self, query, body):
+        return 200, "application/json", _json_bytes({"ok": True}), {}
+
+    async def stats_response(self, query, body):
+        return 200, "application/json", _json_bytes(self.get_stats()), {}
+
+    async def convert(self, query, body):
+        start = time.perf_counter()
+        try:
+            params = parse_params(query)
+            if not body:
+                raise RequestError(400, "the body must be an image")
+        except RequestError as exc:
+            return self._finish(start, exc.status, _error_body(exc.message))
+
+        # 実行中と待っているものが上限に達していたら断る
+        if self.pending >= self.workers + self.queue_size:
+            return self._finish(start, 503, _error_body("server is busy"), {"Retry-After": "1"})
+        self.pending += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.pending -= 1
+            return self._finish(start, 504, _error_body("timed out waiting for a worker"))
+        queued = time.perf_counter()
+        self.latencies["queue"].append(queued - start)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, convert, body, params)
+
+        def done(_):
+            # タイムアウトした後もワーカーが変換を終えるまで枠は空けない
+            self.pending -= 1
+            self.slots.release()
+        future.add_done_callback(done)
+        try:
+            ctype, payload = await asyncio.wait_for(
+                asyncio.shield(future), self.timeout - (queued - start))
+        except asyncio.TimeoutError:
+            return self._finish(start, 504, _error_body("timed out"))
+        except RequestError as exc:
+            return self._finish(start, exc.status, _error_body(exc.message))
+        except Exception as exc:
+            return self._finish(start, 500, _error_body("{}: {}".format(type(exc).__name__, exc)))
+        self.latencies["service"].append(time.perf_counter() - queued)
+        return self._finish(start, 200, payload, ctype=ctype)
+
+    def _finish(self, start, status, payload, extra=None, ctype="application/json"):
+        self.status_counts[status] += 1
+        if status == 200:
+            self.latencies["total"].append(time.perf_counter() - start)
+        return status, ctype, payload, extra or {}
+
+    def get_stats(self):
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "pending": self.pending,
+            "requests": {str(status): count for status, count in sorted(self.status_counts.items())},
+            "latency_ms": {name: percentiles(values)
+                           for name, values in self.latencies.items()},
+        }
+
+
+def percentiles(values):
+    """
+    値(s)のp50, p90, p99, 最大(ms)
+    """
+    if not values:
+        return {"count": 0}
+    arr = np.sort(np.asarray(values)) * 1000
+    res = {"count": len(arr)}
+    for p in (50, 90, 99):
+        res["p{}".format(p)] = round(float(np.percentile(arr, p)), 3)
+    res["max"] = round(float(arr[-1]), 3)
+    return res
+
+
+def parse_params(query):
+    """
+    クエリ文字列から変換のパラメータを読む
+    """
+    qs = {name: values[-1] for name, values in parse_qs(query).items()}
+    params = {}
+    for name, (type_, default) in PARAMS.items():
+        if name not in qs:
+            params[name] = default
+            continue
+        try:
+            params[name] = type_(qs[name])
+        except ValueError:
+            raise RequestError(400, "invalid value of {}: {}".format(name, qs[name]))
+    params["threshold"] = None
+    if "threshold" in qs:
+        try:
+            params["threshold"] = [int(v) for v in qs["threshold"].split(",")]
+        except ValueError:
+            params["threshold"] = []
+        if len(params["threshold"]) != 2:
+            raise RequestError(400, "threshold must be MIN,MAX")
+    params["format"] = qs.get("format", "json")
+    if params["format"] not in ("json", "picf"):
+        raise RequestError(400, 'format must be "json" or "picf"')
+    for name in ("latex", "desmos"):
+        params[name] = qs.get(name, "0").lower() in ("1", "true", "yes")
+    if params["format"] == "picf" and (params["latex"] or params["desmos"]):
+        raise RequestError(400, "latex and desmos can be requested only with format=json")
+    if params["method"] not in ("greedy", "graph"):
+        raise RequestError(400, 'method must be "greedy" or "graph"')
+    if params["auto"] not in ("median", "otsu"):
+        raise RequestError(400, 'auto must be "median" or "otsu"')
+    if params["maxd"] < 1 or params["n"] < 1:
+        raise RequestError(400, "n and maxd must be positive")
+    return params
+
+
+def init_worker():
+    """
+    ワーカーの初期化．最初のリクエストでnumbaのコンパイルを待たないように
+    小さな画像を一度変換しておく
+    """
+    img = np.zeros((64, 64), dtype=np.uint8)
+    cv2.circle(img, (32, 32), 20, 255, 2)
+    x_picf, y_picf = pic2formula.generate(img, 10, headless=True, verbose=False)
+    x_picf.fraction(100)
+    y_picf.fraction(100)
+
+
+def ping():
+    return os.getpid()
+
+
+def convert(data, params):
+    """
+    画像のバイト列を数式に変換する(ワーカーで実行する)
+
+    Returns
+    -------
+    (content_type, payload)
+    """
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise RequestError(400, "could not decode the image")
+    stats = pic2formula.Stats()
+    t0 = time.perf_counter()
+    x_picf, y_picf = pic2formula.generate(
+        img, n=params["n"], e=params["e"], k=params["k"], ml=params["ml"],
+        method=params["method"], headless=True, threshold=params["threshold"],
+        auto=params["auto"], blur=params["blur"], scale=params["scale"],
+        verbose=False, stats=stats, degree_tol=params["tol"],
+        simplify_tol=params["simplify"])
+    if x_picf.num == 0:
+        raise RequestError(422, "no curves were found in the image")
+    t1 = time.perf_counter()
+    x_picff = x_picf.fraction(params["maxd"]).pack()
+    y_picff = y_picf.fraction(params["maxd"]).pack()
+    t2 = time.perf_counter()
+
+    if params["format"] == "picf":
+        f = io.BytesIO()
+        pic2formula.save_picf(f, x_picff, y_picff)
+        return "application/octet-stream", f.getvalue()
+
+    res = {"num": x_picff.num, "maxd": params["maxd"],
+           "degrees": x_picff.degrees.tolist()}
+    for axis, picf in (("x", x_picff), ("y", y_picff)):
+        r_num, r_den, p_num, p_den = picf.fractions
+        res[axis] = {"offsets": picf.offsets.tolist(),
+                     "r_num": r_num.tolist(), "r_den": r_den.tolist(),
+                     "p_num": p_num.tolist(), "p_den": p_den.tolist()}
+    if params["latex"]:
+        f = io.StringIO()
+        write_tex(f, x_picff, y_picff, showmax=params["showmax"])
+        res["latex"] = f.getvalue()
+    if params["desmos"]:
+        f = io.StringIO()
+        write_desmos(f, x_picff, y_picff)
+        res["desmos"] = f.getvalue()
+    res["timings"] = {"generate": t1 - t0, "fraction": t2 - t1,
+                      "write": time.perf_counter() - t2}
+    res["stats"] = stats.as_dict()
+    return "application/json", _json_bytes(res)
+
+
+def _json_bytes(obj):
+    # カウンタなどにnumpyのスカラーが混ざることがある
+    return json.dumps(obj, default=lambda v: v.item()).encode("utf-8")
+
+
+def _error_body(message):
+    return _json_bytes({"error": message})
+
+
+def _write_response(writer, status, payload, keep_alive, ctype="application/json", extra=None):
+    lines = ["HTTP/1.1 {} {}".format(status, REASONS.get(status, "")),
+             "Content-Type: {}".format(ctype),
+             "Content-Length: {}".format(len(payload)),
+             "Connection: {}".format("keep-alive" if keep_alive else "close")]
+    for name, value in (extra or {}).items():
+        lines.append("{}: {}".format(name, value))
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    writer.write(payload)
+
+
+if __name__ == '__main__':
+    main()